@@ -0,0 +1,284 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from src.common.instrumentation import current_rss_mb, peak_rss_mb
+from src.common.synthetic_data import generate_synthetic_dataset
+from util.paths import BASE_DIR, BENCHMARK_DIR
+
+
+##############################################
+# Measurement Helpers
+##############################################
+def summarize_latencies(latencies, items):
+    """Latency percentiles (ms) and throughput (items per second) for a list of call durations (s)."""
+    latencies_ms = np.asarray(latencies) * 1000.0
+    total = float(np.sum(latencies))
+    return {
+        "calls": len(latencies),
+        "items": int(items),
+        "total_s": round(total, 6),
+        "latency_ms": {
+            "mean": round(float(latencies_ms.mean()), 4),
+            "p50": round(float(np.percentile(latencies_ms, 50)), 4),
+            "p90": round(float(np.percentile(latencies_ms, 90)), 4),
+            "p99": round(float(np.percentile(latencies_ms, 99)), 4),
+            "max": round(float(latencies_ms.max()), 4),
+        },
+        "throughput_per_s": round(items / total, 2) if total > 0 else None,
+    }
+
+
+def measure(func, args_list, items_per_call=1):
+    """
+    Call `func(*args)` for every entry of `args_list` and summarize the latencies.
+
+    Returns:
+        tuple: (stage summary dict, result of the last call)
+    """
+    rss_before = current_rss_mb()
+    latencies = []
+    result = None
+    for args in args_list:
+        tic = time.perf_counter()
+        result = func(*args)
+        latencies.append(time.perf_counter() - tic)
+    summary = summarize_latencies(latencies, items_per_call * len(args_list))
+    summary["rss_before_mb"] = round(rss_before, 2)
+    summary["rss_after_mb"] = round(current_rss_mb(), 2)
+    # ru_maxrss is a process-wide high-water mark: the peak of every stage run so far, not of this one.
+    summary["process_peak_rss_mb"] = round(peak_rss_mb(), 2)
+    return summary, result
+
+
+class HashingEncoder:
+    """
+    Stand-in for the sentence encoder: hashes tokens into a fixed number of buckets and L2-normalizes.
+    It has the same `encode` signature and output shape as all-MiniLM-L6-v2, so the embedding stage
+    can be timed without downloading the model.
+    """
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def encode(self, texts, show_progress_bar=False):
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in text.lower().split():
+                embeddings[row, zlib.crc32(token.encode("utf8")) % self.dim] += 1.0
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+
+def git_version():
+    """Short commit hash of the working tree, or None outside a git checkout."""
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+                             capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+##############################################
+# Benchmark Suite
+##############################################
+def run_benchmarks(n_ratings=100_000, n_queries=20, repeats=3, n_factors=20, top_n=5, seed=42,
+                   data_dir=None, output_path=None):
+    """
+    Time every pipeline stage on a synthetic dataset and write the results to JSON.
+
+    Stages: preprocessing, matrix build, `train_svd`, cf/svd/content queries, sentiment and embeddings
+    (with a hashing stub instead of the sentence encoder). Build stages are repeated `repeats` times,
+    query stages run once per sampled id. A stage whose optional dependency is missing is recorded
+    as skipped instead of failing the whole run.
+
+    Returns:
+        dict: The benchmark report (also written to `output_path`).
+    """
+    import src.common.data_preprocessing as dp
+    import src.common.text_embeddings as te
+    import src.level2_cf as l2
+    import src.level3_matrix_factorization as l3
+    from src.common.user_item_matrix_components import build_user_item_matrix_chunked, \
+        build_user_item_matrix_components
+
+    work_dir = tempfile.mkdtemp(prefix="recsys_bench_")
+    previous_cache_dir = os.environ.get("CACHE_DIR")
+    previous_encoder = te.model
+    try:
+        data_dir = data_dir or os.path.join(work_dir, "synthetic")
+        processed_dir = os.path.join(work_dir, "processed")
+        # Keep the cached decorators away from the real cache so every stage does its full work.
+        os.environ["CACHE_DIR"] = os.path.join(work_dir, "cache")
+
+        rng = np.random.default_rng(seed)
+        stages = {}
+
+        tic = time.perf_counter()
+        paths = generate_synthetic_dataset(n_ratings=n_ratings, seed=seed, output_dir=data_dir)
+        generation_s = time.perf_counter() - tic
+
+        # Preprocessing: every processed schema doubles as the raw input schema.
+        for name, func in [("business", dp.preprocess_business), ("reviews", dp.preprocess_reviews),
+                           ("ratings", dp.preprocess_ratings), ("user", dp.preprocess_user),
+                           ("checkin", dp.preprocess_checkin)]:
+            output_csv = os.path.join(processed_dir, f"{name}_processed.csv")
+            with open(paths[name], encoding="utf8") as f:
+                rows = sum(1 for _ in f) - 1
+            stages[f"preprocess_{name}"], _ = measure(func, [(paths[name], output_csv)] * repeats, items_per_call=rows)
+
+        ratings_df = pd.read_csv(os.path.join(processed_dir, "ratings_processed.csv"))
+        reviews_df = pd.read_csv(os.path.join(processed_dir, "reviews_processed.csv"))
+        business_df = pd.read_csv(os.path.join(processed_dir, "business_processed.csv"))
+
+        stages["matrix_build"], matrix_components = measure(
+            build_user_item_matrix_components, [(ratings_df,)] * repeats, items_per_call=len(ratings_df))
+        sparse_matrix, user_ids, business_ids = matrix_components
+        stages["matrix_build_chunked"], _ = measure(
+            build_user_item_matrix_chunked, [(os.path.join(processed_dir, "ratings_processed.csv"),)] * repeats,
+            items_per_call=len(ratings_df))
+
+        stages["train_svd"], svd_components = measure(
+            lambda m: l3.train_svd.__wrapped__(m, n_factors=n_factors), [(sparse_matrix,)] * repeats,
+            items_per_call=sparse_matrix.nnz)
+
+        sample_users = [user_ids[i] for i in
+                        rng.choice(len(user_ids), size=min(n_queries, len(user_ids)), replace=False)]
+        stages["cf_query"], _ = measure(
+            lambda u: l2.user_based_recommendations(u, matrix_components, top_n=top_n), [(u,) for u in sample_users])
+        stages["svd_query"], _ = measure(
+            lambda u: l3.matrix_factorization_recommendations(u, matrix_components, svd_components, top_n=top_n),
+            [(u,) for u in sample_users])
+
+        te.model = HashingEncoder()
+        texts = reviews_df["review_text"].tolist()
+        stages["embeddings_stub"], _ = measure(te.compute_embeddings.__wrapped__, [(texts,)], items_per_call=len(texts))
+
+        try:
+            import src.level1_content_based as l1
+        except ImportError as e:
+            for name in ["sentiment", "item_profiles", "content_query"]:
+                stages[name] = {"skipped": f"missing dependency: {e.name}"}
+        else:
+            stages["sentiment"], _ = measure(l1.calculate_business_sentiments.__wrapped__, [(reviews_df,)],
+                                             items_per_call=len(reviews_df))
+            stages["item_profiles"], profiles = measure(l1.build_item_profiles, [(business_df, reviews_df)],
+                                                        items_per_call=len(business_df))
+            profile_ids = list(profiles.keys())
+            sample_businesses = [profile_ids[i] for i in
+                                 rng.choice(len(profile_ids), size=min(n_queries, len(profile_ids)), replace=False)]
+            stages["content_query"], _ = measure(
+                lambda b: l1.recommend_similar_businesses(b, profiles, top_n=top_n), [(b,) for b in sample_businesses])
+
+        report = {
+            "version": git_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "environment": {
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "pandas": pd.__version__,
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+            },
+            "config": {
+                "n_ratings": n_ratings, "n_queries": n_queries, "repeats": repeats,
+                "n_factors": n_factors, "top_n": top_n, "seed": seed,
+            },
+            "dataset": {
+                "ratings": int(sparse_matrix.nnz), "users": len(user_ids), "businesses": len(business_ids),
+                "reviews": len(reviews_df), "generation_s": round(generation_s, 3),
+            },
+            "stages": stages,
+            "peak_rss_mb": round(peak_rss_mb(), 2),
+        }
+
+        output_path = output_path or default_output_path(n_ratings)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Benchmark results saved to {output_path}")
+        return report
+    finally:
+        if previous_cache_dir is None:
+            os.environ.pop("CACHE_DIR", None)
+        else:
+            os.environ["CACHE_DIR"] = previous_cache_dir
+        te.model = previous_encoder
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def default_output_path(n_ratings):
+    return os.path.join(BENCHMARK_DIR, f"bench_{n_ratings}_{time.strftime('%Y%m%d_%H%M%S')}.json")
+
+
+def compare_benchmarks(baseline_path, current_path, tolerance=0.10):
+    """
+    Compare the p50 latency of every stage between two benchmark reports.
+
+    Returns:
+        list of tuples: (stage, baseline p50 ms, current p50 ms, relative change) for stages
+        that got slower by more than `tolerance`.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)["stages"]
+    with open(current_path) as f:
+        current = json.load(f)["stages"]
+
+    regressions = []
+    for stage, result in current.items():
+        if "latency_ms" not in result or "latency_ms" not in baseline.get(stage, {}):
+            continue
+        old = baseline[stage]["latency_ms"]["p50"]
+        new = result["latency_ms"]["p50"]
+        change = (new - old) / old if old > 0 else 0.0
+        if change > tolerance:
+            regressions.append((stage, old, new, change))
+    return regressions
+
+
+def print_report(report):
+    print(f"{'stage':<22}{'p50 ms':>12}{'p99 ms':>12}{'items/s':>14}{'RSS after MB':>14}")
+    for stage, result in report["stages"].items():
+        if "skipped" in result:
+            print(f"{stage:<22}  skipped ({result['skipped']})")
+            continue
+        latency = result["latency_ms"]
+        print(f"{stage:<22}{latency['p50']:>12.3f}{latency['p99']:>12.3f}"
+              f"{result['throughput_per_s'] or 0:>14.1f}{result['rss_after_mb']:>14.1f}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Scaling benchmark suite on synthetic Yelp-shaped data")
+    parser.add_argument('--n_ratings', type=int, default=100_000,
+                        help="Number of synthetic ratings, 10k to 10M (default is 100000).")
+    parser.add_argument('--n_queries', type=int, default=20,
+                        help="Number of sampled ids per query stage (default is 20).")
+    parser.add_argument('--repeats', type=int, default=3,
+                        help="Number of repetitions of each build stage (default is 3).")
+    parser.add_argument('--n_factors', type=int, default=20,
+                        help="Number of latent factors for SVD (default is 20).")
+    parser.add_argument('--output', type=str, default=None,
+                        help="Path of the JSON report. Defaults to a timestamped file in data/benchmarks.")
+    parser.add_argument('--compare', type=str, default=None,
+                        help="Baseline JSON report to check the new results against.")
+    args = parser.parse_args()
+
+    output_path = args.output or default_output_path(args.n_ratings)
+    report = run_benchmarks(n_ratings=args.n_ratings, n_queries=args.n_queries, repeats=args.repeats,
+                            n_factors=args.n_factors, output_path=output_path)
+    print_report(report)
+
+    if args.compare:
+        for stage, old, new, change in compare_benchmarks(args.compare, output_path):
+            print(f"Regression in {stage}: p50 {old:.3f} ms -> {new:.3f} ms ({change:+.0%})")
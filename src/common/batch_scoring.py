@@ -0,0 +1,239 @@
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from src.common.instrumentation import current_rss_mb, peak_rss_mb, span, traced
+from src.common.model_store import SharedModel
+
+OUTPUT_FORMATS = ("csv", "jsonl", "parquet")
+
+
+##############################################
+# Input
+##############################################
+def read_id_chunks(source, chunk_size=10_000):
+    """
+    Stream IDs in lists of `chunk_size` from a file with one ID per line, or "-" for stdin. Only the first
+    comma-separated field of a line is used, so a CSV whose first column holds the IDs works too; blank
+    lines and a user_id/business_id/id header are skipped.
+    """
+    f = sys.stdin if source == "-" else open(source)
+    try:
+        chunk = []
+        for line in f:
+            value = line.split(",", 1)[0].strip()
+            if not value or value in ("user_id", "business_id", "id"):
+                continue
+            chunk.append(value)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+##############################################
+# Output
+##############################################
+def open_output(path, newline=None):
+    """
+    The file behind an output path. "-" is the standard output of the process, even while `print` output
+    is redirected to stderr (main does so when results go to stdout, so logs do not end up among them).
+    """
+    return sys.__stdout__ if path == "-" else open(path, "w", newline=newline)
+
+
+def close_output(file):
+    if file is sys.__stdout__:
+        file.flush()
+    else:
+        file.close()
+
+
+class CsvResultWriter:
+    """One row per recommendation: id, rank, business_id (IDs without recommendations get no rows)."""
+
+    def __init__(self, path):
+        self.file = open_output(path, newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["id", "rank", "business_id"])
+
+    def write(self, ids, results):
+        self.writer.writerows((entity_id, rank, business_id) for entity_id, recommendations in zip(ids, results)
+                              for rank, business_id in enumerate(recommendations, 1))
+
+    def close(self):
+        close_output(self.file)
+
+
+class JsonlResultWriter:
+    """One JSON object per ID: {"id": ..., "recommendations": [...]}."""
+
+    def __init__(self, path):
+        self.file = open_output(path)
+
+    def write(self, ids, results):
+        self.file.writelines(json.dumps({"id": entity_id, "recommendations": recommendations}) + "\n"
+                             for entity_id, recommendations in zip(ids, results))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        close_output(self.file)
+
+
+class ParquetResultWriter:
+    """The CSV layout (id, rank, business_id) as a Parquet file, one row group per chunk. Needs pyarrow."""
+
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("Parquet output needs pyarrow (pip install pyarrow); use csv or jsonl") from e
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([("id", pyarrow.string()), ("rank", pyarrow.int16()),
+                                      ("business_id", pyarrow.string())])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, ids, results):
+        lengths = np.fromiter((len(recommendations) for recommendations in results), dtype=np.int64, count=len(ids))
+        table = self.pa.table({
+            "id": np.repeat(np.asarray(ids, dtype=object), lengths),
+            "rank": np.concatenate([np.arange(1, n + 1, dtype=np.int16) for n in lengths]) if len(ids) else [],
+            "business_id": [business_id for recommendations in results for business_id in recommendations],
+        }, schema=self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+
+def open_result_writer(path, output_format=None):
+    """Writer for `path` ("-" for stdout); the format defaults to the file extension, else csv."""
+    output_format = output_format or os.path.splitext(path)[1].lstrip(".").lower() or "csv"
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}'; expected one of {OUTPUT_FORMATS}")
+    if output_format == "parquet" and path == "-":
+        raise ValueError("Parquet output cannot go to stdout; pass a file path")
+    if path != "-" and os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    writers = {"csv": CsvResultWriter, "jsonl": JsonlResultWriter, "parquet": ParquetResultWriter}
+    return writers[output_format](path)
+
+
+##############################################
+# Scoring
+##############################################
+# Batch scorer of the current process. Set before the worker pool is forked, so workers share the
+# loaded (mostly memory-mapped) models with the parent instead of loading them again, or built per worker
+# from a published model by `attach_shared_model`.
+batch_scorer = None
+shared_model = None
+
+
+def attach_shared_model(model_name, make_scorer):
+    """
+    Process pool initializer: map the published model `model_name` read-only (one page-cache copy for
+    every worker, see src.common.model_store) and build the worker's scorer from it with `make_scorer(model)`.
+    The worker keeps the version it attached to for the whole run.
+    """
+    global batch_scorer, shared_model
+    shared_model = SharedModel(model_name)
+    batch_scorer = make_scorer(shared_model.model)
+
+
+def score_chunk(ids, top_n=5, batch_size=256):
+    """Score one chunk of IDs with `batch_scorer`, `batch_size` IDs per batched call (bounds the score matrix)."""
+    tic = time.perf_counter()
+    results = []
+    for start in range(0, len(ids), batch_size):
+        results += batch_scorer(ids[start:start + batch_size], top_n)
+    return results, time.perf_counter() - tic
+
+
+@traced("batch_scoring.run")
+def run_batch(scorer, id_chunks, writer, top_n=5, jobs=1, batch_size=256, model_name=None, make_scorer=None):
+    """
+    Score a stream of ID chunks with `scorer(ids, top_n)` (one of the `*_batch_fn` of
+    src.common.micro_batching) and write the results in input order.
+
+    With jobs > 1 the chunks are scored in forked worker processes, with at most 2 * jobs chunks in
+    flight, so memory stays bounded by a few chunks of IDs and results however long the input is.
+    Given a published `model_name`, every worker attaches to it and scores with `make_scorer(model)`
+    instead of inheriting `scorer`, so the model arrays are mapped once for all workers.
+
+    Returns:
+        dict: Throughput summary (IDs, IDs without recommendations, chunks, seconds, IDs per second,
+        chunk latency percentiles and peak RSS).
+    """
+    global batch_scorer
+    batch_scorer = scorer
+    summary = {"ids": 0, "empty": 0, "chunks": 0}
+    chunk_seconds = []
+
+    def emit(ids, results, seconds):
+        with span("batch_scoring.write", items=len(ids)):
+            writer.write(ids, results)
+        summary["ids"] += len(ids)
+        summary["empty"] += sum(1 for recommendations in results if not recommendations)
+        summary["chunks"] += 1
+        chunk_seconds.append(seconds)
+
+    tic = time.perf_counter()
+    if jobs <= 1:
+        for ids in id_chunks:
+            results, seconds = score_chunk(ids, top_n, batch_size)
+            emit(ids, results, seconds)
+    else:
+        initializer, initargs = (attach_shared_model, (model_name, make_scorer)) if model_name else (None, ())
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=initializer, initargs=initargs) as pool:
+            pending, finished, next_chunk = {}, {}, 0
+            chunks = enumerate(id_chunks)
+            exhausted = False
+            while not exhausted or pending:
+                while not exhausted and len(pending) < 2 * jobs:
+                    try:
+                        position, ids = next(chunks)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[pool.submit(score_chunk, ids, top_n, batch_size)] = (position, ids)
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    position, ids = pending.pop(future)
+                    finished[position] = (ids, *future.result())
+                # Write in input order; chunks that finish early wait for the ones before them.
+                while next_chunk in finished:
+                    emit(*finished.pop(next_chunk))
+                    next_chunk += 1
+    summary["seconds"] = time.perf_counter() - tic
+
+    summary["ids_per_second"] = summary["ids"] / summary["seconds"] if summary["seconds"] > 0 else 0.0
+    latencies = np.asarray(chunk_seconds or [0.0]) * 1000
+    summary["chunk_ms"] = {"p50": float(np.percentile(latencies, 50)), "p99": float(np.percentile(latencies, 99))}
+    summary["jobs"] = jobs
+    summary["rss_mb"] = round(current_rss_mb(), 1)
+    summary["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    return summary
+
+
+def print_batch_summary(summary):
+    print(f"Batch scoring: {summary['ids']} IDs in {summary['chunks']} chunks, {summary['seconds']:.2f} s, "
+          f"{summary['ids_per_second']:.0f} IDs/s with {summary['jobs']} worker(s)")
+    print(f"  IDs without recommendations: {summary['empty']}")
+    print(f"  Chunk latency p50 {summary['chunk_ms']['p50']:.1f} ms, p99 {summary['chunk_ms']['p99']:.1f} ms; "
+          f"peak RSS of the parent {summary['peak_rss_mb']:.0f} MB")
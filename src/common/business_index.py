@@ -0,0 +1,193 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.common.cache import get_cache_dir
+from src.common.instrumentation import span, traced
+from src.common.social_graph import user_ids_signature
+from src.common.user_item_matrix_components import replace_directory, source_signature
+
+FIELDS = ("city", "state", "category")
+
+
+def make_token(field, value):
+    """Index key of one attribute value, e.g. ("category", "Pizza") -> "category:pizza"."""
+    return f"{field}:{str(value).strip().lower()}"
+
+
+def parse_filter(expression):
+    """
+    Split a filter expression ("field:value|value;field:value") into its clauses, so a malformed
+    expression can be reported before any index is loaded.
+
+    Returns:
+        list of tuples: (field, list of values) per clause.
+
+    Raises:
+        ValueError: For an empty expression or a clause without a known field or a value.
+    """
+    clauses = []
+    for clause in expression.split(";"):
+        if not clause.strip():
+            continue
+        field, _, values = clause.partition(":")
+        field = field.strip().lower()
+        if field not in FIELDS or not values.strip():
+            raise ValueError(f"Invalid filter clause '{clause}'; expected one of {FIELDS} as 'field:value'")
+        clauses.append((field, values.split("|")))
+    if not clauses:
+        raise ValueError("Empty filter expression")
+    return clauses
+
+
+##############################################
+# Construction
+##############################################
+@traced("business_index.build", items=lambda index: len(index.rows))
+def build_business_index(business_df, business_ids):
+    """
+    Inverted index over the city, state and category tokens of business_processed.csv, keyed on the
+    row order `business_ids` of the model it filters (profile order for content, matrix columns for
+    cf/svd). Categories are split from the comma-separated `categories` column.
+
+    Returns:
+        BusinessIndex
+    """
+    business_df = business_df.drop_duplicates("business_id").set_index("business_id")
+    positions = business_df.index.get_indexer(business_ids)
+    known = np.flatnonzero(positions >= 0).astype(np.int32)
+    business_df = business_df.iloc[positions[known]]
+
+    token_chunks, row_chunks = [], []
+    for field, column in (("city", "city"), ("state", "state")):
+        values = business_df[column].astype("string").fillna("")
+        keep = (values != "").to_numpy()
+        token_chunks.append(np.asarray([make_token(field, value) for value in values[keep]], dtype=object))
+        row_chunks.append(known[keep])
+    categories = business_df["categories"].astype("string").fillna("").str.split(",")
+    lengths = categories.str.len().to_numpy()
+    tokens = categories.explode().str.strip()
+    keep = (tokens != "").to_numpy()
+    token_chunks.append(np.asarray(["category:" + token.lower() for token in tokens[keep]], dtype=object))
+    row_chunks.append(np.repeat(known, lengths)[keep])
+
+    codes, vocabulary = pd.factorize(np.concatenate(token_chunks))
+    rows = np.concatenate(row_chunks)
+    # Group by token; within a token the rows stay ascending, which the intersections rely on.
+    order = np.lexsort((rows, codes))
+    codes, rows = codes[order], rows[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (codes[1:] != codes[:-1]) | (rows[1:] != rows[:-1])
+    codes, rows = codes[first], rows[first]
+    indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=len(vocabulary)), out=indptr[1:])
+    return BusinessIndex(list(vocabulary), indptr, rows.astype(np.int32), len(business_ids))
+
+
+class BusinessIndex:
+    """
+    Posting lists (sorted int32 row positions) per city, state and category token.
+
+    Filter expressions select rows before a recommender scores anything: clauses separated by ";" are
+    intersected and the values of one clause separated by "|" are united, e.g.
+    "city:Philadelphia;category:Pizza|Burgers" (Philadelphia businesses listed as pizza or burger places).
+    Matching is case-insensitive. Intersections start from the shortest posting list.
+    """
+
+    def __init__(self, tokens, indptr, rows, n_rows):
+        self.tokens = list(tokens)
+        self.token_codes = {token: code for code, token in enumerate(self.tokens)}
+        self.indptr = indptr
+        self.rows = rows
+        self.n_rows = n_rows
+
+    def postings(self, token):
+        """Rows carrying `token` ("field:value"); empty for unknown tokens."""
+        code = self.token_codes.get(token)
+        if code is None:
+            return np.empty(0, dtype=np.int32)
+        return self.rows[self.indptr[code]:self.indptr[code + 1]]
+
+    def clause_rows(self, field, values):
+        lists = [self.postings(make_token(field, value)) for value in values]
+        if len(lists) == 1:
+            return lists[0]
+        return np.unique(np.concatenate(lists)).astype(np.int32)
+
+    def select(self, expression):
+        """
+        Rows matching a filter expression, sorted ascending.
+
+        Returns:
+            numpy.ndarray: int32 row positions in the order of the `business_ids` the index was built for.
+        """
+        with span("business_index.select", expression=expression) as s:
+            lists = sorted((self.clause_rows(field, values) for field, values in parse_filter(expression)), key=len)
+            rows = lists[0]
+            for other in lists[1:]:
+                if len(rows) == 0:
+                    break
+                rows = np.intersect1d(rows, other, assume_unique=True)
+            s.set_items(len(rows))
+        return rows
+
+    def vocabulary(self, field):
+        """Values of one field with their posting list lengths, most frequent first."""
+        prefix = f"{field}:"
+        counts = {token[len(prefix):]: int(self.indptr[code + 1] - self.indptr[code])
+                  for code, token in enumerate(self.tokens) if token.startswith(prefix)}
+        return dict(sorted(counts.items(), key=lambda item: -item[1]))
+
+
+##############################################
+# Memory-Mappable Persistence
+##############################################
+def load_business_index(business_csv, business_ids, cache_name="business_index"):
+    """
+    The index over `business_ids`, memory-mapped from the cache directory when it was built from the same
+    (unchanged) business file and the same business order, otherwise built and saved.
+
+    `cache_name` must differ per row order that is kept around (e.g. profile order vs. matrix columns).
+    """
+    directory = os.path.join(get_cache_dir(), cache_name)
+    meta = {"source": source_signature(business_csv), "business_ids": user_ids_signature(business_ids)}
+    meta_path = os.path.join(directory, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            saved = json.load(f)
+        if saved["source"] == meta["source"] and saved["business_ids"] == meta["business_ids"]:
+            print(f"Loading memory-mapped business index from {directory}")
+            load = lambda name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+            return BusinessIndex(load("tokens").tolist(), load("indptr"), load("rows"), saved["n_rows"])
+
+    business_df = pd.read_csv(business_csv, usecols=["business_id", "city", "state", "categories"],
+                              dtype={"business_id": str})
+    index = build_business_index(business_df, business_ids)
+    tmp_directory = f"{directory}.tmp-{os.getpid()}"
+    os.makedirs(tmp_directory, exist_ok=True)
+    np.save(os.path.join(tmp_directory, "tokens.npy"), np.asarray(index.tokens, dtype=str))
+    np.save(os.path.join(tmp_directory, "indptr.npy"), index.indptr)
+    np.save(os.path.join(tmp_directory, "rows.npy"), index.rows)
+    with open(os.path.join(tmp_directory, "meta.json"), "w") as f:
+        json.dump({**meta, "n_rows": index.n_rows, "n_tokens": len(index.tokens)}, f, indent=2)
+    replace_directory(tmp_directory, directory)
+    print(f"Business index saved to {directory}")
+    return index
+
+
+if __name__ == "__main__":
+    import time
+
+    from util.paths import DATA_PROCESSED
+
+    business_csv = os.path.join(DATA_PROCESSED, "business_processed.csv")
+    business_ids = pd.read_csv(business_csv, usecols=["business_id"], dtype=str)["business_id"].tolist()
+    index = load_business_index(business_csv, business_ids)
+    city = next(iter(index.vocabulary("city")))
+    categories = list(index.vocabulary("category"))[:2]
+    expression = f"city:{city};category:{'|'.join(categories)}"
+    tic = time.perf_counter()
+    rows = index.select(expression)
+    print(f"'{expression}': {len(rows)} of {index.n_rows} businesses ({(time.perf_counter() - tic) * 1e6:.0f} us)")
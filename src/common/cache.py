@@ -1,34 +1,56 @@
+import inspect
 import os
 import pickle
 from functools import wraps
 
+from src.common.instrumentation import span
 from util.paths import CACHE_DIR, TEST_CACHE_DIR
 
 
+def get_cache_dir():
+    """
+    Return the cache directory for the current run.
+    If the environment variable TESTING is set to "True", it uses the test cache directory.
+    An explicit CACHE_DIR environment variable (e.g. set by the benchmarks) takes precedence.
+    """
+    test_mode = os.environ.get("TESTING", "False") == "True"
+    base_cache_dir = CACHE_DIR if not test_mode else TEST_CACHE_DIR
+    return os.environ.get("CACHE_DIR", base_cache_dir)
+
+
 def cache_results(cache_filename, force_recompute=False):
     """
     Decorator to cache the output of a function to disk.
     If the environment variable TESTING is set to "True", it uses the test cache directory.
     Accepts only a filename; the full path is constructed automatically.
+    The filename may reference the function's arguments, e.g. "svd_model_cache_{n_factors}.pkl", so calls
+    with different hyperparameters do not share one cache file. For names that depend on the arguments in
+    other ways, pass a callable that takes the arguments as keywords and returns the filename.
+    The uncached function stays reachable as `func.__wrapped__`.
     """
 
     def decorator(func):
+        signature = inspect.signature(func)
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # Determine if in test mode
-            test_mode = os.environ.get("TESTING", "False") == "True"
-            base_cache_dir = CACHE_DIR if not test_mode else TEST_CACHE_DIR
-
-            final_cache_path = os.path.join(base_cache_dir, cache_filename)
+            filename = cache_filename
+            if callable(filename) or "{" in filename:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                filename = filename(**bound.arguments) if callable(filename) else filename.format(**bound.arguments)
+            final_cache_path = os.path.join(get_cache_dir(), filename)
 
             if os.path.exists(final_cache_path) and not force_recompute:
-                print(f"Loading cached results from {final_cache_path}")
-                with open(final_cache_path, "rb") as f:
-                    return pickle.load(f)
-            result = func(*args, **kwargs)
-            os.makedirs(os.path.dirname(final_cache_path), exist_ok=True)
-            with open(final_cache_path, "wb") as f:
-                pickle.dump(result, f)
+                with span("cache.hit", file=filename):
+                    print(f"Loading cached results from {final_cache_path}")
+                    with open(final_cache_path, "rb") as f:
+                        return pickle.load(f)
+            with span("cache.miss", file=filename):
+                result = func(*args, **kwargs)
+                os.makedirs(os.path.dirname(final_cache_path), exist_ok=True)
+                with open(final_cache_path, "wb") as f:
+                    pickle.dump(result, f)
             return result
 
         return wrapper
@@ -0,0 +1,260 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.common.cache import get_cache_dir
+from src.common.instrumentation import span, traced
+from src.common.user_item_matrix_components import assign_codes, replace_directory, source_signature
+
+SECONDS_PER_DAY = 86400
+SEGMENT_LEVELS = ("state", "city")
+
+
+##############################################
+# Segments
+##############################################
+def parse_segment(segment):
+    """
+    Split a segment expression ("state:PA" or "city:Philadelphia, PA") into (level, label).
+
+    Raises:
+        ValueError: Without a known level or a label.
+    """
+    level, _, label = segment.partition(":")
+    level, label = level.strip().lower(), label.strip()
+    if level not in SEGMENT_LEVELS or not label:
+        raise ValueError(f"Invalid segment '{segment}'; expected 'state:<STATE>' or 'city:<CITY>, <STATE>'")
+    return level, label
+
+
+def segment_labels(business_df):
+    """Segment label per business row and level: its state, or "City, ST" for the city level."""
+    states = business_df["state"].astype("string")
+    return {"state": states, "city": business_df["city"].astype("string") + ", " + states}
+
+
+def check_segment(segment, business_df):
+    """
+    Parse a segment expression and check its label (case-insensitively) against the businesses.
+
+    Returns:
+        tuple: (level, label)
+
+    Raises:
+        ValueError: For a malformed expression or a label no business has.
+    """
+    level, label = parse_segment(segment)
+    if label.lower() not in set(segment_labels(business_df)[level].dropna().str.lower()):
+        raise ValueError(f"Unknown {level} '{label}' in segment '{segment}'")
+    return level, label
+
+
+##############################################
+# Check-in Timestamps
+##############################################
+@traced("checkin.parse_times", items=lambda components: len(components[1]))
+def parse_checkin_times(checkin_csv, chunk_size=10000):
+    """
+    Parse the comma-separated `date` strings of checkin_processed.csv into epoch seconds, streaming the
+    file in chunks. The `date_list` column (the same timestamps as a Python list literal) is not read.
+
+    Returns:
+        tuple: (indptr int64, times int64 epoch seconds, business_ids list). The check-ins of business
+        `business_ids[b]` are `times[indptr[b]:indptr[b + 1]]`, sorted ascending.
+    """
+    business_codes = {}
+    code_chunks, time_chunks = [], []
+    reader = pd.read_csv(checkin_csv, usecols=["business_id", "date"], chunksize=chunk_size,
+                         dtype={"business_id": str, "date": str})
+    for chunk in reader:
+        chunk = chunk.dropna(subset=["business_id", "date"])
+        codes = assign_codes(chunk["business_id"].to_numpy(), business_codes)
+        dates = chunk["date"].str.split(",")
+        lengths = dates.str.len().to_numpy()
+        timestamps = pd.to_datetime(dates.explode().str.strip(), format="%Y-%m-%d %H:%M:%S", errors="coerce")
+        valid = timestamps.notna().to_numpy()
+        code_chunks.append(np.repeat(codes, lengths)[valid])
+        time_chunks.append(timestamps.to_numpy()[valid].astype("datetime64[s]").astype(np.int64))
+
+    codes = np.concatenate(code_chunks) if code_chunks else np.empty(0, dtype=np.int32)
+    times = np.concatenate(time_chunks) if time_chunks else np.empty(0, dtype=np.int64)
+    order = np.lexsort((times, codes))
+    indptr = np.zeros(len(business_codes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=len(business_codes)), out=indptr[1:])
+    return indptr, times[order], list(business_codes)
+
+
+def load_checkin_times(checkin_csv, cache_name="checkin_times"):
+    """
+    `parse_checkin_times`, memory-mapped from .npy files in the cache directory while checkin_csv is unchanged.
+    """
+    directory = os.path.join(get_cache_dir(), cache_name)
+    meta_path = os.path.join(directory, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f)["source"] == source_signature(checkin_csv):
+                print(f"Loading memory-mapped check-in times from {directory}")
+                load = lambda name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                return load("indptr"), load("times"), load("business_ids").tolist()
+
+    indptr, times, business_ids = parse_checkin_times(checkin_csv)
+    tmp_directory = f"{directory}.tmp-{os.getpid()}"
+    os.makedirs(tmp_directory, exist_ok=True)
+    np.save(os.path.join(tmp_directory, "indptr.npy"), indptr)
+    np.save(os.path.join(tmp_directory, "times.npy"), times)
+    np.save(os.path.join(tmp_directory, "business_ids.npy"), np.asarray(business_ids, dtype=str))
+    with open(os.path.join(tmp_directory, "meta.json"), "w") as f:
+        json.dump({"source": source_signature(checkin_csv), "n_checkins": int(len(times))}, f, indent=2)
+    replace_directory(tmp_directory, directory)
+    print(f"Check-in times saved to {directory}")
+    return indptr, times, business_ids
+
+
+##############################################
+# Time-Decayed Popularity
+##############################################
+def decay_rate(half_life_days):
+    return np.log(2.0) / (half_life_days * SECONDS_PER_DAY)
+
+
+def decayed_counts(indptr, times, as_of, half_life_days=90.0):
+    """
+    Exponentially decayed check-in count per business as of `as_of` (epoch seconds): every check-in
+    counts 1 at `as_of` and half as much `half_life_days` earlier. Check-ins after `as_of` count fully.
+    """
+    weights = np.exp(-decay_rate(half_life_days) * np.maximum(as_of - np.asarray(times), 0))
+    counts = np.diff(indptr)
+    return np.bincount(np.repeat(np.arange(len(counts)), counts), weights=weights, minlength=len(counts))
+
+
+class PopularityIndex:
+    """
+    Businesses ranked by time-decayed check-in popularity, globally and per state and city, for
+    recommending to users the personalized methods know nothing (or too little) about.
+
+    Rankings are precomputed, so a top-N lookup only walks the first entries of one ranking. Decay is
+    applied incrementally: `advance` multiplies every score by the same factor, which leaves the
+    rankings untouched, and `add_checkins` adds the weights of new check-ins without rescanning the
+    history (the affected rankings are rebuilt lazily on the next lookup).
+    """
+
+    def __init__(self, checkin_components, business_df=None, half_life_days=90.0, as_of=None):
+        indptr, times, business_ids = checkin_components
+        self.half_life_days = half_life_days
+        self.business_ids = list(business_ids)
+        self.business_index = pd.Index(self.business_ids)
+        self.as_of = int(as_of if as_of is not None else (times.max() if len(times) else 0))
+        with span("checkin.decayed_counts", items=len(times)):
+            self.scores = decayed_counts(indptr, times, self.as_of, half_life_days)
+
+        # Segment codes per business (-1 where unknown) for the "state" and "city" levels.
+        self.segments = {}
+        if business_df is not None:
+            business_df = business_df.drop_duplicates("business_id").set_index("business_id")
+            business_df = business_df.reindex(self.business_ids)
+            for level, values in segment_labels(business_df).items():
+                # Labels are matched case-insensitively, so "state:pa" finds the PA businesses.
+                codes, labels = pd.factorize(values.str.lower())
+                self.segments[level] = (codes.astype(np.int32), {label: i for i, label in enumerate(labels)})
+        self._rankings = None
+
+    def _build_rankings(self):
+        with span("checkin.rank", items=len(self.scores)):
+            rankings = {None: np.argsort(-self.scores, kind="stable").astype(np.int32)}
+            for level, (codes, labels) in self.segments.items():
+                # One sort groups the businesses by segment and ranks them within it.
+                order = np.lexsort((-self.scores, codes))
+                order = order[codes[order] >= 0].astype(np.int32)
+                indptr = np.zeros(len(labels) + 1, dtype=np.int64)
+                np.cumsum(np.bincount(codes[codes >= 0], minlength=len(labels)), out=indptr[1:])
+                rankings[level] = (indptr, order)
+        self._rankings = rankings
+
+    def ranking(self, segment=None):
+        """
+        Business positions ordered by decreasing popularity.
+
+        Args:
+            segment (tuple): ("state", "PA") or ("city", "Philadelphia, PA"), case-insensitive; None ranks all
+                businesses. A segment without check-ins ranks nothing (see `check_segment` to reject unknown
+                labels up front).
+        """
+        if self._rankings is None:
+            self._build_rankings()
+        if segment is None:
+            return self._rankings[None]
+        if segment[0] not in self.segments:
+            raise ValueError(f"Unknown segment level '{segment[0]}'; expected one of {SEGMENT_LEVELS}")
+        indptr, order = self._rankings[segment[0]]
+        position = self.segments[segment[0]][1].get(segment[1].strip().lower())
+        if position is None:
+            return order[:0]
+        return order[indptr[position]:indptr[position + 1]]
+
+    def recommend(self, top_n=5, segment=None, exclude=None, allowed=None):
+        """The `top_n` most popular business IDs, skipping those in `exclude` or (if given) not in `allowed`."""
+        exclude = exclude or ()
+        recommendations = []
+        for position in self.ranking(segment):
+            business_id = self.business_ids[position]
+            if business_id not in exclude and (allowed is None or business_id in allowed):
+                recommendations.append(business_id)
+                if len(recommendations) == top_n:
+                    break
+        return recommendations
+
+    def advance(self, now):
+        """Decay every score to time `now` (epoch seconds)."""
+        if now > self.as_of:
+            self.scores *= np.exp(-decay_rate(self.half_life_days) * (now - self.as_of))
+            self.as_of = int(now)
+
+    def add_checkins(self, business_ids, timestamps):
+        """
+        Fold new check-ins into the scores. Check-ins of businesses the index does not know are skipped.
+
+        Returns:
+            int: Number of check-ins added.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if len(timestamps) == 0:
+            return 0
+        self.advance(timestamps.max())
+        positions = self.business_index.get_indexer(list(business_ids))
+        known = positions >= 0
+        weights = np.exp(-decay_rate(self.half_life_days) * (self.as_of - timestamps[known]))
+        np.add.at(self.scores, positions[known], weights)
+        self._rankings = None
+        return int(known.sum())
+
+
+def pad_with_fallback(recommendations, fallback, top_n, exclude=()):
+    """
+    Fill a recommendation list that came back shorter than `top_n` with `fallback(n, exclude=...)`
+    (e.g. `PopularityIndex.recommend`), skipping businesses already recommended or in `exclude`.
+    """
+    if fallback is None or len(recommendations) >= top_n:
+        return recommendations
+    seen = set(recommendations) | set(exclude)
+    return recommendations + fallback(top_n - len(recommendations), exclude=seen)
+
+
+if __name__ == "__main__":
+    import time
+
+    from util.paths import DATA_PROCESSED
+
+    checkin_components = load_checkin_times(os.path.join(DATA_PROCESSED, "checkin_processed.csv"))
+    business_df = pd.read_csv(os.path.join(DATA_PROCESSED, "business_processed.csv"))
+    popularity_index = PopularityIndex(checkin_components, business_df, half_life_days=90)
+    print(f"Most popular businesses: {popularity_index.recommend(5)}")
+
+    state = business_df["state"].iloc[0]
+    tic = time.perf_counter()
+    top = popularity_index.recommend(5, segment=("state", state))
+    print(f"Most popular businesses in {state} ({(time.perf_counter() - tic) * 1e6:.0f} us): {top}")
+
+    popularity_index.add_checkins(top[-1:] * 100, [popularity_index.as_of + 3600] * 100)
+    print(f"After 100 new check-ins for {top[-1]}: {popularity_index.recommend(5, segment=('state', state))}")
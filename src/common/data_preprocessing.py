@@ -4,6 +4,7 @@ import os
 
 import pandas as pd
 
+from src.common.instrumentation import current_span, traced
 from util.paths import DATA_RAW_JSON, DATA_RAW_CSV, DATA_PROCESSED, TEST_DATA_PROCESSED
 
 
@@ -27,6 +28,7 @@ def parse_list_field(value, separator=","):
 ##############################################
 # Conversion Functions (JSON -> CSV)
 ##############################################
+@traced("convert.business")
 def convert_business_json_to_csv(
         json_path=os.path.join(DATA_RAW_JSON, "yelp_academic_dataset_business.json"),
         output_path=os.path.join(DATA_RAW_CSV, "business.csv"),
@@ -69,8 +71,10 @@ def convert_business_json_to_csv(
         if chunk:
             writer.writerows(chunk)
             print(f"Processed a total of {count} business records.")
+        current_span().set_items(count)
 
 
+@traced("convert.review")
 def convert_review_json_to_csv(
         json_path=os.path.join(DATA_RAW_JSON, "yelp_academic_dataset_review.json"),
         reviews_output=os.path.join(DATA_RAW_CSV, "reviews.csv"),
@@ -124,8 +128,10 @@ def convert_review_json_to_csv(
             reviews_writer.writerows(reviews_chunk)
             ratings_writer.writerows(ratings_chunk)
             print(f"Processed a total of {count} review records.")
+        current_span().set_items(count)
 
 
+@traced("convert.user")
 def convert_user_json_to_csv(
         json_path=os.path.join(DATA_RAW_JSON, "yelp_academic_dataset_user.json"),
         output_path=os.path.join(DATA_RAW_CSV, "user.csv"),
@@ -163,8 +169,10 @@ def convert_user_json_to_csv(
         if chunk:
             writer.writerows(chunk)
             print(f"Processed a total of {count} user records.")
+        current_span().set_items(count)
 
 
+@traced("convert.checkin")
 def convert_checkin_json_to_csv(
         json_path=os.path.join(DATA_RAW_JSON, "yelp_academic_dataset_checkin.json"),
         output_path=os.path.join(DATA_RAW_CSV, "checkin.csv"),
@@ -200,6 +208,7 @@ def convert_checkin_json_to_csv(
         if chunk:
             writer.writerows(chunk)
             print(f"Processed a total of {count} checkin records.")
+        current_span().set_items(count)
 
 
 ##############################################
@@ -211,6 +220,7 @@ def clean_ratings(df):
     return df
 
 
+@traced("preprocess.ratings", items=len)
 def preprocess_ratings(input_csv=os.path.join(DATA_RAW_CSV, "ratings.csv"),
                        output_csv=os.path.join(DATA_PROCESSED, "ratings_processed.csv")):
     df = pd.read_csv(input_csv)
@@ -226,6 +236,7 @@ def clean_reviews(df):
     return df
 
 
+@traced("preprocess.reviews", items=len)
 def preprocess_reviews(input_csv=os.path.join(DATA_RAW_CSV, "reviews.csv"),
                        output_csv=os.path.join(DATA_PROCESSED, "reviews_processed.csv")):
     df = pd.read_csv(input_csv)
@@ -241,6 +252,7 @@ def clean_business(df):
     return df
 
 
+@traced("preprocess.business", items=len)
 def preprocess_business(input_csv=os.path.join(DATA_RAW_CSV, "business.csv"),
                         output_csv=os.path.join(DATA_PROCESSED, "business_processed.csv")):
     df = pd.read_csv(input_csv)
@@ -256,6 +268,7 @@ def clean_user(df):
     return df
 
 
+@traced("preprocess.user", items=len)
 def preprocess_user(input_csv=os.path.join(DATA_RAW_CSV, "user.csv"),
                     output_csv=os.path.join(DATA_PROCESSED, "user_processed.csv")):
     df = pd.read_csv(input_csv)
@@ -271,6 +284,7 @@ def clean_checkin(df):
     return df
 
 
+@traced("preprocess.checkin", items=len)
 def preprocess_checkin(input_csv=os.path.join(DATA_RAW_CSV, "checkin.csv"),
                        output_csv=os.path.join(DATA_PROCESSED, "checkin_processed.csv")):
     df = pd.read_csv(input_csv)
@@ -284,6 +298,7 @@ def preprocess_checkin(input_csv=os.path.join(DATA_RAW_CSV, "checkin.csv"),
 ##############################################
 # Subsampling Function for Testing
 ##############################################
+@traced("preprocess.subsample")
 def subsample_processed_data(percent=5):
     """
     Subsample processed data to only include a percentage of users.
@@ -351,74 +366,58 @@ def subsample_processed_data(percent=5):
     print(f" - Checkins: {checkin_sub_file}")
 
 
+##############################################
+# Stage Graph
+##############################################
+def preprocessing_stages(testing=False):
+    """
+    The JSON -> CSV conversions and the cleaning steps as runner stages (see `src.common.stage_runner`),
+    plus the 5% subsample for testing. Independent tables are converted and cleaned in parallel.
+    """
+    from src.common.stage_runner import Stage
+
+    def raw_json(table):
+        return os.path.join(DATA_RAW_JSON, f"yelp_academic_dataset_{table}.json")
+
+    def raw_csv(name):
+        return os.path.join(DATA_RAW_CSV, f"{name}.csv")
+
+    def processed(name, directory=DATA_PROCESSED):
+        return os.path.join(directory, f"{name}_processed.csv")
+
+    stages = [
+        Stage("convert_business", convert_business_json_to_csv, [raw_json("business")], [raw_csv("business")]),
+        Stage("convert_review", convert_review_json_to_csv, [raw_json("review")],
+              [raw_csv("reviews"), raw_csv("ratings")]),
+        Stage("convert_user", convert_user_json_to_csv, [raw_json("user")], [raw_csv("user")]),
+        Stage("convert_checkin", convert_checkin_json_to_csv, [raw_json("checkin")], [raw_csv("checkin")]),
+        Stage("preprocess_business", preprocess_business, [raw_csv("business")], [processed("business")]),
+        Stage("preprocess_reviews", preprocess_reviews, [raw_csv("reviews")], [processed("reviews")]),
+        Stage("preprocess_ratings", preprocess_ratings, [raw_csv("ratings")], [processed("ratings")]),
+        Stage("preprocess_user", preprocess_user, [raw_csv("user")], [processed("user")]),
+        Stage("preprocess_checkin", preprocess_checkin, [raw_csv("checkin")], [processed("checkin")]),
+    ]
+    if testing:
+        tables = ["ratings", "reviews", "business", "user", "checkin"]
+        stages.append(Stage("subsample", subsample_processed_data, [processed(table) for table in tables],
+                            [processed(table, TEST_DATA_PROCESSED) for table in tables], kwargs={"percent": 5}))
+    return stages
+
+
 ##############################################
 # Main Execution with Testing Flag
 ##############################################
 if __name__ == "__main__":
     import argparse
 
+    from src.common.stage_runner import run_stages
+
     parser = argparse.ArgumentParser(description="Data Preprocessing Pipeline")
     parser.add_argument('--testing', type=bool, default=False,
                         help="Set to True to create test (5% subsample) files in TEST_DATA_PROCESSED folder")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of stages to run in parallel (default is 1).")
     args = parser.parse_args()
 
-    # Check and convert JSON files to CSV in data/raw/csv if needed
-    if not os.path.exists(os.path.join(DATA_RAW_CSV, "business.csv")):
-        print("Converting business JSON to CSV...")
-        convert_business_json_to_csv()
-    else:
-        print("Business CSV already exists. Skipping conversion.")
-
-    if not (os.path.exists(os.path.join(DATA_RAW_CSV, "reviews.csv")) and os.path.exists(
-            os.path.join(DATA_RAW_CSV, "ratings.csv"))):
-        print("Converting review JSON to CSV...")
-        convert_review_json_to_csv()
-    else:
-        print("Review and Ratings CSV already exist. Skipping conversion.")
-
-    if not os.path.exists(os.path.join(DATA_RAW_CSV, "user.csv")):
-        print("Converting user JSON to CSV...")
-        convert_user_json_to_csv()
-    else:
-        print("User CSV already exists. Skipping conversion.")
-
-    if not os.path.exists(os.path.join(DATA_RAW_CSV, "checkin.csv")):
-        print("Converting checkin JSON to CSV...")
-        convert_checkin_json_to_csv()
-    else:
-        print("Checkin CSV already exists. Skipping conversion.")
-
-    # Check and clean/process CSV files into data/processed if needed
-    if not os.path.exists(os.path.join(DATA_PROCESSED, "business_processed.csv")):
-        print("Cleaning and processing business data...")
-        preprocess_business()
-    else:
-        print("Processed business data already exists. Skipping cleaning.")
-
-    if not os.path.exists(os.path.join(DATA_PROCESSED, "reviews_processed.csv")):
-        print("Cleaning and processing reviews data...")
-        preprocess_reviews()
-    else:
-        print("Processed reviews data already exists. Skipping cleaning.")
-
-    if not os.path.exists(os.path.join(DATA_PROCESSED, "ratings_processed.csv")):
-        print("Cleaning and processing ratings data...")
-        preprocess_ratings()
-    else:
-        print("Processed ratings data already exists. Skipping cleaning.")
-
-    if not os.path.exists(os.path.join(DATA_PROCESSED, "user_processed.csv")):
-        print("Cleaning and processing user data...")
-        preprocess_user()
-    else:
-        print("Processed user data already exists. Skipping cleaning.")
-
-    if not os.path.exists(os.path.join(DATA_PROCESSED, "checkin_processed.csv")):
-        print("Cleaning and processing checkin data...")
-        preprocess_checkin()
-    else:
-        print("Processed checkin data already exists. Skipping cleaning.")
-
-    if args.testing:
-        print("Subsampling processed data to 5% for testing...")
-        subsample_processed_data(percent=5)
+    # Converts and cleans only the tables whose outputs are missing or older than their inputs.
+    run_stages(preprocessing_stages(testing=args.testing), jobs=args.jobs)
@@ -1,5 +1,6 @@
 import math
 
+import numpy as np
 from sklearn.metrics import root_mean_squared_error
 
 
@@ -75,6 +76,26 @@ def ndcg_at_k(recommended, relevant, k):
     return dcg / idcg
 
 
+def split_holdout(sparse_matrix, holdout_fraction=0.1, min_ratings=3, seed=42):
+    """
+    Hide one rating of a `holdout_fraction` sample of the users with at least `min_ratings` ratings.
+
+    Returns:
+        tuple: (train matrix, holdout user indices, holdout business indices)
+    """
+    rng = np.random.default_rng(seed)
+    counts = np.diff(sparse_matrix.indptr)
+    eligible = np.flatnonzero(counts >= min_ratings)
+    users = rng.choice(eligible, size=max(1, int(len(eligible) * holdout_fraction)), replace=False)
+    positions = sparse_matrix.indptr[users] + rng.integers(0, counts[users])
+    items = sparse_matrix.indices[positions]
+
+    train = sparse_matrix.copy()
+    train.data[positions] = 0
+    train.eliminate_zeros()
+    return train, users, items
+
+
 if __name__ == "__main__":
     # Test evaluation functions with dummy data
     y_true = [3, 4, 5, 2]
@@ -0,0 +1,212 @@
+import contextvars
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from util.paths import PROFILE_DIR
+
+# Tracing is configured through environment variables (like TESTING) so worker processes inherit it.
+#   TRACE_FILE:   path of the trace file; tracing is off when unset.
+#   TRACE_FORMAT: "jsonl" (one span per line) or "chrome" (Chrome trace event array, open in chrome://tracing
+#                 or Perfetto). Defaults to "chrome" for *.json files and "jsonl" otherwise.
+#   PROFILE:      "True" to run `profiled` blocks under cProfile.
+_current_span = contextvars.ContextVar("current_span", default=None)
+_write_lock = threading.Lock()
+
+
+##############################################
+# Process Memory
+##############################################
+def current_rss_mb():
+    """Resident set size of this process in MB (Linux /proc, falls back to the peak RSS elsewhere)."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """High-water mark of the resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS.
+    return peak / 2 ** 20 if platform.system() == "Darwin" else peak / 2 ** 10
+
+
+##############################################
+# Trace Output
+##############################################
+def configure_tracing(trace_path, trace_format=None):
+    """
+    Enable tracing for this process and any process started from it.
+    Starts a fresh trace file; the format is inferred from the extension if not given.
+    """
+    trace_format = trace_format or ("chrome" if trace_path.endswith(".json") else "jsonl")
+    os.makedirs(os.path.dirname(os.path.abspath(trace_path)), exist_ok=True)
+    with open(trace_path, "w") as f:
+        if trace_format == "chrome":
+            # The closing bracket is optional in the Chrome trace event format, so events can be appended.
+            f.write("[\n")
+    os.environ["TRACE_FILE"] = trace_path
+    os.environ["TRACE_FORMAT"] = trace_format
+
+
+def tracing_enabled():
+    return bool(os.environ.get("TRACE_FILE"))
+
+
+def _write_event(record):
+    trace_path = os.environ["TRACE_FILE"]
+    if os.environ.get("TRACE_FORMAT", "jsonl") == "chrome":
+        event = {
+            "name": record["name"],
+            "cat": record["name"].split(".")[0],
+            "ph": "X",
+            "ts": round(record["start"] * 1e6, 1),
+            "dur": round(record["wall_s"] * 1e6, 1),
+            "pid": record["pid"],
+            "tid": record["tid"],
+            "args": {k: v for k, v in record.items() if k not in ("name", "start", "wall_s", "pid", "tid")},
+        }
+        line = json.dumps(event, default=str) + ",\n"
+    else:
+        line = json.dumps(record, default=str) + "\n"
+    with _write_lock, open(trace_path, "a") as f:
+        f.write(line)
+
+
+##############################################
+# Spans
+##############################################
+class Span:
+    """
+    One timed section of the pipeline. Code inside the span can report how many items it handled
+    (rows, ratings, queries, ...) with `set_items` and attach extra attributes with `set`.
+    """
+
+    def __init__(self, name, items=None, attrs=None):
+        self.name = name
+        self.items = items
+        self.attrs = dict(attrs or {})
+        self.parent = _current_span.get()
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def set_items(self, items):
+        self.items = items
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+@contextmanager
+def span(name, items=None, **attrs):
+    """
+    Time a block of code: wall time, CPU time and (when tracing) RSS delta and item count.
+
+    Usage:
+        with span("preprocess.ratings") as s:
+            ...
+            s.set_items(len(df))
+    """
+    current = Span(name, items, attrs)
+    token = _current_span.set(current)
+    enabled = tracing_enabled()
+    rss_before = current_rss_mb() if enabled else 0.0
+    start_wall = time.time()
+    tic = time.perf_counter()
+    cpu_tic = time.process_time()
+    try:
+        yield current
+    finally:
+        current.wall = time.perf_counter() - tic
+        current.cpu = time.process_time() - cpu_tic
+        _current_span.reset(token)
+        if enabled:
+            rss_after = current_rss_mb()
+            record = {
+                "name": name,
+                "start": start_wall,
+                "wall_s": round(current.wall, 6),
+                "cpu_s": round(current.cpu, 6),
+                "rss_mb": round(rss_after, 2),
+                "rss_delta_mb": round(rss_after - rss_before, 2),
+                "items": current.items,
+                "parent": current.parent.name if current.parent else None,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+            }
+            record.update(current.attrs)
+            _write_event(record)
+
+
+def current_span():
+    """The innermost active span, or None."""
+    return _current_span.get()
+
+
+def traced(name=None, items=None):
+    """
+    Decorator version of `span`. The span is named after the function unless `name` is given.
+    `items` may be a callable applied to the return value to get the item count (e.g. `len`).
+    """
+
+    def decorator(func):
+        span_name = name or f"{func.__module__.split('.')[-1]}.{func.__name__}"
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name) as s:
+                result = func(*args, **kwargs)
+                if items is not None and s.items is None:
+                    try:
+                        s.set_items(items(result))
+                    except TypeError:
+                        pass
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+##############################################
+# Profiling
+##############################################
+def profiling_enabled():
+    return os.environ.get("PROFILE", "False") == "True"
+
+
+@contextmanager
+def profiled(name, output_dir=PROFILE_DIR, top=20):
+    """
+    Run the block under cProfile when the environment variable PROFILE is "True".
+    The stats are dumped to `<output_dir>/<name>.prof` (readable with `python -m pstats` or snakeviz)
+    and the `top` entries by cumulative time are printed.
+    """
+    if not profiling_enabled():
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(output_dir, exist_ok=True)
+        stats_path = os.path.join(output_dir, f"{name}.prof")
+        profiler.dump_stats(stats_path)
+        buffer = io.StringIO()
+        pstats.Stats(profiler, stream=buffer).sort_stats("cumulative").print_stats(top)
+        print(buffer.getvalue())
+        print(f"Profile for {name} saved to {stats_path}")
@@ -0,0 +1,327 @@
+import asyncio
+import time
+
+import numpy as np
+import pandas as pd
+
+import src.level1_content_based as l1
+import src.level2_cf as l2
+import src.level3_matrix_factorization as l3
+from src.common.instrumentation import span
+
+
+class MicroBatcher:
+    """
+    Collects concurrent recommendation requests for a few milliseconds and answers them with one
+    batched call.
+
+    A batch is closed when it holds `max_batch_size` requests or `max_wait_ms` after its first request
+    arrived, whichever comes first. `batch_fn(ids, top_n)` must return one result list per id; it runs in
+    a worker thread so the event loop keeps collecting the next batch meanwhile. Requests with different
+    `top_n` share a batch: it is scored with the largest one and every result is cut to its own length.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=64, max_wait_ms=2.0, name="batch"):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+        self._queue = None
+        self._worker = None
+        self.batches = 0
+        self.requests = 0
+
+    async def submit(self, entity_id, top_n=5):
+        """Queue one request and wait for its result."""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((entity_id, top_n, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _score(self, batch):
+        with span(f"micro_batch.{self.name}", items=len(batch)):
+            return self.batch_fn([entity_id for entity_id, _, _ in batch], max(top_n for _, top_n, _ in batch))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            self.batches += 1
+            self.requests += len(batch)
+            try:
+                results = await loop.run_in_executor(None, self._score, batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            if len(results) != len(batch):
+                # Results can no longer be matched to requests; fail the whole batch instead of leaving
+                # the unmatched requests waiting forever.
+                error = RuntimeError(f"{self.name}: batch_fn returned {len(results)} results "
+                                     f"for {len(batch)} requests")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for (_, top_n, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result[:top_n])
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+        }
+
+
+class ReloadingScorer:
+    """
+    `batch_fn(ids, top_n)` that rebuilds its scorer when the model it was loaded from changes.
+
+    `version()` (e.g. `artifact_version` of the model files: a few stat calls) is rechecked at most every
+    `check_interval` seconds. The scorer is rebuilt with `load()` before the next batch after the version
+    changed, so a long-running process picks up retrained models without a restart. A failed reload (e.g.
+    while the artifacts are being rewritten) keeps the previous scorer and is retried on the next batch.
+    """
+
+    def __init__(self, load, version, check_interval=1.0):
+        self.load = load
+        self.version_fn = version
+        self.check_interval = check_interval
+        self.version = self.latest = version()
+        self.scorer = load()
+        self.reloads = 0
+        self._last_check = time.monotonic()
+
+    def current_version(self):
+        """The latest model version seen; the result cache keys on it."""
+        if time.monotonic() - self._last_check >= self.check_interval:
+            self._last_check = time.monotonic()
+            self.latest = self.version_fn()
+        return self.latest
+
+    def __call__(self, ids, top_n):
+        version = self.current_version()
+        if version != self.version:
+            try:
+                with span("micro_batch.reload", version=version):
+                    self.scorer = self.load()
+                self.version = version
+                self.reloads += 1
+                print(f"Reloaded the scorer for model version {version}")
+            except Exception as e:
+                print(f"Reloading the scorer for model version {version} failed, keeping the previous one: {e}")
+        return self.scorer(ids, top_n)
+
+
+##############################################
+# Batchers for the Level 1-3 Scorers
+##############################################
+def svd_batch_fn(matrix_components, svd_model_components, fallback=None, filter_rows=None):
+    """`batch_fn(ids, top_n)` over `batch_matrix_factorization_recommendations`."""
+    user_index = pd.Index(matrix_components[1])
+    return lambda ids, top_n: l3.batch_matrix_factorization_recommendations(
+        ids, matrix_components, svd_model_components, top_n=top_n, user_index=user_index, fallback=fallback,
+        filter_rows=filter_rows)
+
+
+def content_batch_fn(profile_components, filter_rows=None):
+    """`batch_fn(ids, top_n)` over `batch_recommend_similar_businesses`, for `build_profile_matrix` output."""
+    business_index = pd.Index(profile_components[0])
+    return lambda ids, top_n: l1.batch_recommend_similar_businesses(
+        ids, profile_components, top_n=top_n, business_index=business_index, filter_rows=filter_rows)
+
+
+def cf_batch_fn(matrix_components, num_similar=10, fallback=None, filter_rows=None):
+    """`batch_fn(ids, top_n)` over `batch_user_based_recommendations`, with the user norms computed once."""
+    sparse_matrix = matrix_components[0]
+    user_norms = np.sqrt(np.asarray(sparse_matrix.multiply(sparse_matrix).sum(axis=1)).ravel())
+    user_index = pd.Index(matrix_components[1])
+    return lambda ids, top_n: l2.batch_user_based_recommendations(
+        ids, matrix_components, top_n=top_n, num_similar=num_similar, user_norms=user_norms,
+        user_index=user_index, fallback=fallback, filter_rows=filter_rows)
+
+
+def online_cf_batch_fn(state, num_similar=10, fallback=None, filter_rows=None):
+    """
+    `batch_fn(ids, top_n)` over `OnlineCFState.recommend`: the neighbour lists are kept between batches
+    and updated in place by rating events, so the state is read under its lock.
+    """
+    def score(ids, top_n):
+        with state.lock:
+            return [state.recommend(entity_id, top_n=top_n, num_similar=num_similar, fallback=fallback,
+                                    filter_rows=filter_rows) for entity_id in ids]
+
+    return score
+
+
+def svd_batcher(matrix_components, svd_model_components, **kwargs):
+    """Micro-batcher in front of `matrix_factorization_recommendations`."""
+    return MicroBatcher(svd_batch_fn(matrix_components, svd_model_components), name="svd", **kwargs)
+
+
+def content_batcher(item_profiles, **kwargs):
+    """Micro-batcher in front of `recommend_similar_businesses`."""
+    return MicroBatcher(content_batch_fn(l1.build_profile_matrix(item_profiles)), name="content", **kwargs)
+
+
+def cf_batcher(matrix_components, num_similar=10, **kwargs):
+    """Micro-batcher in front of `user_based_recommendations`."""
+    return MicroBatcher(cf_batch_fn(matrix_components, num_similar=num_similar), name="cf", **kwargs)
+
+
+##############################################
+# Serving a Request Stream
+##############################################
+def parse_request(line, top_n=5):
+    """
+    One request line: "<id>" or "<id>,<top_n>".
+
+    Returns:
+        tuple: (id, top_n), or None for a blank line.
+    """
+    entity_id, _, n = line.strip().partition(",")
+    if not entity_id:
+        return None
+    return entity_id.strip(), int(n) if n.strip() else top_n
+
+
+async def serve_requests(batcher, lines, respond, top_n=5, max_in_flight=1024, cache=None, model_version=None):
+    """
+    Answer a stream of request lines (e.g. stdin of a long-running process) through the micro-batcher
+    until the stream ends.
+
+    Lines are read in a worker thread, so requests that arrive while a batch is being scored join the next
+    one. `respond(id, recommendations)` is called as soon as the batch of a request is done, so answers can
+    come back in a different order than the requests. At most `max_in_flight` requests wait at once.
+    A request that repeats one still in flight waits for that one instead of being scored again, and with a
+    `RecommendationCache` repeated requests are answered from it (keyed on the batcher name and
+    `model_version`, or on `model_version()` if it is callable, e.g. `ReloadingScorer.current_version`, so
+    entries of a replaced model are dropped) without joining a batch.
+
+    Returns:
+        dict: Number of requests and of requests that shared an in-flight result.
+    """
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(max_in_flight)
+    pending, in_flight = set(), {}
+    counts = {"requests": 0, "coalesced": 0}
+    lines = iter(lines)
+
+    async def lookup(entity_id, n):
+        version = model_version() if callable(model_version) else model_version
+        recommendations = cache.get(batcher.name, entity_id, n, version) if cache is not None else None
+        if recommendations is None:
+            recommendations = await batcher.submit(entity_id, n)
+            if cache is not None:
+                cache.put(batcher.name, entity_id, n, version, recommendations)
+        return recommendations
+
+    async def answer(entity_id, n):
+        key = (entity_id, n)
+        try:
+            if key in in_flight:
+                counts["coalesced"] += 1
+            else:
+                in_flight[key] = asyncio.ensure_future(lookup(entity_id, n))
+                in_flight[key].add_done_callback(lambda _: in_flight.pop(key, None))
+            respond(entity_id, await in_flight[key])
+        except Exception as e:
+            print(f"Request for {entity_id} failed: {e}")
+            respond(entity_id, [])
+        finally:
+            slots.release()
+
+    while (line := await loop.run_in_executor(None, next, lines, None)) is not None:
+        try:
+            request = parse_request(line, top_n)
+        except ValueError:
+            print(f"Skipping malformed request {line.strip()!r}")
+            continue
+        if request is None:
+            continue
+        counts["requests"] += 1
+        await slots.acquire()
+        task = asyncio.create_task(answer(*request))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.wait(pending)
+    return counts
+
+
+async def measure_throughput(batcher, ids, top_n=5, concurrency=256):
+    """
+    Fire `ids` at the batcher with at most `concurrency` requests in flight.
+
+    Returns:
+        dict: Requests per second, latency percentiles in ms and the batcher stats.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(entity_id):
+        async with semaphore:
+            tic = time.perf_counter()
+            await batcher.submit(entity_id, top_n)
+            latencies.append(time.perf_counter() - tic)
+
+    tic = time.perf_counter()
+    await asyncio.gather(*(one(entity_id) for entity_id in ids))
+    elapsed = time.perf_counter() - tic
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "requests_per_s": len(ids) / elapsed,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        **batcher.stats(),
+    }
+
+
+if __name__ == "__main__":
+    import os
+
+    from src.common.user_item_matrix_components import load_user_item_matrix_components
+    from util.paths import DATA_PROCESSED
+
+    matrix_components = load_user_item_matrix_components(os.path.join(DATA_PROCESSED, "ratings_processed.csv"))
+    svd_model_components = l3.train_svd(matrix_components[0], n_factors=20)
+    sample_ids = matrix_components[1][:2000]
+
+    tic = time.perf_counter()
+    for user_id in sample_ids:
+        l3.matrix_factorization_recommendations(user_id, matrix_components, svd_model_components)
+    print(f"Sequential SVD queries: {len(sample_ids) / (time.perf_counter() - tic):.1f} requests/s")
+
+    async def main():
+        batcher = svd_batcher(matrix_components, svd_model_components, max_batch_size=64, max_wait_ms=2.0)
+        print(f"Micro-batched SVD queries: {await measure_throughput(batcher, sample_ids)}")
+        await batcher.close()
+
+    asyncio.run(main())
@@ -0,0 +1,308 @@
+import json
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+from src.common.cache import get_cache_dir
+from src.common.instrumentation import span, traced
+from src.common.user_item_matrix_components import load_matrix_components, save_matrix_components
+
+CURRENT_FILENAME = "CURRENT"
+LEASES_DIRNAME = "leases"
+
+
+##############################################
+# Layout
+##############################################
+def model_store_dir(name="recommender"):
+    """
+    Root of one shared model in the cache directory:
+
+        shared_models/<name>/CURRENT       name of the version workers should use
+        shared_models/<name>/<version>/    matrix/, U.npy, Vt.npy, profile_*.npy, meta.json
+        shared_models/<name>/<version>/leases/<pid>.<token>   one file per attached handle
+    """
+    return os.path.join(get_cache_dir(), "shared_models", name)
+
+
+def current_pointer(name="recommender"):
+    """Path of the CURRENT file; it is rewritten on every publish, so stages can use it as an output."""
+    return os.path.join(model_store_dir(name), CURRENT_FILENAME)
+
+
+def current_version(name="recommender"):
+    """The published version workers should attach to, or None if nothing was published yet."""
+    try:
+        with open(current_pointer(name)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def live_leases(version_dir):
+    """Lease files of processes that are still running; leases of dead processes are removed."""
+    leases = []
+    lease_dir = os.path.join(version_dir, LEASES_DIRNAME)
+    for lease in os.listdir(lease_dir) if os.path.isdir(lease_dir) else []:
+        pid = int(lease.split(".", 1)[0])
+        if pid_alive(pid):
+            leases.append(lease)
+        else:
+            os.remove(os.path.join(lease_dir, lease))
+    return leases
+
+
+def collect_garbage(name="recommender"):
+    """
+    Delete every version that is not current and no live process holds a lease on.
+
+    Workers that still map a deleted version keep reading it: the kernel only frees the pages once the
+    last mapping is closed.
+
+    Returns:
+        list: Removed versions.
+    """
+    root = model_store_dir(name)
+    current = current_version(name)
+    removed = []
+    for version in os.listdir(root) if os.path.isdir(root) else []:
+        version_dir = os.path.join(root, version)
+        if version in (current, CURRENT_FILENAME) or version.startswith(".") or not os.path.isdir(version_dir):
+            continue
+        if not live_leases(version_dir):
+            shutil.rmtree(version_dir, ignore_errors=True)
+            removed.append(version)
+    if removed:
+        print(f"Removed unused model versions: {removed}")
+    return removed
+
+
+##############################################
+# Publishing
+##############################################
+@traced("model_store.publish")
+def publish_models(matrix_components=None, svd_model_components=None, item_profiles=None, name="recommender"):
+    """
+    Write a new model version as memory-mappable .npy files and make it current.
+
+    The version is written under a temporary name and renamed into place, then the CURRENT pointer is
+    replaced atomically, so a worker sees either the old or the new version, never a partial one.
+    Versions no longer in use are removed afterwards.
+
+    Args:
+        matrix_components (tuple): (sparse_matrix, user_ids list, business_ids list)
+        svd_model_components (tuple): (svd, U, Vt); only U and Vt are shared.
+        item_profiles (dict): Mapping from business_id to feature vector.
+
+    Returns:
+        str: The published version.
+    """
+    root = model_store_dir(name)
+    version = f"v{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    tmp_dir = os.path.join(root, f".tmp-{version}")
+    os.makedirs(os.path.join(tmp_dir, LEASES_DIRNAME))
+
+    meta = {"version": version, "created": time.time(), "parts": []}
+    if matrix_components is not None:
+        save_matrix_components(matrix_components, os.path.join(tmp_dir, "matrix"))
+        meta["parts"].append("matrix")
+    if svd_model_components is not None:
+        svd, U, Vt = svd_model_components
+        np.save(os.path.join(tmp_dir, "U.npy"), np.ascontiguousarray(U))
+        np.save(os.path.join(tmp_dir, "Vt.npy"), np.ascontiguousarray(Vt))
+        meta["parts"].append("svd")
+    if item_profiles is not None:
+        import src.level1_content_based as l1
+
+        business_ids, profile_matrix = l1.build_profile_matrix(item_profiles)
+        np.save(os.path.join(tmp_dir, "profile_ids.npy"), np.asarray(business_ids, dtype=str))
+        np.save(os.path.join(tmp_dir, "profile_matrix.npy"), profile_matrix)
+        meta["parts"].append("content")
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_dir, os.path.join(root, version))
+
+    pointer_tmp = os.path.join(root, f".{CURRENT_FILENAME}.tmp-{os.getpid()}")
+    with open(pointer_tmp, "w") as f:
+        f.write(version)
+    os.replace(pointer_tmp, current_pointer(name))
+    print(f"Published model version {version} to {root}")
+
+    collect_garbage(name)
+    return version
+
+
+def load_version(version_dir):
+    """
+    Memory-map every part of a published version (read-only).
+
+    Returns:
+        dict: version, matrix_components, svd_model_components ((None, U, Vt): the sklearn object is not
+        shared), profile_components ((business_ids, L2-normalized profile matrix)) and item_profiles
+        (business_id -> row view of the profile matrix); parts that were not published are None.
+    """
+    with open(os.path.join(version_dir, "meta.json")) as f:
+        meta = json.load(f)
+
+    def load(filename):
+        return np.load(os.path.join(version_dir, filename), mmap_mode="r")
+
+    model = {"version": meta["version"], "matrix_components": None, "svd_model_components": None,
+             "profile_components": None, "item_profiles": None}
+    if "matrix" in meta["parts"]:
+        model["matrix_components"], _ = load_matrix_components(os.path.join(version_dir, "matrix"))
+    if "svd" in meta["parts"]:
+        model["svd_model_components"] = (None, load("U.npy"), load("Vt.npy"))
+    if "content" in meta["parts"]:
+        business_ids, profile_matrix = load("profile_ids.npy").tolist(), load("profile_matrix.npy")
+        model["profile_components"] = (business_ids, profile_matrix)
+        model["item_profiles"] = dict(zip(business_ids, profile_matrix))
+    return model
+
+
+##############################################
+# Attaching from Workers
+##############################################
+class SharedModel:
+    """
+    A worker's read-only, zero-copy view of the current model version.
+
+    Every worker maps the same page-cache pages, so memory no longer grows with the number of workers.
+    The handle holds a lease on the version it maps; `refresh` (called between requests, or implicitly by
+    `get`) swaps to a newly published version without restarting the worker and releases the old lease.
+    Requests that still hold the previous `get()` result keep working on the old mapping.
+    """
+
+    def __init__(self, name="recommender", check_interval=1.0, retries=5):
+        self.name = name
+        self.check_interval = check_interval
+        self.retries = retries
+        self.token = f"{os.getpid()}.{uuid.uuid4().hex[:8]}"
+        self.model = None
+        self.lease_path = None
+        self._last_check = 0.0
+        self.refresh()
+
+    def _attach(self, version):
+        version_dir = os.path.join(model_store_dir(self.name), version)
+        lease_path = os.path.join(version_dir, LEASES_DIRNAME, self.token)
+        # The lease is taken before mapping, so a concurrent `collect_garbage` either sees it or has
+        # already removed the version, in which case loading fails and the caller retries.
+        with open(lease_path, "w") as f:
+            f.write(str(time.time()))
+        try:
+            with span("model_store.attach", version=version):
+                model = load_version(version_dir)
+        except FileNotFoundError:
+            if os.path.exists(lease_path):
+                os.remove(lease_path)
+            raise
+        return model, lease_path
+
+    def refresh(self):
+        """
+        Attach to the current version if it changed.
+
+        Returns:
+            bool: True if the handle switched to another version.
+        """
+        self._last_check = time.monotonic()
+        for _ in range(self.retries):
+            version = current_version(self.name)
+            if version is None and self.model is not None:
+                # The pointer is rewritten (e.g. its stage is rerunning); keep serving the attached version.
+                return False
+            if version is None:
+                raise FileNotFoundError(f"No model published under {model_store_dir(self.name)}")
+            if self.model is not None and self.model["version"] == version:
+                return False
+            try:
+                model, lease_path = self._attach(version)
+            except FileNotFoundError:
+                continue
+            previous_lease = self.lease_path
+            self.model, self.lease_path = model, lease_path
+            if previous_lease is not None:
+                self._release(previous_lease)
+                collect_garbage(self.name)
+            print(f"Process {os.getpid()} attached to model version {version}")
+            return True
+        raise RuntimeError(f"Could not attach to model {self.name} after {self.retries} attempts")
+
+    def get(self):
+        """The current model dict, checking for a newer version at most every `check_interval` seconds."""
+        if time.monotonic() - self._last_check >= self.check_interval:
+            self.refresh()
+        return self.model
+
+    @staticmethod
+    def _release(lease_path):
+        try:
+            os.remove(lease_path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        """Release the lease; the version is deleted by the next cleanup once it is unused and not current."""
+        if self.lease_path is not None:
+            self._release(self.lease_path)
+            self.lease_path = None
+        self.model = None
+
+
+##############################################
+# Demo Worker
+##############################################
+worker_model = None
+
+
+def init_worker(name="recommender"):
+    """Process pool initializer: attach once per worker process."""
+    global worker_model
+    worker_model = SharedModel(name, check_interval=0.0)
+
+
+def worker_queries(n_queries=200, top_n=5):
+    """Run SVD queries on the shared arrays and report the worker's model version and memory."""
+    import src.level3_matrix_factorization as l3
+    from src.common.instrumentation import current_rss_mb
+
+    model = worker_model.get()
+    matrix_components = model["matrix_components"]
+    user_ids = matrix_components[1][:n_queries]
+    l3.batch_matrix_factorization_recommendations(user_ids, matrix_components, model["svd_model_components"],
+                                                  top_n=top_n)
+    return {"pid": os.getpid(), "version": model["version"], "rss_mb": round(current_rss_mb(), 1)}
+
+
+if __name__ == "__main__":
+    from concurrent.futures import ProcessPoolExecutor
+
+    import src.level3_matrix_factorization as l3
+    from src.common.user_item_matrix_components import load_user_item_matrix_components
+    from util.paths import DATA_PROCESSED
+
+    matrix_components = load_user_item_matrix_components(os.path.join(DATA_PROCESSED, "ratings_processed.csv"))
+    svd_model_components = l3.train_svd(matrix_components[0], n_factors=20)
+    publish_models(matrix_components, svd_model_components)
+
+    with ProcessPoolExecutor(max_workers=4, initializer=init_worker) as pool:
+        for result in pool.map(worker_queries, [200] * 4):
+            print(result)
+        publish_models(matrix_components, svd_model_components)
+        for result in pool.map(worker_queries, [200] * 4):
+            print(result)
+    collect_garbage()
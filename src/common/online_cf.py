@@ -0,0 +1,421 @@
+import csv
+import queue
+import threading
+import time
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+import src.level2_cf as l2
+from src.common.checkin_popularity import pad_with_fallback
+from src.common.instrumentation import span, traced
+
+
+def lookup_sorted(keys, values, queries):
+    """values[keys == query] for each query (0 where absent), with `keys` sorted ascending."""
+    if len(keys) == 0:
+        return np.zeros(len(queries), dtype=np.float32)
+    positions = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+    return np.where(keys[positions] == queries, values[positions], 0.0).astype(np.float32)
+
+
+##############################################
+# Incremental Neighbourhood State
+##############################################
+class OnlineCFState:
+    """
+    User-based CF state that is kept between requests and updated from a stream of rating events.
+
+    Per user it keeps the squared row norm (float64) and a fixed-size list of `capacity` candidate
+    neighbours (int32 user positions) with their dot products (float32). Sims are dot / (norm_u * norm_v)
+    and are recomputed from the stored dots at read time, so a norm change never has to touch the lists.
+    Lists are filled lazily (on the first read of a user) with one sparse product against the matrix.
+
+    New ratings go into overlay dicts on top of the (possibly memory-mapped) base CSR/CSC matrices; a
+    batch of events recomputes the exact lists of the users who rated, and offers the new dot products to
+    the lists of the users who rated the same businesses. Lists that can no longer be trusted (a stored
+    dot went down) are marked stale and refilled on their next read. `compact` folds the overlay back
+    into the base matrices.
+
+    Lists are approximate for users outside a batch: an existing neighbour whose norm grew loses some
+    similarity without the list being rescanned. `capacity` larger than the `num_similar` used for reads
+    leaves room for those reorderings.
+
+    Threads sharing a state (e.g. an event consumer next to a request handler) hold `lock` around their calls.
+    """
+
+    def __init__(self, matrix_components, item_matrix=None, capacity=20, compact_threshold=1_000_000):
+        sparse_matrix, user_ids, business_ids = matrix_components
+        self.base = sparse_matrix.tocsr()
+        self.base_csc = item_matrix if item_matrix is not None else self.base.tocsc()
+        self.user_ids = list(user_ids)
+        self.business_ids = list(business_ids)
+        self.user_index = {user_id: i for i, user_id in enumerate(self.user_ids)}
+        self.business_index = {business_id: j for j, business_id in enumerate(self.business_ids)}
+        self.capacity = capacity
+        self.compact_threshold = compact_threshold
+
+        self.user_overlay = {}  # user position -> {business position: rating}
+        self.item_overlay = {}  # business position -> {user position: rating}
+        self.overlay_size = 0
+        self.norms_sq = np.asarray(self.base.multiply(self.base).sum(axis=1), dtype=np.float64).ravel()
+        self.neighbours = np.full((len(self.user_ids), capacity), -1, dtype=np.int32)
+        self.dots = np.zeros((len(self.user_ids), capacity), dtype=np.float32)
+        self.valid = np.zeros(len(self.user_ids), dtype=bool)
+        self._base_view = None
+        self._delta = None
+        self.lock = threading.RLock()
+
+    @property
+    def shape(self):
+        return len(self.user_ids), len(self.business_ids)
+
+    ##############################################
+    # Effective Ratings (Base + Overlay)
+    ##############################################
+    def base_rating(self, u, b):
+        if u >= self.base.shape[0] or b >= self.base.shape[1]:
+            return 0.0
+        start, stop = self.base.indptr[u], self.base.indptr[u + 1]
+        hits = np.flatnonzero(self.base.indices[start:stop] == b)
+        return float(self.base.data[start + hits[0]]) if len(hits) else 0.0
+
+    def rating(self, u, b):
+        overlay = self.user_overlay.get(u)
+        if overlay is not None and b in overlay:
+            return overlay[b]
+        return self.base_rating(u, b)
+
+    def base_view(self):
+        """The base CSR padded with empty rows/columns for users and businesses added since."""
+        if self._base_view is None or self._base_view.shape != self.shape:
+            n_users, n_items = self.shape
+            indptr = self.base.indptr
+            if n_users > self.base.shape[0]:
+                indptr = np.concatenate([indptr, np.full(n_users - self.base.shape[0], indptr[-1], indptr.dtype)])
+            self._base_view = csr_matrix((self.base.data, self.base.indices, indptr), shape=(n_users, n_items),
+                                         copy=False)
+        return self._base_view
+
+    def delta_matrix(self):
+        """Overlay minus base as a sparse matrix, rebuilt after every batch of events."""
+        if self._delta is None:
+            rows, cols, values = [], [], []
+            for u, overlay in self.user_overlay.items():
+                for b, rating in overlay.items():
+                    rows.append(u)
+                    cols.append(b)
+                    values.append(rating - self.base_rating(u, b))
+            self._delta = csr_matrix((np.asarray(values, dtype=np.float32), (rows, cols)), shape=self.shape)
+        return self._delta
+
+    def effective_rows(self, users):
+        rows = self.base_view()[users] + self.delta_matrix()[users]
+        rows.eliminate_zeros()
+        return rows
+
+    def co_raters(self, businesses):
+        """Users with a rating on any of `businesses`."""
+        parts = []
+        for b in businesses:
+            if b < self.base_csc.shape[1]:
+                parts.append(self.base_csc.indices[self.base_csc.indptr[b]:self.base_csc.indptr[b + 1]])
+            parts.append(np.fromiter(self.item_overlay.get(b, {}), dtype=np.int64))
+        return np.unique(np.concatenate(parts)).astype(np.int64) if parts else np.empty(0, dtype=np.int64)
+
+    ##############################################
+    # Neighbour Lists
+    ##############################################
+    def norms(self, users):
+        return np.sqrt(np.maximum(self.norms_sq[users], 0.0))
+
+    def dot_products(self, users):
+        """(n_users, len(users)) CSC block of exact dot products of `users` with every user."""
+        targets = self.effective_rows(users).T.tocsr()
+        dots = (self.base_view() @ targets + self.delta_matrix() @ targets).tocsc()
+        dots.sort_indices()
+        return dots
+
+    def refresh(self, users):
+        """Recompute the exact candidate lists of `users`."""
+        users = np.asarray(users, dtype=np.int64)
+        dots = self.dot_products(users)
+        for column, u in enumerate(users):
+            start, stop = dots.indptr[column], dots.indptr[column + 1]
+            others, other_dots = dots.indices[start:stop], dots.data[start:stop]
+            keep = (others != u) & (other_dots > 0)
+            others, other_dots = others[keep], other_dots[keep]
+            sims = other_dots / np.maximum(self.norms(others) * self.norms(u), 1e-12)
+            top = np.argsort(-sims, kind="stable")[:self.capacity]
+            self.neighbours[u] = -1
+            self.dots[u] = 0.0
+            self.neighbours[u, :len(top)] = others[top]
+            self.dots[u, :len(top)] = other_dots[top]
+            self.valid[u] = True
+        return dots
+
+    def offer(self, users, u, new_dots):
+        """
+        Update the lists of `users` for their new dot products with user `u`: refresh u's entry if present,
+        otherwise let u replace the weakest entry if it is now more similar.
+
+        Returns:
+            numpy.ndarray: The users whose lists changed.
+        """
+        lists, list_dots = self.neighbours[users], self.dots[users]
+        present = lists == u
+        has_u = present.any(axis=1)
+
+        # A stored dot that went down means a user outside the list may now rank higher: refill later.
+        decreased = (present & (new_dots[:, None] < list_dots)).any(axis=1)
+        self.valid[users[decreased]] = False
+        rows, slots = np.nonzero(present)
+        self.dots[users[rows], slots] = new_dots[rows]
+
+        list_norms = np.where(lists >= 0, self.norms(np.maximum(lists, 0)), 1.0)
+        list_sims = np.where(lists >= 0, list_dots / np.maximum(list_norms * self.norms(users)[:, None], 1e-12),
+                             -np.inf)
+        weakest = np.argmin(list_sims, axis=1)
+        new_sims = new_dots / np.maximum(self.norms(u) * self.norms(users), 1e-12)
+        insert = ~has_u & (new_dots > 0) & (new_sims > list_sims[np.arange(len(users)), weakest])
+        self.neighbours[users[insert], weakest[insert]] = u
+        self.dots[users[insert], weakest[insert]] = new_dots[insert]
+        return users[has_u | insert]
+
+    def _reserve(self, u):
+        """Make room for user position `u` in the per-user arrays, growing them geometrically."""
+        if u < len(self.norms_sq):
+            return
+        extra = max(u + 1 - len(self.norms_sq), len(self.norms_sq) // 4, 1024)
+        self.norms_sq = np.concatenate([self.norms_sq, np.zeros(extra)])
+        self.neighbours = np.vstack([self.neighbours, np.full((extra, self.capacity), -1, dtype=np.int32)])
+        self.dots = np.vstack([self.dots, np.zeros((extra, self.capacity), dtype=np.float32)])
+        self.valid = np.concatenate([self.valid, np.zeros(extra, dtype=bool)])
+
+    ##############################################
+    # Writes
+    ##############################################
+    @traced("online_cf.apply_events", items=len)
+    def apply_events(self, events):
+        """
+        Apply a batch of (user_id, business_id, rating) events; a rating of 0 deletes the rating.
+        Unknown users and businesses are appended.
+
+        Returns:
+            list: IDs of the users whose recommendations may have changed.
+        """
+        changed_users, changed_items = set(), set()
+        for user_id, business_id, rating in events:
+            u = self.user_index.setdefault(user_id, len(self.user_ids))
+            if u == len(self.user_ids):
+                self.user_ids.append(user_id)
+                self._reserve(u)
+            b = self.business_index.setdefault(business_id, len(self.business_ids))
+            if b == len(self.business_ids):
+                self.business_ids.append(business_id)
+            rating = float(rating)
+            old = self.rating(u, b)
+            if b not in self.user_overlay.setdefault(u, {}):
+                self.overlay_size += 1
+            self.user_overlay[u][b] = rating
+            self.item_overlay.setdefault(b, {})[u] = rating
+            self.norms_sq[u] += rating * rating - old * old
+            changed_users.add(u)
+            changed_items.add(b)
+        if not changed_users:
+            return []
+        self._delta = None
+
+        users = np.array(sorted(changed_users), dtype=np.int64)
+        affected = set(users.tolist())
+        with span("online_cf.update_neighbours", items=len(users)):
+            dots = self.refresh(users)
+            co_raters = self.co_raters(changed_items)
+            for column, u in enumerate(users):
+                others = co_raters[(co_raters != u) & self.valid[co_raters]]
+                if len(others) == 0:
+                    continue
+                start, stop = dots.indptr[column], dots.indptr[column + 1]
+                new_dots = lookup_sorted(dots.indices[start:stop], dots.data[start:stop], others)
+                affected.update(self.offer(others, u, new_dots).tolist())
+
+        if self.overlay_size > self.compact_threshold:
+            self.compact()
+        return [self.user_ids[u] for u in affected]
+
+    @traced("online_cf.compact")
+    def compact(self, directory=None):
+        """
+        Fold the overlay into new base CSR/CSC matrices (optionally saved with `save_matrix_components`).
+        Neighbour lists and norms already reflect the overlay and are kept.
+        """
+        matrix = (self.base_view() + self.delta_matrix()).tocsr()
+        matrix.eliminate_zeros()
+        self.base = csr_matrix(matrix, dtype=np.float32)
+        self.base_csc = self.base.tocsc()
+        self.user_overlay, self.item_overlay, self.overlay_size = {}, {}, 0
+        self._base_view = self._delta = None
+        if directory is not None:
+            from src.common.user_item_matrix_components import save_matrix_components
+
+            save_matrix_components((self.base, self.user_ids, self.business_ids), directory, with_csc=True)
+
+    ##############################################
+    # Reads
+    ##############################################
+    @traced("online_cf.query", items=len)
+    def recommend(self, user_id, top_n=5, num_similar=10, fallback=None, filter_rows=None):
+        """
+        User-based CF from the cached neighbour list (filled on first use), scored like level2.
+
+        Args:
+            filter_rows (numpy.ndarray): Optional sorted business positions that may be recommended.
+        """
+        u = self.user_index.get(user_id)
+        if u is None:
+            print("User ID not found in the matrix.")
+            return pad_with_fallback([], fallback, top_n)
+        if not self.valid[u]:
+            self.refresh([u])
+
+        filled = self.neighbours[u] >= 0
+        candidates, candidate_dots = self.neighbours[u][filled], self.dots[u][filled]
+        sims = candidate_dots / np.maximum(self.norms(candidates) * self.norms(u), 1e-12)
+        top = np.argsort(-sims, kind="stable")[:num_similar]
+
+        rows = self.effective_rows(np.concatenate([[u], candidates[top]]))
+        item_indices, predictions = l2.predict_from_neighbours(rows, rows[0], np.arange(1, len(top) + 1), sims[top],
+                                                               filter_rows=filter_rows)
+        recommendations = l2.top_predicted_items(item_indices, predictions, self.business_ids, top_n=top_n)
+        return pad_with_fallback(recommendations, fallback, top_n,
+                                 exclude=[self.business_ids[j] for j in rows[0].indices])
+
+
+##############################################
+# Rating Event Streams
+##############################################
+def read_rating_events(path, follow=False, poll_interval=1.0):
+    """
+    Yield (user_id, business_id, rating) events from a CSV file with the ratings_processed.csv columns.
+
+    With `follow`, keep polling for appended lines like `tail -f` and yield None whenever the reader has
+    caught up, so the consumer can flush a partial batch.
+    """
+    with open(path, newline="", encoding="utf8") as f:
+        header = next(csv.reader([f.readline()]))
+        columns = [header.index(name) for name in ("user_id", "business_id", "rating")]
+        while True:
+            line = f.readline()
+            if not line:
+                if not follow:
+                    return
+                yield None
+                time.sleep(poll_interval)
+                continue
+            if not line.endswith("\n"):
+                # Partially written line: rewind and wait for the rest.
+                f.seek(f.tell() - len(line.encode("utf8")))
+                time.sleep(poll_interval)
+                continue
+            fields = next(csv.reader([line]))
+            yield fields[columns[0]], fields[columns[1]], float(fields[columns[2]])
+
+
+def queue_events(event_queue, idle_timeout=0.1):
+    """
+    Yield events from a `queue.Queue` (a stand-in for a message broker) until a None item arrives;
+    yields None after `idle_timeout` seconds without events.
+    """
+    while True:
+        try:
+            event = event_queue.get(timeout=idle_timeout)
+        except queue.Empty:
+            yield None
+            continue
+        if event is None:
+            return
+        yield event
+
+
+def invalidate_rated(events, cache):
+    """
+    Drop the cached recommendations of the user of every event, for models that are not updated in place
+    (the user's next request is scored again, e.g. by a scorer reloaded after the model was rebuilt).
+
+    Returns:
+        int: Number of events.
+    """
+    count = 0
+    for event in events:
+        if event is not None:
+            cache.invalidate_id(event[0])
+            count += 1
+    return count
+
+
+def consume_events(state, events, batch_size=1000, cache=None):
+    """
+    Apply a stream of events to `state` in batches of up to `batch_size` (a None from the stream flushes
+    the current batch) and drop the cached recommendations of every affected user from `cache`. Each batch
+    is applied under `state.lock`, so the state can answer requests from another thread meanwhile.
+
+    Returns:
+        dict: Number of events, batches and affected users, and seconds spent applying them.
+    """
+    stats = {"events": 0, "batches": 0, "affected_users": 0, "seconds": 0.0}
+    batch = []
+
+    def flush():
+        tic = time.perf_counter()
+        with state.lock:
+            affected = state.apply_events(batch)
+        stats["seconds"] += time.perf_counter() - tic
+        stats["events"] += len(batch)
+        stats["batches"] += 1
+        stats["affected_users"] += len(affected)
+        if cache is not None:
+            for user_id in affected:
+                cache.invalidate_id(user_id)
+        batch.clear()
+
+    for event in events:
+        if event is not None:
+            batch.append(event)
+        if batch and (event is None or len(batch) >= batch_size):
+            flush()
+    if batch:
+        flush()
+    return stats
+
+
+if __name__ == "__main__":
+    import os
+
+    from src.common.result_cache import recommendation_cache
+    from src.common.user_item_matrix_components import load_user_item_matrix_components
+    from util.paths import DATA_PROCESSED
+
+    matrix_components, item_matrix = load_user_item_matrix_components(
+        os.path.join(DATA_PROCESSED, "ratings_processed.csv"), with_csc=True)
+    state = OnlineCFState(matrix_components, item_matrix)
+    user_ids, business_ids = matrix_components[1], matrix_components[2]
+    sample = user_ids[:200]
+
+    tic = time.perf_counter()
+    for user_id in sample:
+        l2.user_based_recommendations(user_id, matrix_components)
+    print(f"Level2 query (full scan): {(time.perf_counter() - tic) / len(sample) * 1000:.2f} ms")
+    for user_id in sample:
+        state.recommend(user_id)
+    tic = time.perf_counter()
+    for user_id in sample:
+        state.recommend(user_id)
+    print(f"Online CF query (cached neighbours): {(time.perf_counter() - tic) / len(sample) * 1000:.2f} ms")
+
+    rng = np.random.default_rng(0)
+    events = [(user_ids[i], business_ids[j], float(r)) for i, j, r in
+              zip(rng.integers(0, len(user_ids), 5000), rng.integers(0, len(business_ids), 5000),
+                  rng.integers(1, 6, 5000))]
+    stats = consume_events(state, iter(events), batch_size=500, cache=recommendation_cache)
+    print(f"Applied {stats['events']} events in {stats['batches']} batches: "
+          f"{stats['seconds'] / stats['events'] * 1000:.3f} ms per event, {stats['affected_users']} lists touched")
@@ -0,0 +1,307 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from src.common.cache import get_cache_dir
+from src.common.checkin_popularity import pad_with_fallback
+from src.common.instrumentation import span, traced
+from src.common.user_item_matrix_components import (load_matrix_components, load_user_item_matrix_components,
+                                                    replace_directory, save_matrix_components, source_signature)
+
+OTHER = "other"
+UNKNOWN = "unknown"
+
+
+##############################################
+# Partitioning
+##############################################
+def partition_root(level="state"):
+    """Cache directory of the per-region models split by `level` ("state" or "city")."""
+    return os.path.join(get_cache_dir(), "partitions", level)
+
+
+def business_regions(business_ids, business_df, level="state"):
+    """Region label per business: its state, or "City, ST" for level="city"; UNKNOWN without metadata."""
+    if level not in ("state", "city"):
+        raise ValueError(f"Unknown partition level '{level}'; expected 'state' or 'city'")
+    business_df = business_df.drop_duplicates("business_id").set_index("business_id").reindex(business_ids)
+    labels = business_df["state"].astype("string")
+    if level == "city":
+        labels = business_df["city"].astype("string") + ", " + labels
+    return labels.fillna(UNKNOWN).to_numpy(dtype=object)
+
+
+def assign_partitions(sparse_matrix, regions, min_ratings=1000):
+    """
+    Group the business columns into partitions: one per region, except that regions with fewer than
+    `min_ratings` ratings share the OTHER partition.
+
+    Returns:
+        tuple: (dict partition name -> sorted int32 columns, dict region -> partition name)
+    """
+    codes, labels = pd.factorize(regions)
+    ratings_per_column = np.bincount(sparse_matrix.indices, minlength=sparse_matrix.shape[1])
+    ratings_per_region = np.bincount(codes, weights=ratings_per_column, minlength=len(labels))
+    names = np.where(ratings_per_region >= min_ratings, np.asarray(labels, dtype=object), OTHER)
+
+    partition_codes, partition_names = pd.factorize(names[codes])
+    order = np.argsort(partition_codes, kind="stable").astype(np.int32)
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(partition_codes, minlength=len(partition_names)))])
+    columns = {name: order[bounds[i]:bounds[i + 1]] for i, name in enumerate(partition_names)}
+    return columns, dict(zip(labels, names))
+
+
+def build_routing(sparse_matrix, column_partition):
+    """
+    Partitions each user rated in, most ratings first, as CSR arrays over the rows of the global matrix:
+    the partitions of user u are `partitions[indptr[u]:indptr[u + 1]]` and the first one is their home.
+    """
+    rows = np.repeat(np.arange(sparse_matrix.shape[0]), np.diff(sparse_matrix.indptr))
+    counts = csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, column_partition[sparse_matrix.indices])),
+                        shape=(sparse_matrix.shape[0], column_partition.max() + 1))
+    counts.sum_duplicates()
+    user_rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    order = np.lexsort((-counts.data, user_rows))
+    return counts.indptr.astype(np.int64), counts.indices[order].astype(np.int16)
+
+
+def train_partition(matrix_dir, columns, directory, n_factors=20):
+    """
+    Build and train one partition (run in a worker process): the ratings of its businesses and the users who
+    rated them are sliced out of the memory-mapped global matrix and saved, then the SVD factors and the user
+    norms the CF path needs are computed on that submatrix only.
+
+    Returns:
+        dict: Size of the partition and training seconds.
+    """
+    import src.level3_matrix_factorization as l3
+
+    tic = time.perf_counter()
+    (sparse_matrix, user_ids, business_ids), _ = load_matrix_components(matrix_dir)
+    submatrix = sparse_matrix[:, columns].tocsr()
+    rows = np.flatnonzero(np.diff(submatrix.indptr))
+    submatrix = submatrix[rows]
+    save_matrix_components((submatrix, [user_ids[i] for i in rows], [business_ids[i] for i in columns]),
+                           os.path.join(directory, "matrix"))
+    user_norms = np.sqrt(np.asarray(submatrix.multiply(submatrix).sum(axis=1)).ravel()).astype(np.float32)
+    np.save(os.path.join(directory, "user_norms.npy"), user_norms)
+
+    n_factors = min(n_factors, min(submatrix.shape) - 1)
+    if n_factors >= 1:
+        _, U, Vt = l3.train_svd.__wrapped__(submatrix, n_factors=n_factors)
+        np.save(os.path.join(directory, "U.npy"), U.astype(np.float32))
+        np.save(os.path.join(directory, "Vt.npy"), Vt.astype(np.float32))
+    return {"users": len(rows), "items": len(columns), "nnz": int(submatrix.nnz), "n_factors": max(n_factors, 0),
+            "seconds": round(time.perf_counter() - tic, 3)}
+
+
+@traced("partitions.train")
+def train_partitions(ratings_csv, business_csv, level="state", n_factors=20, min_ratings=1000, jobs=4):
+    """
+    Split the ratings by the region of the rated business and train the level2/level3 components of every
+    partition in a process pool (largest partitions first). Nothing is retrained while the ratings, the
+    business table and the settings are unchanged.
+
+    Layout under `partition_root(level)`: manifest.json, routing arrays (user_ids, route_indptr,
+    route_partitions) and one directory per partition with matrix/, user_norms.npy, U.npy and Vt.npy.
+
+    Returns:
+        dict: The manifest (partition directories, region -> partition and per-partition statistics).
+    """
+    root = partition_root(level)
+    matrix_components = load_user_item_matrix_components(ratings_csv)
+    matrix_dir = os.path.join(get_cache_dir(), "user_item_matrix")
+    settings = {"ratings": source_signature(os.path.join(matrix_dir, "meta.json")),
+                "business": source_signature(business_csv), "level": level, "n_factors": n_factors,
+                "min_ratings": min_ratings}
+    manifest_path = os.path.join(root, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["settings"] == settings:
+            print(f"Partitioned models in {root} are up to date")
+            return manifest
+
+    sparse_matrix, user_ids, business_ids = matrix_components
+    business_df = pd.read_csv(business_csv, usecols=["business_id", "city", "state"], dtype={"business_id": str})
+    regions = business_regions(business_ids, business_df, level=level)
+    columns, region_partitions = assign_partitions(sparse_matrix, regions, min_ratings=min_ratings)
+    names = sorted(columns, key=lambda name: -len(columns[name]))
+    directories = {name: f"p{i:04d}" for i, name in enumerate(names)}
+
+    tmp_root = f"{root}.tmp-{os.getpid()}"
+    os.makedirs(tmp_root, exist_ok=True)
+    column_partition = np.empty(sparse_matrix.shape[1], dtype=np.int16)
+    for i, name in enumerate(names):
+        column_partition[columns[name]] = i
+    route_indptr, route_partitions = build_routing(sparse_matrix, column_partition)
+    np.save(os.path.join(tmp_root, "user_ids.npy"), np.asarray(user_ids, dtype=str))
+    np.save(os.path.join(tmp_root, "route_indptr.npy"), route_indptr)
+    np.save(os.path.join(tmp_root, "route_partitions.npy"), route_partitions)
+
+    stats = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {name: pool.submit(train_partition, matrix_dir, columns[name],
+                                     os.path.join(tmp_root, directories[name]), n_factors)
+                   for name in names}
+        for name, future in futures.items():
+            stats[name] = future.result()
+            print(f"Trained partition {name}: {stats[name]}")
+
+    manifest = {"settings": settings, "partitions": names, "directories": directories,
+                "regions": region_partitions, "stats": stats}
+    with open(os.path.join(tmp_root, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    replace_directory(tmp_root, root)
+    print(f"{len(names)} partitioned models saved to {root}")
+    return manifest
+
+
+##############################################
+# Routing and Serving
+##############################################
+class PartitionedModels:
+    """
+    Routes requests to per-region models trained by `train_partitions`, loading (memory-mapping) each
+    partition the first time a request needs it.
+
+    A request is served from the requested region's partition if one is given, otherwise from the user's
+    home partition (where they rated most). If that gives fewer than `top_n` recommendations, the
+    cross-region fallback decides where to look next:
+
+        "user"  the other partitions the user rated in, most ratings first
+        a name  that one partition, e.g. OTHER or a large neighbouring state
+        None    no other partition
+
+    and whatever is still missing comes from the `fallback(n, exclude=...)` of the request.
+    """
+
+    def __init__(self, level="state", cross_region="user"):
+        self.root = partition_root(level)
+        with open(os.path.join(self.root, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.cross_region = cross_region
+        load = lambda name: np.load(os.path.join(self.root, f"{name}.npy"), mmap_mode="r")
+        self.user_index = pd.Index(load("user_ids"))
+        self.route_indptr = load("route_indptr")
+        self.route_partitions = load("route_partitions")
+        self.loaded = {}
+
+    def partition(self, name):
+        """Components of one partition, loaded on first use."""
+        if name not in self.loaded:
+            directory = os.path.join(self.root, self.manifest["directories"][name])
+            with span("partitions.load", partition=name):
+                matrix_components, _ = load_matrix_components(os.path.join(directory, "matrix"))
+                svd_model_components = None
+                if os.path.exists(os.path.join(directory, "U.npy")):
+                    svd_model_components = (None, np.load(os.path.join(directory, "U.npy"), mmap_mode="r"),
+                                            np.load(os.path.join(directory, "Vt.npy"), mmap_mode="r"))
+                self.loaded[name] = {
+                    "matrix_components": matrix_components,
+                    "svd_model_components": svd_model_components,
+                    "user_norms": np.load(os.path.join(directory, "user_norms.npy"), mmap_mode="r"),
+                    "user_index": pd.Index(matrix_components[1]),
+                }
+            print(f"Loaded partition {name} ({self.manifest['stats'][name]})")
+        return self.loaded[name]
+
+    def user_partitions(self, user_id):
+        """Partitions the user rated in, home first; empty for unknown users."""
+        position = self.user_index.get_indexer([user_id])[0]
+        if position < 0:
+            return []
+        codes = self.route_partitions[self.route_indptr[position]:self.route_indptr[position + 1]]
+        return [self.manifest["partitions"][code] for code in codes]
+
+    def route(self, user_id, region=None):
+        """Partitions to query for a request, in order."""
+        rated = self.user_partitions(user_id)
+        if region is not None:
+            first = [self.manifest["regions"].get(region, OTHER)]
+        else:
+            first = rated[:1]
+        if self.cross_region == "user":
+            rest = rated
+        elif self.cross_region is not None:
+            rest = [self.cross_region]
+        else:
+            rest = []
+        route = []
+        for name in first + rest:
+            if name in self.manifest["directories"] and name not in route:
+                route.append(name)
+        return route
+
+    def rated_businesses(self, user_id):
+        """Businesses the user rated, from the rows of every partition they rated in (loading them if needed)."""
+        rated = []
+        for name in self.user_partitions(user_id):
+            if name not in self.manifest["directories"]:
+                continue
+            model = self.partition(name)
+            sparse_matrix, _, business_ids = model["matrix_components"]
+            row = model["user_index"].get_loc(user_id)
+            columns = sparse_matrix.indices[sparse_matrix.indptr[row]:sparse_matrix.indptr[row + 1]]
+            rated += [business_ids[j] for j in columns]
+        return rated
+
+    def recommend(self, user_id, method="svd", top_n=5, region=None, num_similar=10, fallback=None):
+        """
+        Recommendations for one user from the routed partition models ("svd" or "cf").
+
+        Returns:
+            list: Recommended business IDs.
+        """
+        import src.level2_cf as l2
+        import src.level3_matrix_factorization as l3
+
+        recommendations = []
+        for name in self.route(user_id, region):
+            if len(recommendations) >= top_n:
+                break
+            model = self.partition(name)
+            if user_id not in model["user_index"]:
+                continue
+            n = top_n - len(recommendations)
+            if method == "svd" and model["svd_model_components"] is not None:
+                recommendations += l3.batch_matrix_factorization_recommendations(
+                    [user_id], model["matrix_components"], model["svd_model_components"], top_n=n,
+                    user_index=model["user_index"])[0]
+            elif method == "cf":
+                recommendations += l2.batch_user_based_recommendations(
+                    [user_id], model["matrix_components"], top_n=n, num_similar=num_similar,
+                    user_norms=model["user_norms"], user_index=model["user_index"])[0]
+        exclude = None
+        if fallback is not None and len(recommendations) < top_n:
+            exclude = self.rated_businesses(user_id)
+        return pad_with_fallback(recommendations, fallback, top_n, exclude=exclude)
+
+
+if __name__ == "__main__":
+    import src.level3_matrix_factorization as l3
+    from util.paths import DATA_PROCESSED
+
+    ratings_csv = os.path.join(DATA_PROCESSED, "ratings_processed.csv")
+    business_csv = os.path.join(DATA_PROCESSED, "business_processed.csv")
+    manifest = train_partitions(ratings_csv, business_csv, level="state", n_factors=20, jobs=4)
+    models = PartitionedModels(level="state")
+
+    matrix_components = load_user_item_matrix_components(ratings_csv)
+    svd_model_components = l3.train_svd(matrix_components[0], n_factors=20)
+    sample_users = matrix_components[1][:200]
+    for name, recommend in (
+            ("global", lambda user_id: l3.matrix_factorization_recommendations(
+                user_id, matrix_components, svd_model_components, top_n=5)),
+            ("partitioned", lambda user_id: models.recommend(user_id, "svd", top_n=5))):
+        recommend(sample_users[0])
+        tic = time.perf_counter()
+        for user_id in sample_users:
+            recommend(user_id)
+        print(f"{name} SVD: {(time.perf_counter() - tic) / len(sample_users) * 1000:.2f} ms per query")
+    print(f"Partitions loaded for {len(sample_users)} users: {len(models.loaded)} of {len(manifest['partitions'])}")
@@ -0,0 +1,166 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from src.common.instrumentation import span
+
+
+##############################################
+# Model Versions
+##############################################
+def artifact_version(*paths):
+    """
+    Short version token for a set of model artifacts (cache pickles, saved matrices, ...), derived from
+    their size and modification time. Any rewrite of an artifact yields a new token.
+    Missing paths are part of the token too, so creating one also changes it.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        except FileNotFoundError:
+            digest.update(f"{path}:missing;".encode())
+    return digest.hexdigest()[:12]
+
+
+def estimate_size(value):
+    """Approximate memory footprint of a cached recommendation list in bytes."""
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value)
+    return sys.getsizeof(value)
+
+
+##############################################
+# Result Cache
+##############################################
+class RecommendationCache:
+    """
+    In-process LRU cache of top-N recommendation lists.
+
+    Entries are keyed by (method, id, top_n, model_version) and bounded by an entry count, an approximate
+    byte budget and a time-to-live. When a method is queried with a new model version, every entry of
+    its older versions is dropped; `invalidate_id` drops the entries of one user (or business) when its
+    ratings change. Safe to share between threads.
+    """
+
+    def __init__(self, max_entries=100_000, max_bytes=256 * 2 ** 20, ttl_seconds=3600.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._by_id = defaultdict(set)
+        self._by_method = defaultdict(set)
+        self._versions = {}
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def _remove(self, key):
+        value, size, expires = self._entries.pop(key)
+        self._bytes -= size
+        method, entity_id = key[0], key[1]
+        self._by_id[entity_id].discard(key)
+        if not self._by_id[entity_id]:
+            del self._by_id[entity_id]
+        self._by_method[method].discard(key)
+
+    def _check_version(self, method, model_version):
+        if self._versions.get(method, model_version) != model_version:
+            self.invalidate_method(method)
+        self._versions[method] = model_version
+
+    def get(self, method, entity_id, top_n, model_version):
+        """Return the cached list or None (a miss)."""
+        key = (method, entity_id, top_n, model_version)
+        with self._lock:
+            self._check_version(method, model_version)
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < self.clock():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, method, entity_id, top_n, model_version, value):
+        key = (method, entity_id, top_n, model_version)
+        size = estimate_size(value) + sys.getsizeof(key)
+        with self._lock:
+            self._check_version(method, model_version)
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, self.clock() + self.ttl_seconds)
+            self._by_id[entity_id].add(key)
+            self._by_method[method].add(key)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_compute(self, method, entity_id, top_n, model_version, compute):
+        """Return the cached list, or call `compute()` and cache its result."""
+        value = self.get(method, entity_id, top_n, model_version)
+        if value is not None:
+            return value
+        with span("result_cache.compute", method=method):
+            value = compute()
+        self.put(method, entity_id, top_n, model_version, value)
+        return value
+
+    def invalidate_method(self, method):
+        """Drop every entry of a method (e.g. after its model was retrained)."""
+        with self._lock:
+            for key in list(self._by_method.get(method, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def invalidate_id(self, entity_id):
+        """Drop every entry for one user or business (e.g. after the user's ratings changed)."""
+        with self._lock:
+            for key in list(self._by_id.get(entity_id, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_id.clear()
+            self._by_method.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Hit rate and memory metrics."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+# Shared cache in front of the serve mode of main.py; its rating event consumer invalidates entries per user.
+recommendation_cache = RecommendationCache()
+
+
+if __name__ == "__main__":
+    cache = RecommendationCache(max_entries=2, ttl_seconds=60)
+    print(cache.get_or_compute("svd", "user_a", 5, "v1", lambda: ["b1", "b2"]))
+    print(cache.get_or_compute("svd", "user_a", 5, "v1", lambda: ["never computed"]))
+    print(cache.get_or_compute("svd", "user_a", 5, "v2", lambda: ["b3", "b4"]))
+    cache.invalidate_id("user_a")
+    print(cache.stats())
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from src.common.cache import get_cache_dir
+from src.common.instrumentation import traced
+from src.common.user_item_matrix_components import replace_directory, source_signature
+
+
+##############################################
+# Construction
+##############################################
+@traced("social.build_graph", items=lambda friend_matrix: friend_matrix.nnz)
+def build_social_graph(user_csv, user_ids, chunk_size=100_000):
+    """
+    Symmetric friend adjacency from the comma-separated `friends` column of user_processed.csv, streamed
+    in chunks and keyed on the row order of the user-item matrix (`user_ids`). Friends that are not in
+    the matrix, self-loops and duplicate edges are dropped.
+
+    Returns:
+        scipy.sparse.csr_matrix: (n_users, n_users) with int32 indptr/indices and float32 ones as data.
+    """
+    index = pd.Index(user_ids)
+    row_chunks, col_chunks = [], []
+    reader = pd.read_csv(user_csv, usecols=["user_id", "friends"], chunksize=chunk_size,
+                         dtype={"user_id": str, "friends": str})
+    for chunk in reader:
+        chunk = chunk.dropna(subset=["user_id", "friends"])
+        chunk = chunk[chunk["friends"] != "None"]
+        pairs = chunk.assign(friend_id=chunk["friends"].str.split(",")).explode("friend_id")
+        rows = index.get_indexer(pairs["user_id"])
+        cols = index.get_indexer(pairs["friend_id"].str.strip())
+        keep = (rows >= 0) & (cols >= 0) & (rows != cols)
+        row_chunks.append(rows[keep].astype(np.int32))
+        col_chunks.append(cols[keep].astype(np.int32))
+
+    rows = np.concatenate(row_chunks + col_chunks) if row_chunks else np.empty(0, dtype=np.int32)
+    cols = np.concatenate(col_chunks + row_chunks) if row_chunks else np.empty(0, dtype=np.int32)
+    # Sort by (row, col) and drop repeated edges (friendships listed by both users).
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    rows, cols = rows[first], cols[first]
+
+    n_users = len(user_ids)
+    indptr = np.zeros(n_users + 1, dtype=np.int32 if len(cols) < 2 ** 31 else np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_users), out=indptr[1:])
+    return csr_matrix((np.ones(len(cols), dtype=np.float32), cols, indptr), shape=(n_users, n_users))
+
+
+def user_ids_signature(user_ids):
+    """Short hash of the user ID order the graph rows are keyed on."""
+    digest = hashlib.sha1()
+    for start in range(0, len(user_ids), 100_000):
+        digest.update("\n".join(user_ids[start:start + 100_000]).encode())
+    return digest.hexdigest()[:16]
+
+
+##############################################
+# Memory-Mappable Persistence
+##############################################
+def save_social_graph(friend_matrix, directory, meta):
+    """
+    Persist the adjacency pattern (int32 indptr/indices only; the data is all ones) as .npy files,
+    written under a temporary name and renamed into place.
+    """
+    tmp_directory = f"{directory}.tmp-{os.getpid()}"
+    os.makedirs(tmp_directory, exist_ok=True)
+    np.save(os.path.join(tmp_directory, "indptr.npy"), friend_matrix.indptr)
+    np.save(os.path.join(tmp_directory, "indices.npy"), friend_matrix.indices)
+    with open(os.path.join(tmp_directory, "meta.json"), "w") as f:
+        json.dump({**meta, "shape": list(friend_matrix.shape), "nnz": int(friend_matrix.nnz)}, f, indent=2)
+    replace_directory(tmp_directory, directory)
+    print(f"Social graph saved to {directory}")
+
+
+def load_social_graph(user_csv, user_ids, cache_name="social_graph", mmap_mode="r"):
+    """
+    The friend adjacency for `user_ids`, memory-mapped from the cache directory when it was built from
+    the same (unchanged) user file and the same user order, otherwise built and saved.
+
+    Returns:
+        scipy.sparse.csr_matrix: Memory-mapped indptr/indices; only the ones of the data are allocated.
+    """
+    directory = os.path.join(get_cache_dir(), cache_name)
+    meta = {"source": source_signature(user_csv), "user_ids": user_ids_signature(user_ids)}
+    meta_path = os.path.join(directory, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            saved = json.load(f)
+        if saved["source"] == meta["source"] and saved["user_ids"] == meta["user_ids"]:
+            print(f"Loading memory-mapped social graph from {directory}")
+            indptr = np.load(os.path.join(directory, "indptr.npy"), mmap_mode=mmap_mode)
+            indices = np.load(os.path.join(directory, "indices.npy"), mmap_mode=mmap_mode)
+            return csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                              shape=tuple(saved["shape"]), copy=False)
+
+    friend_matrix = build_social_graph(user_csv, user_ids)
+    save_social_graph(friend_matrix, directory, meta)
+    return friend_matrix
+
+
+def social_neighbourhood(target_idx, friend_matrix, hops=2):
+    """
+    Users within `hops` friendship steps of the target (friends, and friends of friends for hops=2),
+    from sparse products of the target's adjacency row. The target itself is excluded.
+    """
+    reach = friend_matrix[target_idx]
+    frontier = reach
+    for _ in range(hops - 1):
+        frontier = frontier @ friend_matrix
+        reach = reach + frontier
+    neighbours = reach.indices
+    return neighbours[neighbours != target_idx]
+
+
+if __name__ == "__main__":
+    from src.common.user_item_matrix_components import load_user_item_matrix_components
+    from util.paths import DATA_PROCESSED
+
+    matrix_components = load_user_item_matrix_components(os.path.join(DATA_PROCESSED, "ratings_processed.csv"))
+    user_ids = matrix_components[1]
+    friend_matrix = load_social_graph(os.path.join(DATA_PROCESSED, "user_processed.csv"), user_ids)
+    degrees = np.diff(friend_matrix.indptr)
+    print(f"Social graph: {friend_matrix.shape[0]} users, {friend_matrix.nnz // 2} friendships, "
+          f"{(degrees > 0).mean():.1%} of users with friends")
+    sample_idx = int(np.argmax(degrees))
+    print(f"User {user_ids[sample_idx]}: {degrees[sample_idx]} friends, "
+          f"{len(social_neighbourhood(sample_idx, friend_matrix))} users within two hops")
@@ -0,0 +1,240 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from src.common.instrumentation import span
+
+
+class Stage:
+    """
+    One step of a pipeline: `func(**kwargs)` reads the `inputs` files and writes the `outputs` files.
+
+    Stages are linked through their files: a stage depends on the stage that produces one of its inputs.
+    `after` adds dependencies on stage names that are not expressed as files. `func` must be a module-level
+    function so it can be sent to a worker process.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), kwargs=None, after=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.kwargs = kwargs or {}
+        self.after = list(after)
+
+    def __repr__(self):
+        return f"Stage({self.name!r})"
+
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def execute_stage(name, func, kwargs):
+    """Run one stage (in a worker process when jobs > 1) and return its wall time."""
+    tic = time.perf_counter()
+    with span(f"stage.{name}"):
+        func(**kwargs)
+    return time.perf_counter() - tic
+
+
+##############################################
+# Planning
+##############################################
+def build_dependencies(stages):
+    """Map every stage name to the names of the stages it depends on."""
+    producers = {output: stage.name for stage in stages for output in stage.outputs}
+    return {stage.name: sorted({producers[path] for path in stage.inputs if path in producers} | set(stage.after))
+            for stage in stages}
+
+
+def topological_order(stages, dependencies):
+    by_name = {stage.name: stage for stage in stages}
+    order, state = [], {}
+
+    def visit(name):
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            raise ValueError(f"Stage dependency cycle through '{name}'")
+        state[name] = "visiting"
+        for dependency in dependencies[name]:
+            visit(dependency)
+        state[name] = "done"
+        order.append(by_name[name])
+
+    for stage in stages:
+        visit(stage.name)
+    return order
+
+
+def plan_stages(stages, targets=None):
+    """
+    Decide which stages have to run, make-style.
+
+    A stage must run if it has no outputs, an output is missing, an input is newer than its oldest
+    output, or a stage it depends on must run. Outputs of an upstream stage that are missing are treated
+    as intermediate files (like make's .SECONDARY): they do not force a rebuild on their own, only if the
+    files they would be rebuilt from are newer than the outputs that read them. A stage that runs brings
+    every stage it depends on up to date first.
+
+    Args:
+        targets (list): Stage names to bring up to date; None means all stages.
+
+    Returns:
+        tuple: (stages needed for the targets in topological order, set of stage names to run)
+    """
+    dependencies = build_dependencies(stages)
+    by_name = {stage.name: stage for stage in stages}
+    targets = list(by_name) if targets is None else list(targets)
+    needed, pending = set(), list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(dependencies[name])
+    order = topological_order([stage for stage in stages if stage.name in needed], dependencies)
+    producers = {output: stage for stage in order for output in stage.outputs}
+
+    def outputs_exist(stage):
+        return bool(stage.outputs) and all(mtime(path) is not None for path in stage.outputs)
+
+    def newest_source(path, seen=()):
+        modified = mtime(path)
+        if modified is not None or path not in producers or path in seen:
+            return modified or 0.0
+        return max((newest_source(source, seen + (path,)) for source in producers[path].inputs), default=0.0)
+
+    decided = {}
+
+    def must_run(name):
+        if name not in decided:
+            stage = by_name[name]
+            if not outputs_exist(stage):
+                decided[name] = True
+            else:
+                oldest = min(mtime(path) for path in stage.outputs)
+                decided[name] = (
+                    any(outputs_exist(by_name[dependency]) and must_run(dependency)
+                        for dependency in dependencies[name])
+                    or max((newest_source(path) for path in stage.inputs), default=0.0) > oldest)
+        return decided[name]
+
+    to_run = {name for name in targets if must_run(name)}
+    pending = list(to_run)
+    while pending:
+        for dependency in dependencies[pending.pop()]:
+            if dependency not in to_run and must_run(dependency):
+                to_run.add(dependency)
+                pending.append(dependency)
+    return order, to_run
+
+
+def critical_path(order, dependencies, durations):
+    """
+    Longest chain of dependent stages by duration; it bounds the wall time no matter how many workers run.
+
+    Returns:
+        tuple: (stage names along the path, total seconds)
+    """
+    finish, previous = {}, {}
+    for stage in order:
+        upstream = [name for name in dependencies[stage.name] if name in finish]
+        best = max(upstream, key=lambda name: finish[name], default=None)
+        finish[stage.name] = durations.get(stage.name, 0.0) + (finish[best] if best else 0.0)
+        previous[stage.name] = best
+    if not finish:
+        return [], 0.0
+    name = max(finish, key=finish.get)
+    total = finish[name]
+    path = []
+    while name is not None:
+        path.append(name)
+        name = previous[name]
+    return path[::-1], total
+
+
+##############################################
+# Execution
+##############################################
+def run_stages(stages, targets=None, jobs=1):
+    """
+    Run the stale stages, up to `jobs` at once in a process pool (in-process if jobs is 1), starting each
+    stage as soon as the stages it depends on have finished. Stale outputs are deleted before a stage
+    reruns, so cached builders (`cache_results`) recompute instead of loading the old pickle.
+
+    Returns:
+        dict: status and duration per stage, wall and serial seconds, and the critical path.
+    """
+    order, to_run = plan_stages(stages, targets)
+    dependencies = build_dependencies(stages)
+    remaining = {stage.name: stage for stage in order if stage.name in to_run}
+    # Stages that do not run are up to date, or intermediates that are missing but not needed.
+    status = {stage.name: "up to date" if all(mtime(path) is not None for path in stage.outputs) else "not needed"
+              for stage in order if stage.name not in to_run}
+    durations = {}
+
+    def ready():
+        return [stage for stage in order if stage.name in remaining
+                and all(dependency not in remaining and dependency not in running.values()
+                        for dependency in dependencies[stage.name])]
+
+    tic = time.perf_counter()
+    running = {}
+    pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 and len(remaining) > 1 else None
+    try:
+        while remaining or running:
+            for stage in ready():
+                del remaining[stage.name]
+                for path in stage.outputs:
+                    if os.path.isfile(path):
+                        os.remove(path)
+                print(f"Running stage {stage.name}...")
+                if pool is None:
+                    durations[stage.name] = execute_stage(stage.name, stage.func, stage.kwargs)
+                    status[stage.name] = "ran"
+                else:
+                    running[pool.submit(execute_stage, stage.name, stage.func, stage.kwargs)] = stage.name
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    durations[name] = future.result()
+                except Exception:
+                    print(f"Stage {name} failed; waiting for the running stages to finish.")
+                    remaining.clear()
+                    wait(running)
+                    raise
+                status[name] = "ran"
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    wall = time.perf_counter() - tic
+
+    path, path_seconds = critical_path(order, dependencies, durations)
+    path = [name for name in path if name in durations]
+    report = {
+        "stages": {stage.name: {"status": status[stage.name], "seconds": durations.get(stage.name, 0.0)}
+                   for stage in order},
+        "wall_seconds": wall,
+        "serial_seconds": sum(durations.values()),
+        "critical_path": path,
+        "critical_path_seconds": path_seconds,
+        "jobs": jobs,
+    }
+    print_stage_report(report)
+    return report
+
+
+def print_stage_report(report):
+    print(f"Stage report (jobs={report['jobs']}, wall {report['wall_seconds']:.2f} s, "
+          f"serial {report['serial_seconds']:.2f} s):")
+    for name, stage in report["stages"].items():
+        print(f"  {name:<28} {stage['status']:<11} {stage['seconds']:8.2f} s")
+    if report["serial_seconds"] > 0:
+        print(f"Critical path ({report['critical_path_seconds']:.2f} s): {' -> '.join(report['critical_path'])}")
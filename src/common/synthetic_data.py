@@ -0,0 +1,315 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from util.paths import DATA_SYNTHETIC
+
+##############################################
+# Vocabulary used to fill the synthetic tables
+##############################################
+ID_ALPHABET = np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_", dtype=np.uint8)
+
+CITIES = [
+    ("Philadelphia", "PA"), ("Tucson", "AZ"), ("Tampa", "FL"), ("Indianapolis", "IN"),
+    ("Nashville", "TN"), ("New Orleans", "LA"), ("Reno", "NV"), ("Edmonton", "AB"),
+    ("Saint Louis", "MO"), ("Boise", "ID"), ("Santa Barbara", "CA"), ("Clearwater", "FL"),
+    ("Wilmington", "DE"), ("Metairie", "LA"), ("Franklin", "TN"), ("St. Petersburg", "FL"),
+    ("Cherry Hill", "NJ"), ("Sparks", "NV"), ("Brandon", "FL"), ("Meridian", "ID"),
+]
+
+CATEGORIES = [
+    "Restaurants", "Food", "Shopping", "Home Services", "Beauty & Spas", "Nightlife",
+    "Health & Medical", "Local Services", "Bars", "Automotive", "Event Planning & Services",
+    "Sandwiches", "American (Traditional)", "Pizza", "Coffee & Tea", "Fast Food", "Breakfast & Brunch",
+    "American (New)", "Hotels & Travel", "Home & Garden", "Fashion", "Burgers", "Arts & Entertainment",
+    "Auto Repair", "Hair Salons", "Nail Salons", "Mexican", "Italian", "Specialty Food", "Doctors",
+    "Pets", "Real Estate", "Seafood", "Fitness & Instruction", "Professional Services", "Grocery",
+    "Chinese", "Japanese", "Desserts", "Bakeries",
+]
+
+NAME_ADJECTIVES = ["Golden", "Blue", "Happy", "Rustic", "Urban", "Little", "Grand", "Lucky", "Silver", "Old Town"]
+NAME_NOUNS = ["Spoon", "Garden", "Corner", "Kitchen", "Market", "House", "Studio", "Table", "Bistro", "Shop"]
+FIRST_NAMES = ["Alex", "Sam", "Jordan", "Taylor", "Morgan", "Casey", "Jamie", "Riley", "Avery", "Quinn",
+               "Maria", "John", "Wei", "Priya", "Ahmed", "Elena", "Kenji", "Fatima", "Lucas", "Zoe"]
+
+POSITIVE_PHRASES = ["amazing food", "great service", "friendly staff", "loved the atmosphere",
+                    "would definitely come back", "excellent value", "delicious and fresh", "wonderful experience"]
+NEUTRAL_PHRASES = ["the place was okay", "average portions", "parking was available", "it was busy on friday",
+                   "the menu is large", "prices are typical", "we ordered the special", "open late"]
+NEGATIVE_PHRASES = ["terrible service", "cold food", "rude staff", "waited forever", "overpriced and bland",
+                    "dirty tables", "would not recommend", "awful experience"]
+
+
+##############################################
+# Sampling Helpers
+##############################################
+def random_ids(rng, n, length=22):
+    """
+    Generate `n` Yelp-style identifiers (22 url-safe base64 characters).
+    """
+    codes = ID_ALPHABET[rng.integers(0, len(ID_ALPHABET), size=(n, length))]
+    return codes.view(f"S{length}").ravel().astype(str)
+
+
+def skewed_indices(rng, n, size, skew):
+    """
+    Draw `size` indices from range(n) with an approximately power-law popularity.
+
+    Index i is drawn as floor(n * u ** skew) with u uniform, so the k-th most popular index
+    is drawn with frequency proportional to k ** (1 / skew - 1). skew=1 is uniform; larger values
+    concentrate the activity on fewer indices.
+    """
+    return np.minimum((n * rng.random(size) ** skew).astype(np.int64), n - 1)
+
+
+##############################################
+# Table Generators
+##############################################
+def generate_businesses(rng, n_businesses, n_cities, item_skew):
+    """
+    Create the business table. Businesses are assigned to cities with a skewed city size distribution
+    and are returned sorted by city so each city is one contiguous block.
+    """
+    cities = CITIES[:n_cities]
+    city_idx = np.sort(skewed_indices(rng, len(cities), n_businesses, 1.5))
+    quality = np.clip(rng.normal(3.7, 0.6, n_businesses), 1.0, 5.0)
+
+    n_categories = rng.integers(1, 5, n_businesses)
+    category_idx = skewed_indices(rng, len(CATEGORIES), int(n_categories.sum()), item_skew)
+    offsets = np.concatenate([[0], np.cumsum(n_categories)])
+    categories_list = [sorted({CATEGORIES[c] for c in category_idx[offsets[i]:offsets[i + 1]]})
+                       for i in range(n_businesses)]
+
+    adjectives = rng.integers(0, len(NAME_ADJECTIVES), n_businesses)
+    nouns = rng.integers(0, len(NAME_NOUNS), n_businesses)
+    business_df = pd.DataFrame({
+        "business_id": random_ids(rng, n_businesses),
+        "name": [f"{NAME_ADJECTIVES[a]} {NAME_NOUNS[b]} {i}" for i, (a, b) in enumerate(zip(adjectives, nouns))],
+        "city": [cities[c][0] for c in city_idx],
+        "state": [cities[c][1] for c in city_idx],
+        "stars": np.round(quality * 2) / 2,
+        "review_count": 0,
+        "categories": [", ".join(cats) for cats in categories_list],
+        "categories_list": [str(cats) for cats in categories_list],
+    })
+    return business_df, city_idx, quality
+
+
+def generate_ratings(rng, n_ratings, n_users, business_city, business_quality, n_cities,
+                     user_skew, item_skew, locality):
+    """
+    Draw (user, business, rating) triples.
+
+    Users are drawn with a power-law activity. With probability `locality` the business is drawn from the
+    user's home city, otherwise from the whole catalog; both draws favour a power-law set of popular
+    businesses. Repeated (user, business) pairs are dropped, so the result has at most `n_ratings` rows.
+    """
+    n_businesses = len(business_city)
+    city_offsets = np.searchsorted(business_city, np.arange(n_cities + 1))
+    city_sizes = np.diff(city_offsets)
+
+    # Users live where the businesses are.
+    weights = city_sizes / city_sizes.sum()
+    user_city = rng.choice(n_cities, size=n_users, p=weights)
+    user_bias = rng.normal(0.0, 0.4, n_users)
+    user_rank = rng.permutation(n_users)
+
+    users = np.empty(0, dtype=np.int64)
+    businesses = np.empty(0, dtype=np.int64)
+    for _ in range(5):
+        missing = n_ratings - len(users)
+        if missing <= 0:
+            break
+        draw = int(missing * 1.2) + 16
+        u = user_rank[skewed_indices(rng, n_users, draw, user_skew)]
+        local = rng.random(draw) < locality
+        b = skewed_indices(rng, n_businesses, draw, item_skew)
+        home = user_city[u[local]]
+        sizes = city_sizes[home]
+        has_businesses = sizes > 0
+        local_pick = np.minimum((sizes * rng.random(len(home)) ** item_skew).astype(np.int64),
+                                np.maximum(sizes - 1, 0))
+        b_local = b[local]
+        b_local[has_businesses] = city_offsets[home][has_businesses] + local_pick[has_businesses]
+        b[local] = b_local
+
+        users = np.concatenate([users, u])
+        businesses = np.concatenate([businesses, b])
+        _, first = np.unique(users * n_businesses + businesses, return_index=True)
+        keep = np.sort(first)
+        users, businesses = users[keep], businesses[keep]
+
+    users, businesses = users[:n_ratings], businesses[:n_ratings]
+    ratings = np.clip(np.rint(business_quality[businesses] + user_bias[users] + rng.normal(0.0, 0.9, len(users))),
+                      1, 5).astype(float)
+    return users, businesses, ratings, user_city
+
+
+def generate_review_texts(rng, ratings):
+    """
+    Produce short review texts whose tone follows the star rating.
+    """
+    texts = []
+    n_phrases = rng.integers(2, 6, len(ratings))
+    for rating, k in zip(ratings, n_phrases):
+        if rating >= 4:
+            pool = POSITIVE_PHRASES
+        elif rating <= 2:
+            pool = NEGATIVE_PHRASES
+        else:
+            pool = NEUTRAL_PHRASES
+        phrases = [pool[i] for i in rng.integers(0, len(pool), k - 1)]
+        phrases.append(NEUTRAL_PHRASES[rng.integers(0, len(NEUTRAL_PHRASES))])
+        texts.append(". ".join(phrases).capitalize() + ".")
+    return texts
+
+
+def generate_friends(rng, user_ids, user_city, mean_friends):
+    """
+    Build the comma-separated `friends` strings. Friend counts are heavy-tailed and friends are
+    mostly drawn from the same city. Users without friends get "None" like in the Yelp dump.
+    """
+    n_users = len(user_ids)
+    degree = np.minimum(rng.pareto(2.0, n_users) * mean_friends, 5000).astype(np.int64)
+    order = np.argsort(user_city, kind="stable")
+    city_offsets = np.searchsorted(user_city[order], np.arange(user_city.max() + 2))
+
+    friends = []
+    for u in range(n_users):
+        if degree[u] == 0:
+            friends.append("None")
+            continue
+        lo, hi = city_offsets[user_city[u]], city_offsets[user_city[u] + 1]
+        picks = order[rng.integers(lo, hi, degree[u])]
+        picks = np.unique(picks[picks != u])
+        friends.append(", ".join(user_ids[picks]) if len(picks) else "None")
+    return friends
+
+
+def generate_checkins(rng, business_popularity, mean_checkins, start="2010-01-01", end="2022-01-19"):
+    """
+    Build the check-in table: one row per business with a comma-separated list of timestamps.
+    The number of check-ins per business follows its rating popularity.
+    """
+    lo = np.datetime64(start, "s").astype(np.int64)
+    hi = np.datetime64(end, "s").astype(np.int64)
+    scale = mean_checkins * len(business_popularity) / max(business_popularity.sum(), 1)
+    counts = rng.poisson(business_popularity * scale + 0.5)
+
+    dates, date_lists = [], []
+    for count in counts:
+        if count == 0:
+            dates.append(None)
+            date_lists.append("[]")
+            continue
+        stamps = np.sort(rng.integers(lo, hi, count)).astype("datetime64[s]")
+        formatted = np.char.replace(stamps.astype(str), "T", " ").tolist()
+        dates.append(", ".join(formatted))
+        date_lists.append(str(formatted))
+    return dates, date_lists
+
+
+##############################################
+# Dataset Generator
+##############################################
+def generate_synthetic_dataset(n_ratings=100_000, n_users=None, n_businesses=None, n_cities=len(CITIES),
+                               user_skew=3.0, item_skew=3.0, locality=0.9, review_fraction=0.2,
+                               max_reviews=200_000, mean_friends=5, mean_checkins=20, seed=42,
+                               output_dir=DATA_SYNTHETIC):
+    """
+    Generate a Yelp-shaped dataset and write it in the `*_processed.csv` schemas.
+
+    The output directory can be used anywhere a processed data directory is expected.
+    By default the user and business counts follow the Yelp ratios (about 0.28 users and 0.02 businesses
+    per rating). Only `review_fraction` of the ratings (capped at `max_reviews`) get a review text.
+
+    Args:
+        n_ratings (int): Target number of ratings (10k to 10M are practical).
+        n_users (int): Number of users. Defaults to 0.28 * n_ratings.
+        n_businesses (int): Number of businesses. Defaults to 0.02 * n_ratings.
+        n_cities (int): Number of (city, state) regions, at most len(CITIES).
+        user_skew (float): Skew of the user activity (1 is uniform).
+        item_skew (float): Skew of the business popularity (1 is uniform).
+        locality (float): Probability that a rating is for a business in the user's home city.
+        review_fraction (float): Fraction of ratings that also get a review text.
+        max_reviews (int): Upper bound on the number of reviews.
+        mean_friends (float): Mean friend count per user.
+        mean_checkins (float): Mean check-in count per business.
+        seed (int): Random seed.
+        output_dir (str): Directory for the generated CSV files.
+
+    Returns:
+        dict: Mapping from table name ("business", "reviews", "ratings", "user", "checkin") to CSV path.
+    """
+    rng = np.random.default_rng(seed)
+    n_cities = min(n_cities, len(CITIES))
+    n_users = n_users or max(10, int(n_ratings * 0.28))
+    n_businesses = n_businesses or max(10, int(n_ratings * 0.02))
+
+    business_df, business_city, quality = generate_businesses(rng, n_businesses, n_cities, item_skew)
+    users, businesses, ratings, user_city = generate_ratings(rng, n_ratings, n_users, business_city, quality,
+                                                             n_cities, user_skew, item_skew, locality)
+    user_ids = random_ids(rng, n_users)
+    business_ids = business_df["business_id"].to_numpy()
+
+    ratings_df = pd.DataFrame({
+        "user_id": user_ids[users],
+        "business_id": business_ids[businesses],
+        "rating": ratings,
+    })
+
+    n_reviews = min(int(len(ratings_df) * review_fraction), max_reviews)
+    review_rows = np.sort(rng.choice(len(ratings_df), size=n_reviews, replace=False))
+    reviews_df = pd.DataFrame({
+        "review_id": random_ids(rng, n_reviews),
+        "user_id": ratings_df["user_id"].to_numpy()[review_rows],
+        "business_id": ratings_df["business_id"].to_numpy()[review_rows],
+        "review_text": generate_review_texts(rng, ratings[review_rows]),
+    })
+
+    business_popularity = np.bincount(businesses, minlength=n_businesses)
+    business_df["review_count"] = business_popularity
+
+    user_counts = np.bincount(users, minlength=n_users)
+    user_sums = np.bincount(users, weights=ratings, minlength=n_users)
+    user_df = pd.DataFrame({
+        "user_id": user_ids,
+        "name": [FIRST_NAMES[i] for i in rng.integers(0, len(FIRST_NAMES), n_users)],
+        "review_count": user_counts,
+        "average_stars": np.round(np.divide(user_sums, user_counts, out=np.zeros(n_users), where=user_counts > 0), 2),
+        "friends": generate_friends(rng, user_ids, user_city, mean_friends),
+    })
+
+    dates, date_lists = generate_checkins(rng, business_popularity, mean_checkins)
+    checkin_df = pd.DataFrame({"business_id": business_ids, "date": dates, "date_list": date_lists})
+    checkin_df = checkin_df.dropna(subset=["date"])
+
+    os.makedirs(output_dir, exist_ok=True)
+    tables = {
+        "business": business_df,
+        "reviews": reviews_df,
+        "ratings": ratings_df,
+        "user": user_df,
+        "checkin": checkin_df,
+    }
+    paths = {}
+    for name, df in tables.items():
+        paths[name] = os.path.join(output_dir, f"{name}_processed.csv")
+        df.to_csv(paths[name], index=False)
+        print(f"Wrote {len(df)} synthetic {name} rows to {paths[name]}")
+    return paths
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Synthetic Yelp-shaped data generator")
+    parser.add_argument('--n_ratings', type=int, default=100_000,
+                        help="Target number of ratings (default is 100000).")
+    parser.add_argument('--seed', type=int, default=42, help="Random seed (default is 42).")
+    parser.add_argument('--output_dir', type=str, default=DATA_SYNTHETIC,
+                        help="Directory to write the *_processed.csv files to.")
+    args = parser.parse_args()
+
+    generate_synthetic_dataset(n_ratings=args.n_ratings, seed=args.seed, output_dir=args.output_dir)
@@ -1,15 +1,30 @@
 import numpy as np
-import torch
-from sentence_transformers import SentenceTransformer
 
 from src.common.cache import cache_results
+from src.common.instrumentation import traced
 
-# Set device to GPU if available.
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model = SentenceTransformer('all-MiniLM-L6-v2', device=device)
+# The sentence encoder is loaded lazily on first use. Anything exposing
+# `encode(texts, show_progress_bar=...)` can be assigned here instead (e.g. a stub in the benchmarks).
+model = None
+
+
+def get_model():
+    """
+    Return the sentence encoder, loading all-MiniLM-L6-v2 on first use.
+    Uses the GPU if available.
+    """
+    global model
+    if model is None:
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model = SentenceTransformer('all-MiniLM-L6-v2', device=device)
+    return model
 
 
 @cache_results("embeddings_cache.pkl", force_recompute=False)
+@traced("embeddings.compute", items=len)
 def compute_embeddings(texts):
     """
     Compute and cache embeddings for a list of texts.
@@ -19,7 +34,7 @@ def compute_embeddings(texts):
         numpy.ndarray: Array of embeddings.
     """
     print("Computing embeddings...")
-    embeddings = model.encode(texts, show_progress_bar=True)
+    embeddings = get_model().encode(texts, show_progress_bar=True)
     return embeddings
 
 
@@ -1,7 +1,16 @@
+import json
+import os
+import shutil
+
+import numpy as np
 import pandas as pd
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csc_matrix, csr_matrix
+
+from src.common.cache import get_cache_dir
+from src.common.instrumentation import span, traced
 
 
+@traced("matrix.build", items=lambda components: components[0].nnz)
 def build_user_item_matrix_components(ratings_df):
     user_ids = ratings_df['user_id'].unique()
     business_ids = ratings_df['business_id'].unique()
@@ -16,6 +25,195 @@ def build_user_item_matrix_components(ratings_df):
     return sparse_matrix, user_ids.tolist(), business_ids.tolist()
 
 
+##############################################
+# Chunked (Out-of-Core) Construction
+##############################################
+def count_data_lines(csv_path, block_size=1 << 24):
+    """
+    Number of data rows of a CSV without quoted newlines (total lines minus the header). A last line
+    without a trailing newline counts as a line.
+    """
+    lines = 0
+    last = b"\n"
+    with open(csv_path, "rb") as f:
+        while block := f.read(block_size):
+            lines += block.count(b"\n")
+            last = block[-1:]
+    if last != b"\n":
+        lines += 1
+    return max(lines - 1, 0)
+
+
+def assign_codes(values, code_map):
+    """
+    Integer codes for a chunk of IDs, extending `code_map` with IDs seen for the first time.
+    Only the distinct IDs of the chunk go through the Python dict.
+    """
+    local_codes, uniques = pd.factorize(values)
+    global_codes = np.fromiter((code_map.setdefault(value, len(code_map)) for value in uniques),
+                               dtype=np.int32, count=len(uniques))
+    return global_codes[local_codes]
+
+
+@traced("matrix.build_chunked", items=lambda components: components[0].nnz)
+def build_user_item_matrix_chunked(ratings_csv, chunk_size=1_000_000):
+    """
+    Build the user-item matrix components by streaming ratings_processed.csv in chunks.
+
+    User and business IDs get integer codes incrementally (first appearance order, like
+    `build_user_item_matrix_components`), and the row/column codes and ratings are written into
+    preallocated int32/int32/int8 buffers (float32 if a rating is not integral), so the peak memory
+    is close to the size of the final matrix. The buffers are sized from the line count and grow if a
+    chunk holds more rows than expected. When the same (user, business) pair appears more than
+    once, the last rating wins instead of the ratings being summed.
+
+    Returns:
+        tuple: (CSR matrix with float32 ratings, user_ids list, business_ids list)
+    """
+    capacity = count_data_lines(ratings_csv)
+    rows = np.empty(capacity, dtype=np.int32)
+    cols = np.empty(capacity, dtype=np.int32)
+    data = np.empty(capacity, dtype=np.int8)
+    user_codes, business_codes = {}, {}
+
+    filled = 0
+    reader = pd.read_csv(ratings_csv, usecols=["user_id", "business_id", "rating"], chunksize=chunk_size,
+                         dtype={"user_id": str, "business_id": str, "rating": np.float32})
+    for chunk in reader:
+        chunk = chunk.dropna(subset=["user_id", "business_id", "rating"])
+        n = len(chunk)
+        if filled + n > len(rows):
+            capacity = max(filled + n, 2 * len(rows))
+            rows, cols, data = (np.resize(buffer, capacity) for buffer in (rows, cols, data))
+        ratings = chunk["rating"].to_numpy()
+        if data.dtype == np.int8 and not np.array_equal(ratings, np.round(ratings)):
+            data = data.astype(np.float32)
+        rows[filled:filled + n] = assign_codes(chunk["user_id"].to_numpy(), user_codes)
+        cols[filled:filled + n] = assign_codes(chunk["business_id"].to_numpy(), business_codes)
+        data[filled:filled + n] = ratings
+        filled += n
+        print(f"Streamed {filled} ratings...")
+    rows, cols, data = rows[:filled], cols[:filled], data[:filled]
+
+    with span("matrix.deduplicate", items=filled):
+        # Stable sort by (row, col): the last entry of every run is the most recent rating of that pair.
+        order = np.lexsort((cols, rows))
+        rows, cols, data = rows[order], cols[order], data[order]
+        del order
+        last = np.ones(filled, dtype=bool)
+        last[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        rows, cols, data = rows[last], cols[last], data[last]
+
+    shape = (len(user_codes), len(business_codes))
+    indptr = np.zeros(shape[0] + 1, dtype=np.int32 if len(cols) < 2 ** 31 else np.int64)
+    np.cumsum(np.bincount(rows, minlength=shape[0]), out=indptr[1:])
+    sparse_matrix = csr_matrix((data.astype(np.float32), cols, indptr), shape=shape)
+    return sparse_matrix, list(user_codes), list(business_codes)
+
+
+##############################################
+# Memory-Mappable Persistence
+##############################################
+def source_signature(path):
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def replace_directory(tmp_directory, directory):
+    """
+    Move a fully written `tmp_directory` to `directory`. An existing directory is renamed aside before
+    the new one is renamed in and only deleted afterwards, so a reader finds either the complete old
+    directory, the complete new one, or (between the two renames) none, never a partly deleted one.
+    Arrays that readers already memory-mapped stay valid after the old files are unlinked.
+    """
+    old_directory = f"{directory}.old-{os.getpid()}"
+    if os.path.exists(directory):
+        os.replace(directory, old_directory)
+    os.replace(tmp_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+
+def save_matrix_components(matrix_components, directory, with_csc=False, source_csv=None):
+    """
+    Persist matrix components as .npy arrays (CSR indptr/indices/data, fixed-width ID arrays and
+    optionally a CSC copy) that `load_matrix_components` can memory-map. The directory is written
+    under a temporary name and swapped in with `replace_directory`, so readers never see a half-written
+    matrix (though one that looks while it is swapped may find no matrix and build its own).
+    """
+    sparse_matrix, user_ids, business_ids = matrix_components
+    tmp_directory = f"{directory}.tmp-{os.getpid()}"
+    os.makedirs(tmp_directory, exist_ok=True)
+
+    arrays = {
+        "indptr": sparse_matrix.indptr,
+        "indices": sparse_matrix.indices,
+        "data": sparse_matrix.data,
+        "user_ids": np.asarray(user_ids, dtype=str),
+        "business_ids": np.asarray(business_ids, dtype=str),
+    }
+    if with_csc:
+        item_matrix = sparse_matrix.tocsc()
+        arrays.update(csc_indptr=item_matrix.indptr, csc_indices=item_matrix.indices, csc_data=item_matrix.data)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_directory, f"{name}.npy"), array)
+
+    meta = {"shape": list(sparse_matrix.shape), "nnz": int(sparse_matrix.nnz), "with_csc": with_csc,
+            "source": source_signature(source_csv) if source_csv else None}
+    with open(os.path.join(tmp_directory, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    replace_directory(tmp_directory, directory)
+    print(f"User-item matrix saved to {directory}")
+
+
+def load_matrix_components(directory, mmap_mode="r"):
+    """
+    Load components saved by `save_matrix_components`, memory-mapping the arrays (read-only by default).
+
+    Returns:
+        tuple: (matrix_components, CSC matrix or None if it was not saved)
+    """
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+
+    def load(name):
+        return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+
+    shape = tuple(meta["shape"])
+    sparse_matrix = csr_matrix((load("data"), load("indices"), load("indptr")), shape=shape, copy=False)
+    item_matrix = None
+    if meta["with_csc"]:
+        item_matrix = csc_matrix((load("csc_data"), load("csc_indices"), load("csc_indptr")), shape=shape,
+                                 copy=False)
+    return (sparse_matrix, load("user_ids").tolist(), load("business_ids").tolist()), item_matrix
+
+
+@traced("matrix.load")
+def load_user_item_matrix_components(ratings_csv, cache_name="user_item_matrix", chunk_size=1_000_000,
+                                     with_csc=False):
+    """
+    Return the user-item matrix components for `ratings_csv`, memory-mapped from the cache directory when
+    they were saved from the same (unchanged) file, otherwise built with the chunked builder and saved.
+
+    Returns:
+        tuple: matrix_components, or (matrix_components, CSC matrix) if `with_csc` is True.
+    """
+    directory = os.path.join(get_cache_dir(), cache_name)
+    meta_path = os.path.join(directory, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta["source"] == source_signature(ratings_csv) and (meta["with_csc"] or not with_csc):
+            print(f"Loading memory-mapped user-item matrix from {directory}")
+            matrix_components, item_matrix = load_matrix_components(directory)
+            return (matrix_components, item_matrix) if with_csc else matrix_components
+
+    matrix_components = build_user_item_matrix_chunked(ratings_csv, chunk_size=chunk_size)
+    save_matrix_components(matrix_components, directory, with_csc=with_csc, source_csv=ratings_csv)
+    matrix_components, item_matrix = load_matrix_components(directory)
+    return (matrix_components, item_matrix) if with_csc else matrix_components
+
+
 if __name__ == "__main__":
     from util.paths import DATA_PROCESSED
 
@@ -27,3 +225,6 @@ if __name__ == "__main__":
     print(f"Business IDs: {matrix_components[2]}")
     print(f"Sparse Matrix Shape: {matrix_components[0].shape}")
     print(f"Sample User ID: {sample_user_id}")
+
+    chunked_components = load_user_item_matrix_components(ratings_csv)
+    print(f"Chunked Sparse Matrix Shape: {chunked_components[0].shape}, nnz: {chunked_components[0].nnz}")
@@ -3,20 +3,43 @@ import time
 
 import numpy as np
 import pandas as pd
+from sklearn.decomposition import IncrementalPCA
 from sklearn.metrics.pairwise import cosine_similarity
 
-from src.common.cache import cache_results
+from src.common.cache import cache_results, get_cache_dir
+from src.common.instrumentation import span, traced
 from src.common.sentiment_analysis import batch_sentiment_analysis
 from src.common.text_embeddings import compute_embeddings
 from util.paths import DATA_PROCESSED
 
 
-@cache_results("item_profiles_cache.pkl", force_recompute=False)
-def build_item_profiles(business_df, reviews_df):
+def item_profiles_cache_name(n_components=None, projection="pca", sentiment_weight=1.0, **_):
+    """Cache file of `build_item_profiles`: the raw profiles keep their original name."""
+    if n_components is None:
+        return "item_profiles_cache.pkl"
+    return f"item_profiles_cache_{projection}{n_components}_w{sentiment_weight:g}.pkl"
+
+
+def profile_projection_cache_name(n_components, projection="pca", sentiment_weight=1.0):
+    """File the projection of projected profiles is saved to, next to their cache file."""
+    return item_profiles_cache_name(n_components, projection, sentiment_weight)[:-4] + ".npz"
+
+
+@cache_results(item_profiles_cache_name, force_recompute=False)
+@traced("level1.build_item_profiles", items=len)
+def build_item_profiles(business_df, reviews_df, n_components=None, projection="pca", sentiment_weight=1.0):
     """
     Build content-based item profiles by aggregating review texts, computing text embeddings,
     and incorporating average sentiment.
 
+    Args:
+        n_components (int): If given, project the embeddings to this many dimensions (see
+            `fit_profile_projection`) and append the sentiment standardized and weighted by
+            `sentiment_weight`; the projection is saved to the cache directory. None keeps the full
+            embedding with the raw sentiment appended.
+        projection (str): "pca" (incremental PCA) or "random" (seeded Gaussian random projection).
+        sentiment_weight (float): Spread of the sentiment feature relative to an average projected dimension.
+
     Returns:
         dict: Mapping from business_id to feature vector.
     """
@@ -37,6 +60,15 @@ def build_item_profiles(business_df, reviews_df):
     merged_df = pd.merge(merged_df, business_sentiments, on='business_id', how='left')
     merged_df['avg_sentiment'] = merged_df['avg_sentiment'].fillna(0.0)
 
+    if n_components is not None:
+        sentiments = merged_df['avg_sentiment'].to_numpy()
+        profile_projection = fit_profile_projection(embeddings, sentiments, n_components=n_components,
+                                                    method=projection, sentiment_weight=sentiment_weight)
+        save_profile_projection(profile_projection, os.path.join(
+            get_cache_dir(), profile_projection_cache_name(n_components, projection, sentiment_weight)))
+        projected = project_profiles(profile_projection, embeddings, sentiments)
+        return dict(zip(merged_df['business_id'], projected))
+
     # Append average sentiment as an extra feature dimension for each business
     item_profiles = {}
     for idx, row in merged_df.iterrows():
@@ -47,6 +79,7 @@ def build_item_profiles(business_df, reviews_df):
 
 
 @cache_results("aggregated_reviews_cache.pkl", force_recompute=False)
+@traced("level1.aggregate_business_reviews", items=len)
 def aggregate_business_reviews(reviews_df):
     """Cache the aggregation of review texts per business."""
     return reviews_df.groupby('business_id')['review_text'].apply(
@@ -54,10 +87,11 @@ def aggregate_business_reviews(reviews_df):
 
 
 @cache_results("business_sentiments_cache.pkl", force_recompute=False)
+@traced("level1.calculate_business_sentiments", items=len)
 def calculate_business_sentiments(reviews_df):
     """Cache sentiment calculations for reviews."""
-    tic = time.time()
-    sentiments = batch_sentiment_analysis(reviews_df['review_text'].tolist())
+    with span("sentiment.batch_analysis", items=len(reviews_df)) as sentiment_span:
+        sentiments = batch_sentiment_analysis(reviews_df['review_text'].tolist())
 
     # Extract polarities using vectorized operations instead of apply
     polarities = [sentiment[0] for sentiment in sentiments]
@@ -72,17 +106,21 @@ def calculate_business_sentiments(reviews_df):
     avg_sentiments = sentiment_df.groupby('business_id')['polarity'].mean().reset_index()
     avg_sentiments.rename(columns={'polarity': 'avg_sentiment'}, inplace=True)
 
-    toc = time.time()
-    minutes = (toc - tic) // 60
-    seconds = (toc - tic) % 60
+    minutes = sentiment_span.wall // 60
+    seconds = sentiment_span.wall % 60
     print(f"Sentiment calculation took {minutes} minutes {seconds} seconds.")
     return avg_sentiments
 
 
-def recommend_similar_businesses(business_id, item_profiles, top_n=5):
+@traced("level1.query", items=len)
+def recommend_similar_businesses(business_id, item_profiles, top_n=5, filter_rows=None):
     """
     Recommend similar businesses based on cosine similarity between item profiles.
     Memory-efficient implementation that only computes similarities for the target business.
+
+    Args:
+        filter_rows (numpy.ndarray): Optional positions (in item_profiles order) of the businesses that may be
+            recommended, e.g. from `BusinessIndex.select`; only those are scored.
     """
     business_ids = list(item_profiles.keys())
 
@@ -95,8 +133,11 @@ def recommend_similar_businesses(business_id, item_profiles, top_n=5):
     # Get the feature vector for the target business
     target_vector = item_profiles[business_id].reshape(1, -1)
 
-    # Create array of all other business vectors
-    other_business_ids = [bid for bid in business_ids if bid != business_id]
+    # Create array of all other (allowed) business vectors
+    candidates = range(len(business_ids)) if filter_rows is None else filter_rows
+    other_business_ids = [business_ids[i] for i in candidates if i != idx]
+    if not other_business_ids:
+        return []
     other_vectors = np.array([item_profiles[bid] for bid in other_business_ids])
 
     # Compute similarity only between target and all others (not all-to-all)
@@ -109,7 +150,188 @@ def recommend_similar_businesses(business_id, item_profiles, top_n=5):
     return [other_business_ids[i] for i in top_indices]
 
 
+def build_profile_matrix(item_profiles):
+    """
+    Stack the item profiles into one L2-normalized float32 matrix, so cosine similarity is a dot product.
+
+    Returns:
+        tuple: (business_ids list, profile matrix)
+    """
+    business_ids = list(item_profiles.keys())
+    profile_matrix = np.array([item_profiles[bid] for bid in business_ids], dtype=np.float32)
+    norms = np.linalg.norm(profile_matrix, axis=1, keepdims=True)
+    return business_ids, profile_matrix / np.maximum(norms, 1e-12)
+
+
+@traced("level1.batch_query", items=len)
+def batch_recommend_similar_businesses(business_id_batch, profile_components, top_n=5, business_index=None,
+                                       filter_rows=None):
+    """
+    Content-based recommendations for many businesses at once: one matrix-matrix product of the
+    targets' profiles with the profile matrix and a batched argpartition.
+
+    Args:
+        profile_components (tuple): Output of `build_profile_matrix`.
+        business_index (pandas.Index): Optional prebuilt index over the profile business IDs.
+        filter_rows (numpy.ndarray): Optional sorted profile positions that may be recommended; the product
+            only covers those rows.
+
+    Returns:
+        list of lists: Similar business IDs per input business (empty for unknown businesses).
+    """
+    business_ids, profile_matrix = profile_components
+    business_index = business_index if business_index is not None else pd.Index(business_ids)
+
+    positions = business_index.get_indexer(list(business_id_batch))
+    known = np.flatnonzero(positions >= 0)
+    results = [[] for _ in positions]
+    if len(known) == 0:
+        return results
+
+    candidates = np.arange(profile_matrix.shape[0]) if filter_rows is None else np.asarray(filter_rows)
+    sim_scores = profile_matrix[positions[known]] @ profile_matrix[candidates].T
+    # A target that is itself among the candidates must not be recommended.
+    slots = np.searchsorted(candidates, positions[known])
+    is_candidate = slots < len(candidates)
+    is_candidate[is_candidate] = candidates[slots[is_candidate]] == positions[known][is_candidate]
+    sim_scores[np.flatnonzero(is_candidate), slots[is_candidate]] = -np.inf
+    n = min(top_n, len(candidates))
+    if n <= 0:
+        return results
+    top = np.argpartition(-sim_scores, n - 1, axis=1)[:, :n]
+    order = np.argsort(-np.take_along_axis(sim_scores, top, axis=1), axis=1)
+    for row, indices, row_scores in zip(known, np.take_along_axis(top, order, axis=1), sim_scores):
+        results[row] = [business_ids[candidates[i]] for i in indices if np.isfinite(row_scores[i])]
+    return results
+
+
+##############################################
+# Profile Projection
+##############################################
+@traced("level1.fit_profile_projection", items=len)
+def fit_profile_projection(embeddings, sentiments, n_components=64, method="pca", sentiment_weight=1.0,
+                           batch_size=4096, seed=42):
+    """
+    Fit a projection of the text embeddings to `n_components` dimensions in batches of `batch_size` rows,
+    so the fit never needs more than one batch beyond the embeddings themselves.
+
+    "pca" fits an IncrementalPCA batch by batch; "random" draws a seeded Gaussian matrix (nothing to fit);
+    "none" keeps every dimension (only the sentiment weighting applies).
+    Profiles are projected without centering, so cosine similarities stay comparable to the full embedding.
+    The sentiment is not projected: it is standardized and scaled so its spread is `sentiment_weight` times
+    that of an average projected dimension, then appended as the last feature.
+
+    Returns:
+        dict: method, components (n_features, n_components), sentiment_mean and sentiment_scale.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    n_components = min(n_components, embeddings.shape[1], len(embeddings))
+    starts = list(range(0, len(embeddings), max(batch_size, n_components)))
+    if len(starts) > 1 and len(embeddings) - starts[-1] < n_components:
+        # IncrementalPCA needs at least n_components rows per batch: the last batch absorbs a short remainder.
+        starts.pop()
+    bounds = starts + [len(embeddings)]
+    if method == "none":
+        components = np.eye(embeddings.shape[1], dtype=np.float32)
+        n_components = embeddings.shape[1]
+    elif method == "pca":
+        pca = IncrementalPCA(n_components=n_components)
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            pca.partial_fit(embeddings[start:stop])
+        components = pca.components_.T.astype(np.float32)
+    elif method == "random":
+        rng = np.random.default_rng(seed)
+        components = (rng.standard_normal((embeddings.shape[1], n_components)) / np.sqrt(n_components)).astype(
+            np.float32)
+    else:
+        raise ValueError(f"Unknown projection '{method}'; expected 'pca', 'random' or 'none'")
+
+    squared_norms = sum(float(np.sum((embeddings[start:stop] @ components) ** 2))
+                        for start, stop in zip(bounds[:-1], bounds[1:]))
+    dimension_scale = np.sqrt(squared_norms / max(len(embeddings), 1) / n_components)
+    sentiments = np.asarray(sentiments, dtype=np.float64)
+    sentiment_std = sentiments.std() if len(sentiments) and sentiments.std() > 0 else 1.0
+    return {
+        "method": method,
+        "components": components,
+        "sentiment_mean": float(sentiments.mean()) if len(sentiments) else 0.0,
+        "sentiment_scale": float(sentiment_weight * dimension_scale / sentiment_std),
+    }
+
+
+def project_profiles(profile_projection, embeddings, sentiments):
+    """Projected embeddings with the weighted sentiment appended, as a float32 (n, n_components + 1) matrix."""
+    projected = np.asarray(embeddings, dtype=np.float32) @ profile_projection["components"]
+    sentiment = (np.asarray(sentiments) - profile_projection["sentiment_mean"]) * profile_projection["sentiment_scale"]
+    return np.column_stack([projected, sentiment]).astype(np.float32)
+
+
+def save_profile_projection(profile_projection, path):
+    """Persist a projection, so profiles of new businesses (and queries) can be projected the same way."""
+    tmp_path = f"{path}.tmp-{os.getpid()}.npz"
+    np.savez(tmp_path, **profile_projection)
+    os.replace(tmp_path, path)
+    print(f"Profile projection saved to {path}")
+
+
+def load_profile_projection(path):
+    with np.load(path) as saved:
+        return {"method": str(saved["method"]), "components": saved["components"],
+                "sentiment_mean": float(saved["sentiment_mean"]), "sentiment_scale": float(saved["sentiment_scale"])}
+
+
+def projection_report(item_profiles, dims=(16, 32, 64, 128), methods=("pca", "random"), top_n=10, n_queries=500,
+                      sentiment_weight=1.0, seed=42):
+    """
+    Query speed and neighbour overlap of projected profiles against full-dimensional profiles (the full
+    embedding with the same weighted sentiment), for every projection method and dimension.
+
+    Args:
+        item_profiles (dict): Raw profiles of `build_item_profiles` (embedding followed by the sentiment).
+
+    Returns:
+        pandas.DataFrame: Per method and dimension: profile dimension, batched query latency (ms per query)
+        and mean overlap of the top_n neighbours with the full-dimensional ones.
+    """
+    business_ids = list(item_profiles.keys())
+    raw_profiles = np.array([item_profiles[business_id] for business_id in business_ids], dtype=np.float32)
+    embeddings, sentiments = raw_profiles[:, :-1], raw_profiles[:, -1]
+    rng = np.random.default_rng(seed)
+    queries = [business_ids[i] for i in rng.choice(len(business_ids), min(n_queries, len(business_ids)),
+                                                   replace=False)]
+
+    def run(profiles):
+        profile_components = build_profile_matrix(dict(zip(business_ids, profiles)))
+        business_index = pd.Index(business_ids)
+        tic = time.perf_counter()
+        neighbours = batch_recommend_similar_businesses(queries, profile_components, top_n=top_n,
+                                                        business_index=business_index)
+        return neighbours, (time.perf_counter() - tic) / len(queries) * 1000
+
+    full = fit_profile_projection(embeddings, sentiments, method="none", sentiment_weight=sentiment_weight)
+    reference, reference_ms = run(project_profiles(full, embeddings, sentiments))
+    report = [{"method": "full", "dim": embeddings.shape[1] + 1, "query_ms": reference_ms, f"overlap@{top_n}": 1.0}]
+    for method in methods:
+        for dim in dims:
+            profile_projection = fit_profile_projection(embeddings, sentiments, n_components=dim, method=method,
+                                                        sentiment_weight=sentiment_weight, seed=seed)
+            neighbours, query_ms = run(project_profiles(profile_projection, embeddings, sentiments))
+            overlap = np.mean([len(set(a) & set(b)) / max(len(b), 1) for a, b in zip(neighbours, reference)])
+            report.append({"method": method, "dim": profile_projection["components"].shape[1] + 1,
+                           "query_ms": query_ms, f"overlap@{top_n}": overlap})
+    return pd.DataFrame(report)
+
+
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Content-based recommendations and a profile projection report")
+    parser.add_argument("--dims", type=str, default="16,32,64,128",
+                        help="Comma-separated projected dimensions to compare against the full profiles")
+    parser.add_argument("--sentiment_weight", type=float, default=1.0,
+                        help="Spread of the sentiment feature relative to an average projected dimension")
+    args = parser.parse_args()
+
     # Load processed data using centralized paths
     business_csv = os.path.join(DATA_PROCESSED, "business_processed.csv")
     reviews_csv = os.path.join(DATA_PROCESSED, "reviews_processed.csv")
@@ -124,3 +346,8 @@ if __name__ == "__main__":
     recommendations = recommend_similar_businesses(sample_business_id, profiles, top_n=5)
     print(f"Content-Based Recommendations for business {sample_business_id}:")
     print(recommendations)
+
+    report = projection_report(profiles, dims=[int(dim) for dim in args.dims.split(",")],
+                               sentiment_weight=args.sentiment_weight)
+    print("Projected profiles vs. full profiles (batched queries, neighbour overlap):")
+    print(report.to_string(index=False, float_format=lambda value: f"{value:.4f}"))
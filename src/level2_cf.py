@@ -2,15 +2,79 @@ import numpy as np
 import pandas as pd
 from sklearn.metrics.pairwise import cosine_similarity
 
+from src.common.checkin_popularity import pad_with_fallback
+from src.common.instrumentation import traced
+from src.common.social_graph import social_neighbourhood
 
-def user_based_recommendations(user_id, matrix_components, top_n=5, num_similar=10):
+
+def predict_from_neighbours(sparse_matrix, target_vector, neighbour_indices, neighbour_sims, filter_rows=None):
+    """
+    Predict ratings for the items rated by the neighbours but not by the target user.
+
+    The prediction for an item is the similarity-weighted average of the ratings of the neighbours
+    who rated it. Items whose weights sum to zero get no prediction. If `filter_rows` (sorted item
+    columns, e.g. from `BusinessIndex.select`) is given, only those items are scored.
+
+    Returns:
+        tuple: (item indices, predicted ratings), both numpy arrays.
+    """
+    neighbour_ratings = sparse_matrix[np.asarray(neighbour_indices)]
+    candidate_indices = np.unique(neighbour_ratings.indices[neighbour_ratings.data > 0])
+    target_rated = target_vector.indices[target_vector.data > 0]
+    candidate_indices = candidate_indices[~np.isin(candidate_indices, target_rated)]
+    if filter_rows is not None:
+        candidate_indices = np.intersect1d(candidate_indices, filter_rows, assume_unique=True)
+
+    candidate_ratings = neighbour_ratings[:, candidate_indices]
+    numerator = candidate_ratings.T @ neighbour_sims
+    denominator = (candidate_ratings > 0).T @ neighbour_sims
+    valid = denominator > 0
+    return candidate_indices[valid], numerator[valid] / denominator[valid]
+
+
+def pool_neighbours(sparse_matrix, target_idx, pool, num_similar=10):
+    """
+    The `num_similar` users of `pool` (matrix rows, without the target) most cosine-similar to the
+    target, computed against the pool only instead of every user.
+
+    Returns:
+        tuple: (neighbour rows, similarities), both numpy arrays.
+    """
+    target_vector = sparse_matrix[target_idx]
+    pool_matrix = sparse_matrix[pool]
+    dots = np.asarray((pool_matrix @ target_vector.T).todense()).ravel()
+    pool_norms = np.sqrt(np.asarray(pool_matrix.multiply(pool_matrix).sum(axis=1)).ravel())
+    target_norm = np.sqrt(target_vector.multiply(target_vector).sum())
+    sim_scores = dots / np.maximum(pool_norms * target_norm, 1e-12)
+
+    top = np.argsort(-sim_scores, kind="stable")[:num_similar]
+    return pool[top], sim_scores[top]
+
+
+def top_predicted_items(item_indices, predictions, business_ids, top_n=5):
+    """Business IDs of the `top_n` highest predictions."""
+    order = np.argsort(-predictions, kind="stable")[:top_n]
+    return [business_ids[j] for j in item_indices[order]]
+
+
+@traced("level2.query", items=len)
+def user_based_recommendations(user_id, matrix_components, top_n=5, num_similar=10, fallback=None,
+                               filter_rows=None):
+    """
+    User-based CF over the cosine similarity of the target's rating row to every other user.
+
+    Args:
+        fallback (callable): Optional `fallback(n, exclude=...)` (e.g. `PopularityIndex.recommend`) that
+            answers unknown users and fills lists that come back shorter than `top_n` (very sparse users).
+        filter_rows (numpy.ndarray): Optional sorted item columns that may be recommended.
+    """
     sparse_matrix, user_ids, business_ids = matrix_components
 
     try:
         target_idx = user_ids.index(user_id)
     except ValueError:
         print("User ID not found in the matrix.")
-        return []
+        return pad_with_fallback([], fallback, top_n)
 
     # Compute cosine similarity for the target user row vs. all users.
     target_vector = sparse_matrix[target_idx]
@@ -19,30 +83,96 @@ def user_based_recommendations(user_id, matrix_components, top_n=5, num_similar=
 
     # Get indices of similar users, excluding the target user.
     similar_indices = sim_scores.argsort()[::-1]
-    similar_indices = [i for i in similar_indices if i != target_idx]
+    similar_indices = similar_indices[similar_indices != target_idx]
     top_similar_indices = similar_indices[:num_similar]
 
     # Candidate items: items rated by top similar users but not by the target user.
-    target_rated = set(np.where(target_vector.toarray().flatten() > 0)[0])
-    candidate_indices = set()
-    for i in top_similar_indices:
-        candidate_indices.update(np.where(sparse_matrix[i].toarray().flatten() > 0)[0])
-    candidate_indices = candidate_indices - target_rated
-
-    predicted_ratings = {}
-    for j in candidate_indices:
-        numerator = 0.0
-        denominator = 0.0
-        for i in top_similar_indices:
-            rating = sparse_matrix[i, j]
-            if rating > 0:
-                numerator += sim_scores[i] * rating
-                denominator += sim_scores[i]
-        if denominator > 0:
-            predicted_ratings[business_ids[j]] = numerator / denominator
-
-    recommended_items = sorted(predicted_ratings.items(), key=lambda x: x[1], reverse=True)[:top_n]
-    return [item for item, score in recommended_items]
+    item_indices, predictions = predict_from_neighbours(sparse_matrix, target_vector, top_similar_indices,
+                                                        sim_scores[top_similar_indices], filter_rows=filter_rows)
+    recommendations = top_predicted_items(item_indices, predictions, business_ids, top_n=top_n)
+    return pad_with_fallback(recommendations, fallback, top_n,
+                             exclude=[business_ids[j] for j in target_vector.indices])
+
+
+@traced("level2.batch_query", items=len)
+def batch_user_based_recommendations(user_id_batch, matrix_components, top_n=5, num_similar=10, user_norms=None,
+                                     user_index=None, fallback=None, filter_rows=None):
+    """
+    User-based CF for many users at once. The similarities of the whole batch against every user come
+    from one sparse matrix-matrix product, so the scan over the rating matrix is shared by the batch.
+
+    Args:
+        user_norms (numpy.ndarray): Optional precomputed L2 norm of every user row.
+        user_index (pandas.Index): Optional prebuilt index over user_ids.
+        fallback (callable): Optional `fallback(n, exclude=...)` for unknown and very sparse users.
+        filter_rows (numpy.ndarray): Optional sorted item columns that may be recommended.
+
+    Returns:
+        list of lists: Recommended business IDs per user, in input order (empty for unknown users
+        without a fallback).
+    """
+    sparse_matrix, user_ids, business_ids = matrix_components
+    user_index = user_index if user_index is not None else pd.Index(user_ids)
+    if user_norms is None:
+        user_norms = np.sqrt(np.asarray(sparse_matrix.multiply(sparse_matrix).sum(axis=1)).ravel())
+
+    positions = user_index.get_indexer(list(user_id_batch))
+    known = np.flatnonzero(positions >= 0)
+    results = [pad_with_fallback([], fallback, top_n) if position < 0 else [] for position in positions]
+    if len(known) == 0:
+        return results
+
+    targets = sparse_matrix[positions[known]]
+    # (n_users, batch) dot products; only users sharing a rated business with a target are stored.
+    dots = (sparse_matrix @ targets.T).tocsc()
+    for column, row in enumerate(known):
+        target_idx = positions[row]
+        start, stop = dots.indptr[column], dots.indptr[column + 1]
+        neighbours, neighbour_dots = dots.indices[start:stop], dots.data[start:stop]
+        keep = neighbours != target_idx
+        neighbours, neighbour_dots = neighbours[keep], neighbour_dots[keep]
+        sims = neighbour_dots / np.maximum(user_norms[neighbours] * user_norms[target_idx], 1e-12)
+        top = np.argsort(-sims, kind="stable")[:num_similar]
+        item_indices, predictions = predict_from_neighbours(sparse_matrix, targets[column], neighbours[top],
+                                                            sims[top], filter_rows=filter_rows)
+        recommendations = top_predicted_items(item_indices, predictions, business_ids, top_n=top_n)
+        results[row] = pad_with_fallback(recommendations, fallback, top_n,
+                                         exclude=[business_ids[j] for j in targets[column].indices])
+    return results
+
+
+@traced("level2.social_query", items=len)
+def social_recommendations(user_id, matrix_components, friend_matrix, top_n=5, num_similar=10, hops=2,
+                           fallback=None, filter_rows=None):
+    """
+    User-based CF whose neighbours are searched among the target's friends and friends of friends only
+    (see `social_neighbourhood`), instead of scanning every user. Scoring is the same as
+    `user_based_recommendations`, which is used for users without friends in the matrix.
+
+    Args:
+        friend_matrix (scipy.sparse.csr_matrix): Friend adjacency keyed on the matrix rows
+            (`src.common.social_graph.load_social_graph`).
+    """
+    sparse_matrix, user_ids, business_ids = matrix_components
+
+    try:
+        target_idx = user_ids.index(user_id)
+    except ValueError:
+        print("User ID not found in the matrix.")
+        return pad_with_fallback([], fallback, top_n)
+
+    pool = social_neighbourhood(target_idx, friend_matrix, hops=hops)
+    if len(pool) == 0:
+        return user_based_recommendations(user_id, matrix_components, top_n=top_n, num_similar=num_similar,
+                                          fallback=fallback, filter_rows=filter_rows)
+
+    target_vector = sparse_matrix[target_idx]
+    neighbour_indices, neighbour_sims = pool_neighbours(sparse_matrix, target_idx, pool, num_similar)
+    item_indices, predictions = predict_from_neighbours(sparse_matrix, target_vector, neighbour_indices,
+                                                        neighbour_sims, filter_rows=filter_rows)
+    recommendations = top_predicted_items(item_indices, predictions, business_ids, top_n=top_n)
+    return pad_with_fallback(recommendations, fallback, top_n,
+                             exclude=[business_ids[j] for j in target_vector.indices])
 
 
 if __name__ == "__main__":
@@ -59,3 +189,10 @@ if __name__ == "__main__":
     recommendations = user_based_recommendations(sample_user_id, matrix_components, top_n=5)
     print(f"Collaborative Filtering Recommendations for user {sample_user_id}:")
     print(recommendations)
+
+    from src.common.social_graph import load_social_graph
+
+    friend_matrix = load_social_graph(DATA_PROCESSED + "/user_processed.csv", user_ids)
+    recommendations = social_recommendations(sample_user_id, matrix_components, friend_matrix, top_n=5)
+    print(f"Social Collaborative Filtering Recommendations for user {sample_user_id}:")
+    print(recommendations)
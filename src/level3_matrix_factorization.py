@@ -1,13 +1,21 @@
 import os
+import pickle
+import time
 
 import numpy as np
 import pandas as pd
+import scipy.linalg
 from sklearn.decomposition import TruncatedSVD
+from sklearn.utils.extmath import randomized_svd
 
-from src.common.cache import cache_results
+from src.common.cache import cache_results, get_cache_dir
+from src.common.checkin_popularity import pad_with_fallback
+from src.common.evaluation import split_holdout
+from src.common.instrumentation import span, traced
 
 
-@cache_results("svd_model_cache.pkl", force_recompute=False)
+@cache_results("svd_model_cache_{n_factors}.pkl", force_recompute=False)
+@traced("level3.train_svd")
 def train_svd(sparse_matrix, n_factors=20):
     """
     Train SVD on the sparse user-item matrix and cache the model along with factor matrices.
@@ -21,12 +29,16 @@ def train_svd(sparse_matrix, n_factors=20):
     return svd, U, Vt
 
 
-def matrix_factorization_recommendations(user_id, matrix_components, svd_model_components, top_n=5):
+@traced("level3.query", items=len)
+def matrix_factorization_recommendations(user_id, matrix_components, svd_model_components, top_n=5,
+                                         fallback=None, filter_rows=None):
     """
     Recommend items for a given user using the SVD model.
 
     For the target user, it computes predicted ratings from the SVD factors, excludes items already rated,
-    and returns the top_n items with the highest predicted ratings.
+    and returns the top_n items with the highest predicted ratings. Unknown users are answered by
+    `fallback(n, exclude=...)` (e.g. `PopularityIndex.recommend`) if one is given. If `filter_rows`
+    (sorted item columns, e.g. from `BusinessIndex.select`) is given, only those columns of Vt are scored.
     """
     sparse_matrix, user_ids, business_ids = matrix_components
     svd, U, Vt = svd_model_components
@@ -35,51 +47,374 @@ def matrix_factorization_recommendations(user_id, matrix_components, svd_model_c
         target_idx = user_ids.index(user_id)
     except ValueError:
         print("User ID not found.")
-        return []
+        return pad_with_fallback([], fallback, top_n)
 
-    # Compute predicted ratings for the target user
-    predicted_ratings = np.dot(U[target_idx], Vt)
     # Retrieve the target user's actual ratings from the sparse matrix
     target_ratings = sparse_matrix[target_idx].toarray().flatten()
     # Only consider items that the target user hasn't rated
     candidate_indices = np.where(target_ratings == 0)[0]
-    candidate_predictions = predicted_ratings[candidate_indices]
+    if filter_rows is None:
+        # Compute predicted ratings for the target user
+        candidate_predictions = np.dot(U[target_idx], Vt)[candidate_indices]
+    else:
+        # Score only the unrated items that pass the filter
+        candidate_indices = np.intersect1d(candidate_indices, filter_rows, assume_unique=True)
+        candidate_predictions = np.dot(U[target_idx], Vt[:, candidate_indices])
     # Get the indices of the top predicted items
     top_candidate_indices = candidate_indices[np.argsort(candidate_predictions)[::-1][:top_n]]
     recommended_items = [business_ids[i] for i in top_candidate_indices]
-    return recommended_items
+    return pad_with_fallback(recommended_items, fallback, top_n,
+                             exclude=[business_ids[j] for j in sparse_matrix[target_idx].indices])
 
 
-if __name__ == "__main__":
-    # Load the processed ratings file
-    ratings_csv = os.path.join(DATA_PROCESSED, "ratings_processed.csv")
-    ratings_df = pd.read_csv(ratings_csv)
+def top_unrated_items(scores, rated_rows, top_n=5):
+    """
+    Indices of the `top_n` highest scores per row of a (batch, n_items) score block, skipping the items
+    rated in the matching row of `rated_rows`. Rows may come back shorter if too few items are left.
 
-    # Build the sparse user-item matrix
-    sparse_matrix, user_ids, business_ids = build_user_item_matrix_sparse(ratings_df)
-    sample_user_id = user_ids[0]
+    Returns:
+        list of numpy.ndarray: Item indices per row, best first.
+    """
+    rows, cols = rated_rows.nonzero()
+    scores[rows, cols] = -np.inf
+    n = min(top_n, scores.shape[1])
+    top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    return [row[np.isfinite(row_scores[row])] for row, row_scores in zip(top, scores)]
 
-    # Train the SVD model on the sparse matrix (caching is applied)
-    svd_model, U, Vt = train_svd(sparse_matrix, n_factors=20)
 
-    # Generate recommendations for the sample user
-    recommendations = matrix_factorization_recommendations(sample_user_id, sparse_matrix, U, Vt, user_ids, business_ids,
-                                                           top_n=5)
-    print(f"Matrix Factorization Recommendations for user {sample_user_id}:")
-    print(recommendations)
+@traced("level3.batch_query", items=len)
+def batch_matrix_factorization_recommendations(user_id_batch, matrix_components, svd_model_components, top_n=5,
+                                               user_index=None, fallback=None, filter_rows=None):
+    """
+    Recommend items for many users at once: one matrix-matrix product of their factors with Vt and a
+    batched argpartition, instead of one matrix-vector product per user.
+
+    Args:
+        user_index (pandas.Index): Optional prebuilt index over user_ids (saves rebuilding it per batch).
+        fallback (callable): Optional `fallback(n, exclude=...)` for unknown users and users with fewer
+            than `top_n` results.
+        filter_rows (numpy.ndarray): Optional sorted item columns that may be recommended; the product only
+            covers those columns of Vt.
+
+    Returns:
+        list of lists: Recommended business IDs per user, in input order (empty for unknown users
+        without a fallback).
+    """
+    sparse_matrix, user_ids, business_ids = matrix_components
+    svd, U, Vt = svd_model_components
+    user_index = user_index if user_index is not None else pd.Index(user_ids)
+
+    positions = user_index.get_indexer(list(user_id_batch))
+    known = np.flatnonzero(positions >= 0)
+    results = [pad_with_fallback([], fallback, top_n) if position < 0 else [] for position in positions]
+    if len(known):
+        if filter_rows is None:
+            scores = U[positions[known]] @ Vt
+            top = top_unrated_items(scores, sparse_matrix[positions[known]], top_n=top_n)
+        else:
+            scores = U[positions[known]] @ Vt[:, filter_rows]
+            top = top_unrated_items(scores, sparse_matrix[positions[known]][:, filter_rows], top_n=top_n)
+            top = [filter_rows[item_indices] for item_indices in top]
+        targets = sparse_matrix[positions[known]]
+        for column, (row, item_indices) in enumerate(zip(known, top)):
+            # Users with fewer unrated (or filtered) candidates than top_n are padded like single queries.
+            rated = targets.indices[targets.indptr[column]:targets.indptr[column + 1]]
+            results[row] = pad_with_fallback([business_ids[i] for i in item_indices], fallback, top_n,
+                                             exclude=[business_ids[j] for j in rated])
+    return results
+
+
+##############################################
+# Factor Sweep
+##############################################
+@traced("level3.fit_svd_factors")
+def fit_svd_factors(sparse_matrix, max_factors, n_iter=5, seed=42):
+    """
+    One randomized SVD at rank `max_factors`, returned in the form `train_svd` uses (U scaled by the
+    singular values, Vt). The factors are ordered by decreasing singular value, so the first k columns
+    of U and the first k rows of Vt are the rank-k model: every smaller rank is a truncation, not a refit.
+
+    Returns:
+        tuple: (U matrix, Vt matrix)
+    """
+    U, sigma, Vt = randomized_svd(sparse_matrix, max_factors, n_iter=n_iter, random_state=seed)
+    return U * sigma, Vt
+
+
+def truncate_svd(svd_factors, n_factors):
+    """The rank-`n_factors` model of `fit_svd_factors` output as svd_model_components (no sklearn object)."""
+    U, Vt = svd_factors
+    return None, U[:, :n_factors], Vt[:n_factors]
+
+
+def held_out_ranks(scores, rated_rows, held_out):
+    """
+    Position of each row's held-out item among the items the row has not rated (0 is the top), from a
+    (batch, n_items) score block. Counting instead of sorting keeps every rank of the sweep one pass.
+    """
+    rows = np.arange(len(held_out))
+    held_scores = scores[rows, held_out]
+    better = (scores > held_scores[:, None]).sum(axis=1)
+    rated_r, rated_c = rated_rows.nonzero()
+    rated_better = scores[rated_r, rated_c] > held_scores[rated_r]
+    return better - np.bincount(rated_r[rated_better], minlength=len(held_out))
+
+
+@traced("level3.factor_sweep")
+def svd_factor_sweep(sparse_matrix, ranks=(5, 10, 20, 50, 100), top_n=10, holdout_fraction=0.1,
+                     max_eval_users=2000, n_latency_queries=200, chunk_size=256, seed=42):
+    """
+    Compare SVD ranks from a single decomposition instead of one `train_svd` fit per rank.
+
+    One rating per sampled user is held out and one randomized SVD is fit at the largest rank on the
+    rest. The held-out users are then scored in chunks, adding the next block of factors to the score
+    matrix as the rank grows (U[:, a:b] @ Vt[a:b]), so every rank is evaluated in the same pass.
+
+    Args:
+        ranks (iterable): Numbers of factors to compare.
+        top_n (int): Cutoff for hit rate and NDCG.
+        max_eval_users (int): Cap on the number of held-out users scored.
+        n_latency_queries (int): Single-user queries timed per rank.
+
+    Returns:
+        pandas.DataFrame: Per rank: hit_rate and ndcg at top_n, median held-out rank, mean query latency
+        (ms) and the memory of the U and Vt factors (MB).
+    """
+    ranks = sorted(set(ranks))
+    train, users, items = split_holdout(sparse_matrix, holdout_fraction=holdout_fraction, seed=seed)
+    if len(users) > max_eval_users:
+        keep = np.random.default_rng(seed).choice(len(users), max_eval_users, replace=False)
+        users, items = users[keep], items[keep]
+    U, Vt = fit_svd_factors(train, ranks[-1], seed=seed)
+
+    positions = np.empty((len(ranks), len(users)), dtype=np.int64)
+    bounds = list(zip([0] + ranks[:-1], ranks))
+    with span("level3.sweep_score", items=len(users) * len(ranks)):
+        for start in range(0, len(users), chunk_size):
+            rows, held_out = users[start:start + chunk_size], items[start:start + chunk_size]
+            rated_rows = train[rows]
+            scores = np.zeros((len(rows), Vt.shape[1]))
+            for r, (low, high) in enumerate(bounds):
+                scores += U[rows, low:high] @ Vt[low:high]
+                positions[r, start:start + chunk_size] = held_out_ranks(scores, rated_rows, held_out)
+
+    report = []
+    latency_users = users[:n_latency_queries]
+    for r, n_factors in enumerate(ranks):
+        _, U_k, Vt_k = truncate_svd((U, Vt), n_factors)
+        hits = positions[r] < top_n
+        tic = time.perf_counter()
+        for row in latency_users:
+            top_unrated_items(U_k[row:row + 1] @ Vt_k, train[row:row + 1], top_n=top_n)
+        latency = (time.perf_counter() - tic) / max(len(latency_users), 1)
+        report.append({
+            "n_factors": n_factors,
+            f"hit_rate@{top_n}": hits.mean(),
+            f"ndcg@{top_n}": np.where(hits, 1.0 / np.log2(positions[r] + 2), 0.0).mean(),
+            "median_rank": float(np.median(positions[r])),
+            "latency_ms": latency * 1000,
+            "memory_mb": (U_k.nbytes + Vt_k.nbytes) / 2 ** 20,
+        })
+    return pd.DataFrame(report)
+
+
+##############################################
+# Warm-Started Retraining
+##############################################
+def align_factors(previous_Vt, previous_business_ids, business_ids):
+    """Previous Vt columns in the column order of the new matrix; businesses that are new get zero columns."""
+    positions = pd.Index(previous_business_ids).get_indexer(business_ids)
+    known = positions >= 0
+    aligned = np.zeros((previous_Vt.shape[0], len(business_ids)))
+    aligned[:, known] = previous_Vt[:, positions[known]]
+    return aligned
+
+
+def subspace_angle(Vt_a, Vt_b):
+    """Largest principal angle (degrees) between the row spaces of two orthonormal factor matrices."""
+    cosines = np.linalg.svd(Vt_a @ Vt_b.T, compute_uv=False)
+    return float(np.degrees(np.arccos(np.clip(cosines.min(), -1.0, 1.0))))
+
+
+@traced("level3.subspace_iteration")
+def subspace_iteration_svd(sparse_matrix, n_factors=20, start=None, n_oversamples=10, max_iter=30, tol=1e-4,
+                           seed=42):
+    """
+    Truncated SVD by block power (subspace) iteration on the item side, optionally seeded with a previous
+    solution.
+
+    Every iteration projects the ratings on an orthonormal block of item vectors Q (Y = A Q), solves the
+    small Rayleigh-Ritz problem on Y^T Y for the singular values and vectors within that block, and takes
+    one power step (A^T Y) to get the next block. Only the item-side block is orthonormalized, so no
+    factorization of a users-sized matrix is needed. The iteration stops once no top-`n_factors` singular
+    value changed by more than `tol` relative to the largest one. A random start needs many iterations;
+    a start close to the answer, such as the previous Vt, needs a few.
+
+    Args:
+        start (numpy.ndarray): (n_start, n_items) rows spanning the start subspace, e.g. an aligned previous Vt;
+            it is padded with random rows up to n_factors + n_oversamples. None starts from random rows.
+
+    Returns:
+        tuple: (U matrix scaled by the singular values, Vt matrix, number of iterations)
+    """
+    rng = np.random.default_rng(seed)
+    block_size = min(n_factors + n_oversamples, min(sparse_matrix.shape))
+    start = np.empty((0, sparse_matrix.shape[1])) if start is None else np.asarray(start)[:block_size]
+    padding = rng.standard_normal((block_size - len(start), sparse_matrix.shape[1]))
+    Q, _ = scipy.linalg.qr(np.vstack([start, padding]).T, mode="economic")
+
+    previous_sigma = None
+    for iteration in range(1, max_iter + 1):
+        Y = sparse_matrix @ Q
+        eigenvalues, W = np.linalg.eigh(Y.T @ Y)
+        W = W[:, ::-1]
+        sigma = np.sqrt(np.maximum(eigenvalues[::-1], 0.0))
+        converged = (previous_sigma is not None
+                     and np.max(np.abs(sigma[:n_factors] - previous_sigma)) <= tol * sigma[0])
+        previous_sigma = sigma[:n_factors]
+        if converged or iteration == max_iter:
+            break
+        Q, _ = scipy.linalg.qr(sparse_matrix.T @ (Y @ W), mode="economic")
+    # Y W = A Q W: U scaled by the singular values, like TruncatedSVD.fit_transform.
+    return Y @ W[:, :n_factors], (Q @ W[:, :n_factors]).T, iteration
+
+
+@traced("level3.retrain_svd")
+def retrain_svd(matrix_components, previous_factors, n_factors=20, max_iter=30, tol=1e-4):
+    """
+    Retrain the SVD after new ratings arrived, starting from the previous factors instead of a random init.
+
+    The previous Vt is aligned to the new business order (new businesses start at zero and are picked up
+    by the oversampling rows and the first multiplication with the new ratings). Every call retrains, and
+    the result overwrites the cache file of `train_svd`, so later `train_svd` calls load the retrained model.
+
+    Args:
+        previous_factors (tuple): (Vt matrix, business_ids list) of the previous model.
+
+    Returns:
+        tuple: (None, U matrix, Vt matrix), as svd_model_components without the sklearn object.
+    """
+    sparse_matrix, user_ids, business_ids = matrix_components
+    previous_Vt, previous_business_ids = previous_factors
+    start = align_factors(previous_Vt, previous_business_ids, business_ids)
+    U, Vt, n_iterations = subspace_iteration_svd(sparse_matrix, n_factors=n_factors, start=start,
+                                                 max_iter=max_iter, tol=tol)
+    print(f"Warm-started SVD converged in {n_iterations} iterations")
+
+    cache_path = os.path.join(get_cache_dir(), f"svd_model_cache_{n_factors}.pkl")
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(tmp_path, "wb") as f:
+        pickle.dump((None, U, Vt), f)
+    os.replace(tmp_path, cache_path)
+    return None, U, Vt
+
+
+def save_svd_factors(path, Vt, business_ids):
+    """Keep the Vt of a trained model with its business order, as the start of the next `retrain_svd`."""
+    tmp_path = f"{path}.tmp-{os.getpid()}.npz"
+    np.savez(tmp_path, Vt=Vt, business_ids=np.asarray(business_ids, dtype=str))
+    os.replace(tmp_path, path)
+
+
+def load_svd_factors(path):
+    with np.load(path) as saved:
+        return saved["Vt"], saved["business_ids"].tolist()
+
+
+def explained_energy(sparse_matrix, U):
+    """Share of the squared Frobenius norm of the ratings captured by a model whose U is A @ V."""
+    return float(np.sum(U ** 2) / sparse_matrix.multiply(sparse_matrix).sum())
+
+
+def warm_start_report(matrix_components, fractions=(0.6, 0.7, 0.8, 0.9, 1.0), n_factors=20, tol=1e-4):
+    """
+    Simulate a growing ratings matrix and compare retraining from scratch with warm-started retraining.
+
+    Step i uses the first `fractions[i]` of the users and businesses (IDs are numbered in order of first
+    appearance, so later rows and columns are the newer users and businesses). At every step after the
+    first, the model is retrained three ways: a cold `TruncatedSVD` fit, cold subspace iteration from a
+    random start, and subspace iteration warm-started from the previous step's warm model.
+
+    Returns:
+        pandas.DataFrame: Per step: matrix size, seconds and iterations per method, the largest principal
+        angle between warm and cold Vt, relative singular value error and explained energy of both fits.
+    """
+    sparse_matrix, user_ids, business_ids = matrix_components
+    report, previous = [], None
+    for fraction in fractions:
+        n_users = max(1, int(sparse_matrix.shape[0] * fraction))
+        n_items = max(1, int(sparse_matrix.shape[1] * fraction))
+        step_matrix = sparse_matrix[:n_users, :n_items].tocsr()
+        step_business_ids = business_ids[:n_items]
+
+        tic = time.perf_counter()
+        _, U_cold, Vt_cold = train_svd.__wrapped__(step_matrix, n_factors=n_factors)
+        cold_seconds = time.perf_counter() - tic
+        if previous is None:
+            previous = (Vt_cold, step_business_ids)
+            continue
+
+        tic = time.perf_counter()
+        _, _, random_iterations = subspace_iteration_svd(step_matrix, n_factors=n_factors, tol=tol)
+        random_seconds = time.perf_counter() - tic
+        tic = time.perf_counter()
+        start = align_factors(*previous, step_business_ids)
+        U_warm, Vt_warm, warm_iterations = subspace_iteration_svd(step_matrix, n_factors=n_factors, start=start,
+                                                                  tol=tol)
+        warm_seconds = time.perf_counter() - tic
+        previous = (Vt_warm, step_business_ids)
+
+        sigma_cold = np.linalg.norm(U_cold, axis=0)
+        sigma_warm = np.linalg.norm(U_warm, axis=0)
+        report.append({
+            "users": n_users,
+            "items": n_items,
+            "nnz": step_matrix.nnz,
+            "cold_s": cold_seconds,
+            "random_start_s": random_seconds,
+            "random_start_iter": random_iterations,
+            "warm_s": warm_seconds,
+            "warm_iter": warm_iterations,
+            "angle_deg": subspace_angle(Vt_warm, Vt_cold),
+            "sigma_rel_err": float(np.max(np.abs(np.sort(sigma_warm) - np.sort(sigma_cold)) / sigma_cold.max())),
+            "energy_cold": explained_energy(step_matrix, U_cold),
+            "energy_warm": explained_energy(step_matrix, U_warm),
+        })
+    return pd.DataFrame(report)
+
 
 if __name__ == "__main__":
+    import argparse
+
+    from src.common.user_item_matrix_components import load_user_item_matrix_components
     from util.paths import DATA_PROCESSED
-    from src.common.user_item_matrix_components import build_user_item_matrix_components
 
-    ratings_csv = os.path.join(DATA_PROCESSED, "ratings_processed.csv")
-    ratings_df = pd.read_csv(ratings_csv)
-    matrix_components = build_user_item_matrix_components(ratings_df)
+    parser = argparse.ArgumentParser(description="SVD recommendations and a single-fit sweep over n_factors")
+    parser.add_argument("--ranks", type=str, default="5,10,20,50,100",
+                        help="Comma-separated numbers of factors to compare")
+    parser.add_argument("--top_n", type=int, default=10, help="Cutoff for hit rate and NDCG")
+    parser.add_argument("--growth", type=str, default=None,
+                        help="Comma-separated matrix fractions for the warm-start retraining report, e.g. 0.8,0.9,1.0")
+    args = parser.parse_args()
 
+    matrix_components = load_user_item_matrix_components(os.path.join(DATA_PROCESSED, "ratings_processed.csv"))
     sparse_matrix, user_ids, business_ids = matrix_components
 
     sample_user_id = user_ids[0]
-    svd_model, U, Vt = train_svd(sparse_matrix, n_factors=20)
-    recommendations = matrix_factorization_recommendations(sample_user_id, sparse_matrix, svd_model, U, Vt, top_n=5)
+    svd_model_components = train_svd(sparse_matrix, n_factors=20)
+    recommendations = matrix_factorization_recommendations(sample_user_id, matrix_components, svd_model_components,
+                                                           top_n=5)
     print(f"Matrix Factorization Recommendations for user {sample_user_id}:")
     print(recommendations)
+
+    report = svd_factor_sweep(sparse_matrix, ranks=[int(rank) for rank in args.ranks.split(",")], top_n=args.top_n)
+    print("Factor sweep (one decomposition, held-out rating per user):")
+    print(report.to_string(index=False, float_format=lambda value: f"{value:.4f}"))
+
+    if args.growth:
+        report = warm_start_report(matrix_components, fractions=[float(f) for f in args.growth.split(",")])
+        print("Retraining on a growing matrix (cold TruncatedSVD vs. warm-started subspace iteration):")
+        print(report.to_string(index=False, float_format=lambda value: f"{value:.4f}"))
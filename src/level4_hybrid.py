@@ -0,0 +1,281 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+import src.level3_matrix_factorization as l3
+from src.common.cache import cache_results
+from src.common.evaluation import split_holdout
+from src.common.instrumentation import span, traced
+
+FEATURES = ["svd", "cf", "content", "popularity"]
+
+
+##############################################
+# Offline Components
+##############################################
+def build_content_matrix(item_profiles, business_ids):
+    """
+    Stack the level1 item profiles in the column order of the user-item matrix and L2-normalize them,
+    so a dot product is a cosine similarity. Businesses without a profile get a zero row.
+    """
+    dim = len(next(iter(item_profiles.values())))
+    content_matrix = np.zeros((len(business_ids), dim), dtype=np.float32)
+    for idx, business_id in enumerate(business_ids):
+        vector = item_profiles.get(business_id)
+        if vector is not None:
+            content_matrix[idx] = vector
+    norms = np.linalg.norm(content_matrix, axis=1, keepdims=True)
+    return content_matrix / np.maximum(norms, 1e-12)
+
+
+@cache_results("content_neighbours_cache_{n_neighbours}.pkl", force_recompute=False)
+def build_content_neighbours(content_matrix, n_neighbours=50, batch_size=2048):
+    """
+    Precompute the `n_neighbours` most similar businesses of every business (int32 column indices),
+    so content candidates are a table lookup at query time instead of a scan over the catalog.
+    """
+    n_items = content_matrix.shape[0]
+    n_neighbours = min(n_neighbours, n_items - 1)
+    neighbours = np.empty((n_items, n_neighbours), dtype=np.int32)
+    for start in range(0, n_items, batch_size):
+        stop = min(start + batch_size, n_items)
+        sims = content_matrix[start:stop] @ content_matrix.T
+        sims[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+        top = np.argpartition(-sims, n_neighbours - 1, axis=1)[:, :n_neighbours]
+        order = np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1)
+        neighbours[start:stop] = np.take_along_axis(top, order, axis=1)
+    return neighbours
+
+
+def build_hybrid_components(matrix_components, item_profiles, n_content_neighbours=50):
+    """
+    Assemble everything the hybrid recommender needs besides the SVD factors.
+
+    Returns:
+        dict: item_user_matrix (CSC view of the ratings as CSR over items), user_norms, popularity
+        (log rating count per business), content_matrix and content_neighbours.
+    """
+    sparse_matrix, user_ids, business_ids = matrix_components
+    content_matrix = build_content_matrix(item_profiles, business_ids)
+    return {
+        "item_user_matrix": sparse_matrix.T.tocsr(),
+        "user_norms": np.sqrt(np.asarray(sparse_matrix.multiply(sparse_matrix).sum(axis=1)).ravel()),
+        "popularity": np.log1p(np.bincount(sparse_matrix.indices, minlength=len(business_ids))).astype(np.float32),
+        "content_matrix": content_matrix,
+        "content_neighbours": build_content_neighbours(content_matrix, n_neighbours=n_content_neighbours),
+    }
+
+
+##############################################
+# Candidate Generation
+##############################################
+def svd_candidates(target_idx, svd_model_components, n_candidates):
+    """Top SVD scores for the user; one matrix-vector product and an argpartition."""
+    svd, U, Vt = svd_model_components
+    scores = U[target_idx] @ Vt
+    n_candidates = min(n_candidates, len(scores))
+    return np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+
+
+def find_neighbours(target_idx, sparse_matrix, hybrid_components, num_similar):
+    """
+    Cosine neighbours of the target user. Only users who co-rated one of the target's businesses can have
+    a non-zero similarity, so they are reached through the item side instead of scanning every user.
+
+    Returns:
+        tuple: (neighbour user indices, similarities)
+    """
+    target = sparse_matrix[target_idx]
+    dots = csr_matrix(target.data.reshape(1, -1)) @ hybrid_components["item_user_matrix"][target.indices]
+    keep = dots.indices != target_idx
+    candidates, dots = dots.indices[keep], dots.data[keep]
+    if len(candidates) == 0:
+        return candidates, np.empty(0)
+    user_norms = hybrid_components["user_norms"]
+    sims = dots / (user_norms[target_idx] * user_norms[candidates])
+    num_similar = min(num_similar, len(candidates))
+    top = np.argpartition(-sims, num_similar - 1)[:num_similar]
+    return candidates[top], sims[top]
+
+
+def cf_candidates(sparse_matrix, neighbours):
+    """Businesses rated by the neighbours."""
+    return np.unique(sparse_matrix[neighbours].indices)
+
+
+def recent_businesses(target_row, n_recent=5):
+    """
+    The user's `n_recent` highest-rated businesses. The ratings carry no timestamps,
+    so the best-rated ones stand in for the most recent.
+    """
+    order = np.argsort(-target_row.data, kind="stable")[:n_recent]
+    return target_row.indices[order]
+
+
+def content_candidates(target_row, hybrid_components, n_recent=5):
+    """Precomputed content neighbours of the user's recent businesses."""
+    return np.unique(hybrid_components["content_neighbours"][recent_businesses(target_row, n_recent)])
+
+
+##############################################
+# Reranking
+##############################################
+def candidate_features(target_idx, target_row, candidates, neighbours, neighbour_sims, sparse_matrix,
+                       svd_model_components, hybrid_components, n_recent=5):
+    """
+    Score the shortlist with every signal. Each column is z-scored within the shortlist so the blend
+    weights do not depend on the scale of the individual scores.
+
+    Returns:
+        numpy.ndarray: (len(candidates), len(FEATURES)) feature matrix.
+    """
+    svd, U, Vt = svd_model_components
+    svd_scores = U[target_idx] @ Vt[:, candidates]
+
+    if len(neighbours):
+        neighbour_ratings = sparse_matrix[neighbours][:, candidates]
+        cf_scores = (neighbour_sims @ neighbour_ratings) / max(neighbour_sims.sum(), 1e-12)
+    else:
+        cf_scores = np.zeros(len(candidates))
+
+    liked = recent_businesses(target_row, n_recent)
+    content_matrix = hybrid_components["content_matrix"]
+    if len(liked):
+        content_scores = (content_matrix[candidates] @ content_matrix[liked].T).max(axis=1)
+    else:
+        content_scores = np.zeros(len(candidates))
+
+    features = np.column_stack([svd_scores, np.ravel(cf_scores), content_scores,
+                                hybrid_components["popularity"][candidates]])
+    std = features.std(axis=0)
+    return (features - features.mean(axis=0)) / np.where(std > 0, std, 1.0)
+
+
+def hybrid_recommendations(user_id, matrix_components, svd_model_components, hybrid_components, weights,
+                           top_n=5, n_candidates=300, num_similar=20, n_recent=5, return_timings=False):
+    """
+    Recommend businesses by pulling candidates from SVD, user-based CF and content similarity,
+    merging them and reranking only the shortlist with a blended score.
+
+    Apart from the single SVD matrix-vector product, the per-request cost scales with the number of
+    candidates: CF neighbours are found through co-raters, content candidates are a lookup in the
+    precomputed neighbour table and only the shortlist is scored by every signal.
+
+    Args:
+        weights (numpy.ndarray): Blend weights from `fit_blend_weights` (one per feature plus intercept).
+        n_candidates (int): Candidates pulled from the SVD scores; CF and content add their own.
+        return_timings (bool): Also return the latency of every stage in milliseconds.
+
+    Returns:
+        list (and dict of stage timings if `return_timings`): Recommended business IDs.
+    """
+    sparse_matrix, user_ids, business_ids = matrix_components
+    timings = {}
+
+    try:
+        target_idx = user_ids.index(user_id)
+    except ValueError:
+        print("User ID not found.")
+        return ([], timings) if return_timings else []
+
+    target_row = sparse_matrix[target_idx]
+    with span("hybrid.candidates.svd") as s:
+        from_svd = svd_candidates(target_idx, svd_model_components, n_candidates)
+    timings["candidates_svd"] = s.wall * 1000
+    with span("hybrid.candidates.cf") as s:
+        neighbours, neighbour_sims = find_neighbours(target_idx, sparse_matrix, hybrid_components, num_similar)
+        from_cf = cf_candidates(sparse_matrix, neighbours)
+    timings["candidates_cf"] = s.wall * 1000
+    with span("hybrid.candidates.content") as s:
+        from_content = content_candidates(target_row, hybrid_components, n_recent=n_recent)
+    timings["candidates_content"] = s.wall * 1000
+
+    with span("hybrid.merge") as s:
+        candidates = np.unique(np.concatenate([from_svd, from_cf, from_content]).astype(np.int64))
+        candidates = candidates[~np.isin(candidates, target_row.indices)]
+        s.set_items(len(candidates))
+    timings["merge"] = s.wall * 1000
+
+    with span("hybrid.rerank", items=len(candidates)) as s:
+        if len(candidates):
+            features = candidate_features(target_idx, target_row, candidates, neighbours, neighbour_sims,
+                                          sparse_matrix, svd_model_components, hybrid_components, n_recent=n_recent)
+            scores = features @ weights[:-1] + weights[-1]
+            top = np.argsort(-scores)[:top_n]
+            recommended_items = [business_ids[i] for i in candidates[top]]
+        else:
+            recommended_items = []
+    timings["rerank"] = s.wall * 1000
+    timings["n_candidates"] = len(candidates)
+
+    return (recommended_items, timings) if return_timings else recommended_items
+
+
+##############################################
+# Offline Blend Weight Fitting
+##############################################
+@cache_results("hybrid_weights_cache_{n_factors}.pkl", force_recompute=False)
+@traced("level4.fit_blend_weights")
+def fit_blend_weights(matrix_components, item_profiles, n_factors=20, holdout_fraction=0.1, n_negatives=50,
+                      num_similar=20, n_recent=5, seed=42):
+    """
+    Fit the blend weights on a held-out slice of the ratings.
+
+    One rating per sampled user is hidden, the SVD and the CF/content components are rebuilt on the
+    remaining ratings, and a least-squares fit separates the held-out business (label 1) from
+    `n_negatives` random unrated businesses (label 0) using the same shortlist features as serving.
+
+    Returns:
+        numpy.ndarray: One weight per feature in FEATURES followed by the intercept.
+    """
+    sparse_matrix, user_ids, business_ids = matrix_components
+    rng = np.random.default_rng(seed)
+    train, users, items = split_holdout(sparse_matrix, holdout_fraction=holdout_fraction, seed=seed)
+    train_components = (train, user_ids, business_ids)
+    svd_model_components = l3.train_svd.__wrapped__(train, n_factors=n_factors)
+    hybrid_components = build_hybrid_components(train_components, item_profiles)
+    n_items = train.shape[1]
+
+    X, y = [], []
+    for target_idx, held_out in zip(users, items):
+        target_row = train[target_idx]
+        negatives = rng.integers(0, n_items, n_negatives)
+        negatives = negatives[~np.isin(negatives, sparse_matrix[target_idx].indices)]
+        candidates = np.concatenate([[held_out], negatives])
+        neighbours, neighbour_sims = find_neighbours(target_idx, train, hybrid_components, num_similar)
+        X.append(candidate_features(target_idx, target_row, candidates, neighbours, neighbour_sims,
+                                    train, svd_model_components, hybrid_components, n_recent=n_recent))
+        y.append(np.concatenate([[1.0], np.zeros(len(negatives))]))
+
+    X = np.vstack(X)
+    X = np.column_stack([X, np.ones(len(X))])
+    weights, *_ = np.linalg.lstsq(X, np.concatenate(y), rcond=None)
+    print("Hybrid blend weights: " + ", ".join(f"{name}={w:.4f}" for name, w in zip(FEATURES, weights)))
+    return weights
+
+
+if __name__ == "__main__":
+    import src.level1_content_based as l1
+    from src.common.user_item_matrix_components import build_user_item_matrix_components
+    from util.paths import DATA_PROCESSED
+
+    ratings_df = pd.read_csv(os.path.join(DATA_PROCESSED, "ratings_processed.csv"))
+    business_df = pd.read_csv(os.path.join(DATA_PROCESSED, "business_processed.csv"))
+    reviews_df = pd.read_csv(os.path.join(DATA_PROCESSED, "reviews_processed.csv"))
+
+    matrix_components = build_user_item_matrix_components(ratings_df)
+    profiles = l1.build_item_profiles(business_df, reviews_df)
+    svd_model_components = l3.train_svd(matrix_components[0], n_factors=20)
+    hybrid_components = build_hybrid_components(matrix_components, profiles)
+    weights = fit_blend_weights(matrix_components, profiles, n_factors=20)
+
+    sample_user_id = matrix_components[1][0]
+    tic = time.perf_counter()
+    recommendations, timings = hybrid_recommendations(sample_user_id, matrix_components, svd_model_components,
+                                                      hybrid_components, weights, top_n=5, return_timings=True)
+    print(f"Hybrid Recommendations for user {sample_user_id}:")
+    print(recommendations)
+    print(f"Stage latencies (ms): {timings}, total {(time.perf_counter() - tic) * 1000:.2f} ms")
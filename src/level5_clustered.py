@@ -0,0 +1,236 @@
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import normalize
+
+import src.level2_cf as l2
+from src.common.cache import cache_results, get_cache_dir
+from src.common.instrumentation import span, traced
+
+
+##############################################
+# Clustering
+##############################################
+def user_representation(rows, features="svd", svd_model_components=None):
+    """
+    L2-normalized vectors the users are clustered on: their SVD factors or their rating rows.
+    Rating rows are projected into the SVD space with Vt, the same projection TruncatedSVD.transform uses.
+    """
+    if features == "svd":
+        svd, U, Vt = svd_model_components
+        return normalize(np.asarray(rows @ Vt.T))
+    return normalize(rows)
+
+
+def build_members(assignments, n_clusters):
+    """
+    Group users by cluster: `members[indptr[c]:indptr[c + 1]]` are the users of cluster c.
+    """
+    order = np.argsort(assignments, kind="stable").astype(np.int32)
+    indptr = np.searchsorted(assignments[order], np.arange(n_clusters + 1)).astype(np.int64)
+    return indptr, order
+
+
+def cluster_cache_name(n_clusters=100, features="svd", svd_model_components=None, **_):
+    """Cache file of `fit_user_clusters`; clusters on SVD factors are also keyed on the rank."""
+    if features == "svd":
+        return f"user_clusters_cache_{n_clusters}_svd{svd_model_components[2].shape[0]}.pkl"
+    return f"user_clusters_cache_{n_clusters}_{features}.pkl"
+
+
+@cache_results(cluster_cache_name, force_recompute=False)
+@traced("level5.fit_user_clusters")
+def fit_user_clusters(sparse_matrix, svd_model_components=None, n_clusters=100, features="svd",
+                      batch_size=4096, seed=42):
+    """
+    Spherical mini-batch k-means over the users.
+
+    The user vectors (SVD factors, or rating rows if `features="ratings"`) are L2-normalized before
+    clustering and the centroids afterwards, so nearest centroid means highest cosine similarity.
+
+    Returns:
+        dict: centroids, assignments (int32 cluster per user), indptr/members (users grouped by cluster),
+        features, n_clusters, Vt (the projection of the fit, None for rating features) and n_fitted
+        (users the centroids were fit on).
+    """
+    vectors = user_representation(sparse_matrix, features, svd_model_components)
+    n_clusters = min(n_clusters, sparse_matrix.shape[0])
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, random_state=seed, n_init=3)
+    assignments = kmeans.fit_predict(vectors).astype(np.int32)
+    indptr, members = build_members(assignments, n_clusters)
+    return {
+        "centroids": normalize(kmeans.cluster_centers_).astype(np.float32),
+        "assignments": assignments,
+        "indptr": indptr,
+        "members": members,
+        "features": features,
+        "n_clusters": n_clusters,
+        "Vt": np.asarray(svd_model_components[2], dtype=np.float32) if features == "svd" else None,
+        "n_fitted": sparse_matrix.shape[0],
+    }
+
+
+def save_cluster_components(cluster_components, cache_name):
+    """Persist (updated) cluster components, e.g. under `cluster_cache_name` where `fit_user_clusters` loads them."""
+    cache_path = os.path.join(get_cache_dir(), cache_name)
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(tmp_path, "wb") as f:
+        pickle.dump(cluster_components, f)
+    os.replace(tmp_path, cache_path)
+    print(f"Cluster assignments saved to {cache_path}")
+
+
+def load_cluster_components(cache_name):
+    """Cluster components saved by `save_cluster_components`, or None."""
+    cache_path = os.path.join(get_cache_dir(), cache_name)
+    if not os.path.exists(cache_path):
+        return None
+    with open(cache_path, "rb") as f:
+        return pickle.load(f)
+
+
+def assign_new_users(new_rows, cluster_components):
+    """
+    Fold users that were not part of the clustering into their nearest centroid, without refitting.
+
+    The new users get the next row indices after the clustered ones, so the matrix must only have grown:
+    existing users and businesses keep their rows and columns (as when ratings are appended to the file).
+    SVD features are projected through the Vt of the fit, so the centroids stay comparable after the SVD is
+    retrained; businesses added since the fit have no column in it and are ignored.
+
+    Args:
+        new_rows (scipy.sparse.csr_matrix): Rating rows of the new users (same or more columns than at the fit).
+
+    Returns:
+        dict: Updated cluster components.
+    """
+    Vt = cluster_components["Vt"]
+    if Vt is not None:
+        vectors = normalize(np.asarray(new_rows[:, :Vt.shape[1]] @ Vt.T))
+    else:
+        vectors = normalize(new_rows[:, :cluster_components["centroids"].shape[1]])
+    labels = np.asarray(vectors @ cluster_components["centroids"].T).argmax(axis=1).astype(np.int32)
+    assignments = np.concatenate([cluster_components["assignments"], labels])
+    indptr, members = build_members(assignments, cluster_components["n_clusters"])
+    return {**cluster_components, "assignments": assignments, "indptr": indptr, "members": members}
+
+
+def probe_clusters(target_idx, cluster_components, n_probe=2):
+    """The target's own cluster followed by the `n_probe - 1` clusters with the closest centroids."""
+    centroids = cluster_components["centroids"]
+    own = cluster_components["assignments"][target_idx]
+    if n_probe <= 1:
+        return np.array([own])
+    closeness = centroids @ centroids[own]
+    closeness[own] = np.inf
+    return np.argsort(-closeness)[:n_probe]
+
+
+##############################################
+# Recommendation
+##############################################
+@traced("level5.query", items=len)
+def clustered_recommendations(user_id, matrix_components, cluster_components, top_n=5, num_similar=10, n_probe=2):
+    """
+    User-based CF where the neighbour search only scans the target's cluster and the `n_probe - 1`
+    nearest clusters instead of every user. Scoring is the same as level2. Users of the matrix that the
+    clustering does not cover yet are folded in with `assign_new_users` (updating `cluster_components`).
+    """
+    sparse_matrix, user_ids, business_ids = matrix_components
+
+    try:
+        target_idx = user_ids.index(user_id)
+    except ValueError:
+        print("User ID not found in the matrix.")
+        return []
+
+    n_clustered = len(cluster_components["assignments"])
+    if target_idx >= n_clustered:
+        # Users added to the matrix after the clustering are folded in; the caller may persist the update.
+        cluster_components.update(assign_new_users(sparse_matrix[n_clustered:], cluster_components))
+        print(f"Assigned {sparse_matrix.shape[0] - n_clustered} new users to their nearest clusters")
+
+    indptr, members = cluster_components["indptr"], cluster_components["members"]
+    clusters = probe_clusters(target_idx, cluster_components, n_probe=n_probe)
+    pool = np.concatenate([members[indptr[c]:indptr[c + 1]] for c in clusters])
+    pool = pool[pool != target_idx]
+    if len(pool) == 0:
+        return []
+
+    neighbour_indices, neighbour_sims = l2.pool_neighbours(sparse_matrix, target_idx, pool, num_similar)
+    item_indices, predictions = l2.predict_from_neighbours(sparse_matrix, sparse_matrix[target_idx], neighbour_indices,
+                                                           neighbour_sims)
+    return l2.top_predicted_items(item_indices, predictions, business_ids, top_n=top_n)
+
+
+##############################################
+# Evaluation Against the Exhaustive Search
+##############################################
+def recall_speedup_report(matrix_components, cluster_components, n_users=100, top_n=10, num_similar=10,
+                          n_probe_values=(1, 2, 4), seed=42):
+    """
+    Compare clustered recommendations with the exhaustive level2 path on a sample of users.
+
+    Recall is the share of the exhaustive top-N that the clustered path also returns; speedup is the
+    ratio of the mean query latencies.
+
+    Returns:
+        pandas.DataFrame: One row per n_probe with recall@top_n, mean latencies and speedup.
+    """
+    sparse_matrix, user_ids, business_ids = matrix_components
+    rng = np.random.default_rng(seed)
+    rated = np.flatnonzero(np.diff(sparse_matrix.indptr) > 0)
+    sample = rng.choice(rated, size=min(n_users, len(rated)), replace=False)
+
+    exhaustive, exhaustive_time = {}, 0.0
+    for idx in sample:
+        with span("level5.report.exhaustive") as s:
+            exhaustive[idx] = set(l2.user_based_recommendations(user_ids[idx], matrix_components, top_n=top_n,
+                                                                num_similar=num_similar))
+        exhaustive_time += s.wall
+
+    rows = []
+    for n_probe in n_probe_values:
+        recalls, clustered_time = [], 0.0
+        for idx in sample:
+            tic = time.perf_counter()
+            recommended = clustered_recommendations(user_ids[idx], matrix_components, cluster_components,
+                                                    top_n=top_n, num_similar=num_similar, n_probe=n_probe)
+            clustered_time += time.perf_counter() - tic
+            if exhaustive[idx]:
+                recalls.append(len(exhaustive[idx] & set(recommended)) / len(exhaustive[idx]))
+        rows.append({
+            "n_probe": n_probe,
+            f"recall@{top_n}": float(np.mean(recalls)) if recalls else float("nan"),
+            "exhaustive_ms": exhaustive_time / len(sample) * 1000,
+            "clustered_ms": clustered_time / len(sample) * 1000,
+            "speedup": exhaustive_time / max(clustered_time, 1e-12),
+        })
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    import src.level3_matrix_factorization as l3
+    from src.common.user_item_matrix_components import build_user_item_matrix_components
+    from util.paths import DATA_PROCESSED
+
+    ratings_csv = os.path.join(DATA_PROCESSED, "ratings_processed.csv")
+    ratings_df = pd.read_csv(ratings_csv)
+    matrix_components = build_user_item_matrix_components(ratings_df)
+
+    sparse_matrix, user_ids, business_ids = matrix_components
+    svd_model_components = l3.train_svd(sparse_matrix, n_factors=20)
+    cluster_components = fit_user_clusters(sparse_matrix, svd_model_components, n_clusters=100)
+
+    sample_user_id = user_ids[0]
+    recommendations = clustered_recommendations(sample_user_id, matrix_components, cluster_components, top_n=5)
+    print(f"Clustered Recommendations for user {sample_user_id}:")
+    print(recommendations)
+
+    print("Recall vs. speedup against exhaustive user-based CF:")
+    print(recall_speedup_report(matrix_components, cluster_components).to_string(index=False))
@@ -0,0 +1,223 @@
+import os
+from collections import deque
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import bmat, csr_matrix, diags
+
+from src.common.instrumentation import span, traced
+
+
+##############################################
+# Graph Construction
+##############################################
+@traced("level6.build_graph")
+def build_bipartite_graph(sparse_matrix, friend_matrix=None, friend_weight=1.0, rating_weighted=True):
+    """
+    Build the random-walk transition matrix of the user-business graph.
+
+    Nodes 0..n_users-1 are users and n_users.. are businesses. Edges are the ratings (weighted by the
+    rating value if `rating_weighted`) plus, optionally, friend edges between users scaled by `friend_weight`
+    (`friend_matrix` from `src.common.social_graph.load_social_graph`).
+    The transition matrix is column-stochastic: column j holds the probabilities of stepping from node j.
+
+    Returns:
+        dict: transition (CSR), adjacency (CSR, symmetric), degree, n_users.
+    """
+    n_users, n_items = sparse_matrix.shape
+    ratings = sparse_matrix.astype(np.float32)
+    if not rating_weighted:
+        ratings.data[:] = 1.0
+    if friend_matrix is not None:
+        user_block = (friend_matrix * friend_weight).astype(np.float32)
+    else:
+        user_block = csr_matrix((n_users, n_users), dtype=np.float32)
+    adjacency = bmat([[user_block, ratings], [ratings.T, None]], format="csr")
+
+    degree = np.asarray(adjacency.sum(axis=0)).ravel()
+    inverse_degree = np.divide(1.0, degree, out=np.zeros_like(degree), where=degree > 0)
+    transition = (adjacency @ diags(inverse_degree.astype(np.float32))).tocsr()
+    return {"transition": transition, "adjacency": adjacency, "degree": degree, "n_users": n_users}
+
+
+##############################################
+# Batched Power Iteration
+##############################################
+@traced("level6.personalized_pagerank")
+def personalized_pagerank(graph, seed_nodes, restart=0.15, tol=1e-4, max_iter=50):
+    """
+    Random walk with restart for a block of seeds at once.
+
+    Every seed is one column of a dense block, so each iteration is a single sparse x dense-block product.
+    Columns whose L1 change drops below `tol` are frozen and dropped from the active block, and the loop
+    stops as soon as every column has converged.
+
+    Args:
+        seed_nodes (array-like): One graph node per column.
+
+    Returns:
+        numpy.ndarray: (n_nodes, len(seed_nodes)) visiting probabilities.
+    """
+    transition = graph["transition"]
+    n_nodes = transition.shape[0]
+    seed_nodes = np.asarray(seed_nodes)
+    n_seeds = len(seed_nodes)
+    scores = np.zeros((n_nodes, n_seeds), dtype=np.float32)
+
+    # Only the active (not yet converged) columns are kept in the block that gets multiplied.
+    active = np.arange(n_seeds)
+    block = np.zeros((n_nodes, n_seeds), dtype=np.float32)
+    block[seed_nodes, active] = 1.0
+    with span("level6.power_iteration", items=n_seeds) as s:
+        for iteration in range(1, max_iter + 1):
+            updated = transition @ block
+            updated *= 1.0 - restart
+            updated[seed_nodes[active], np.arange(len(active))] += restart
+            change = np.abs(updated - block).sum(axis=0)
+            block = updated
+            converged = change < tol
+            if converged.any():
+                scores[:, active[converged]] = block[:, converged]
+                active = active[~converged]
+                block = block[:, ~converged]
+                if len(active) == 0:
+                    break
+        scores[:, active] = block
+        s.set(iterations=iteration)
+    return scores
+
+
+def top_businesses(scores, user_indices, sparse_matrix, top_n=5):
+    """
+    Top-N businesses per column of a score block, skipping the businesses each user already rated.
+
+    Returns:
+        list of numpy.ndarray: Business column indices per user, best first.
+    """
+    n_users = sparse_matrix.shape[0]
+    business_scores = scores[n_users:]
+    results = []
+    for column, user_idx in enumerate(user_indices):
+        column_scores = business_scores[:, column].copy()
+        column_scores[sparse_matrix[user_idx].indices] = -np.inf
+        n = min(top_n, len(column_scores))
+        top = np.argpartition(-column_scores, n - 1)[:n]
+        top = top[np.argsort(-column_scores[top])]
+        results.append(top[np.isfinite(column_scores[top]) & (column_scores[top] > 0)])
+    return results
+
+
+def graph_recommendations_batch(user_id_batch, matrix_components, graph, top_n=5, batch_size=32, restart=0.15,
+                                tol=1e-4, max_iter=50):
+    """
+    Recommend businesses for many users, running the power iteration `batch_size` seeds at a time.
+    The dense block needs about n_nodes * batch_size * 4 bytes per copy (three copies are alive at once).
+
+    Returns:
+        dict: Mapping from user_id to recommended business IDs (empty for unknown users).
+    """
+    sparse_matrix, user_ids, business_ids = matrix_components
+    index = pd.Index(user_ids)
+    positions = index.get_indexer(list(user_id_batch))
+
+    recommendations = {user_id: [] for user_id, pos in zip(user_id_batch, positions) if pos < 0}
+    known = [(user_id, pos) for user_id, pos in zip(user_id_batch, positions) if pos >= 0]
+    for start in range(0, len(known), batch_size):
+        batch = known[start:start + batch_size]
+        user_indices = np.array([pos for _, pos in batch])
+        scores = personalized_pagerank(graph, user_indices, restart=restart, tol=tol, max_iter=max_iter)
+        for (user_id, _), top in zip(batch, top_businesses(scores, user_indices, sparse_matrix, top_n=top_n)):
+            recommendations[user_id] = [business_ids[j] for j in top]
+    return recommendations
+
+
+@traced("level6.query", items=len)
+def graph_recommendations(user_id, matrix_components, graph, top_n=5, restart=0.15, tol=1e-4, max_iter=50):
+    """Recommend businesses for one user with the exact (power iteration) random walk with restart."""
+    return graph_recommendations_batch([user_id], matrix_components, graph, top_n=top_n, restart=restart, tol=tol,
+                                       max_iter=max_iter)[user_id]
+
+
+##############################################
+# Push-Based Approximation
+##############################################
+def approximate_pagerank_push(graph, seed_node, restart=0.15, epsilon=1e-5):
+    """
+    Forward-push approximation of the random walk with restart from one seed (Andersen, Chung & Lang).
+
+    Residual mass is only pushed from nodes whose residual exceeds `epsilon` times their degree, so the
+    work is bounded by about 1 / (restart * epsilon) pushes and only touches the seed's neighbourhood.
+
+    Returns:
+        dict: Mapping from node to approximate visiting probability.
+    """
+    adjacency, degree = graph["adjacency"], graph["degree"]
+    indptr, indices, weights = adjacency.indptr, adjacency.indices, adjacency.data
+    estimate = {}
+    residual = {seed_node: 1.0}
+    queue = deque([seed_node])
+    queued = {seed_node}
+
+    while queue:
+        node = queue.popleft()
+        queued.discard(node)
+        mass = residual.pop(node, 0.0)
+        if degree[node] == 0:
+            estimate[node] = estimate.get(node, 0.0) + mass
+            continue
+        estimate[node] = estimate.get(node, 0.0) + restart * mass
+        spread = (1.0 - restart) * mass / degree[node]
+        for neighbour, weight in zip(indices[indptr[node]:indptr[node + 1]], weights[indptr[node]:indptr[node + 1]]):
+            neighbour = int(neighbour)
+            residual[neighbour] = residual.get(neighbour, 0.0) + spread * weight
+            if neighbour not in queued and residual[neighbour] > epsilon * degree[neighbour]:
+                queue.append(neighbour)
+                queued.add(neighbour)
+    return estimate
+
+
+@traced("level6.query_push", items=len)
+def graph_recommendations_push(user_id, matrix_components, graph, top_n=5, restart=0.15, epsilon=1e-5):
+    """Low-latency single-user recommendations from the push-based approximation."""
+    sparse_matrix, user_ids, business_ids = matrix_components
+
+    try:
+        target_idx = user_ids.index(user_id)
+    except ValueError:
+        print("User ID not found in the graph.")
+        return []
+
+    n_users = graph["n_users"]
+    rated = set(sparse_matrix[target_idx].indices.tolist())
+    estimate = approximate_pagerank_push(graph, target_idx, restart=restart, epsilon=epsilon)
+    candidates = [(node - n_users, score) for node, score in estimate.items()
+                  if node >= n_users and node - n_users not in rated]
+    candidates.sort(key=lambda x: x[1], reverse=True)
+    return [business_ids[j] for j, score in candidates[:top_n]]
+
+
+if __name__ == "__main__":
+    import time
+
+    from src.common.social_graph import load_social_graph
+    from src.common.user_item_matrix_components import build_user_item_matrix_components
+    from util.paths import DATA_PROCESSED
+
+    ratings_df = pd.read_csv(os.path.join(DATA_PROCESSED, "ratings_processed.csv"))
+    matrix_components = build_user_item_matrix_components(ratings_df)
+
+    sparse_matrix, user_ids, business_ids = matrix_components
+    friend_matrix = load_social_graph(os.path.join(DATA_PROCESSED, "user_processed.csv"), user_ids)
+    graph = build_bipartite_graph(sparse_matrix, friend_matrix=friend_matrix)
+
+    sample_user_id = user_ids[0]
+    tic = time.perf_counter()
+    exact = graph_recommendations(sample_user_id, matrix_components, graph, top_n=5)
+    exact_ms = (time.perf_counter() - tic) * 1000
+    tic = time.perf_counter()
+    approximate = graph_recommendations_push(sample_user_id, matrix_components, graph, top_n=5)
+    approximate_ms = (time.perf_counter() - tic) * 1000
+    print(f"Graph-Based Recommendations for user {sample_user_id} ({exact_ms:.1f} ms):")
+    print(exact)
+    print(f"Push-based approximation ({approximate_ms:.1f} ms):")
+    print(approximate)
@@ -1,5 +1,11 @@
 import argparse
+import asyncio
+import contextlib
+import functools
+import hashlib
 import os
+import sys
+import threading
 
 import pandas as pd
 
@@ -9,34 +15,246 @@ import src.level1_content_based as l1
 import src.level2_cf as l2
 # Import Level 3: Matrix Factorization functions
 import src.level3_matrix_factorization as l3
-from src.common.user_item_matrix_components import build_user_item_matrix_components
-from util.paths import DATA_PROCESSED, TEST_DATA_PROCESSED
+# Import Level 4: Hybrid functions
+import src.level4_hybrid as l4
+# Import Level 5: Clustered functions
+import src.level5_clustered as l5
+# Import Level 6: Graph-Based functions
+import src.level6_graph_based as l6
+from src.common.batch_scoring import open_result_writer, print_batch_summary, read_id_chunks, run_batch
+from src.common.business_index import load_business_index, parse_filter
+from src.common.cache import get_cache_dir
+from src.common.checkin_popularity import PopularityIndex, check_segment, load_checkin_times, parse_segment
+from src.common.data_preprocessing import preprocessing_stages
+from src.common.instrumentation import configure_tracing, profiled
+from src.common.micro_batching import MicroBatcher, ReloadingScorer, cf_batch_fn, content_batch_fn, online_cf_batch_fn, \
+    serve_requests, svd_batch_fn
+from src.common.model_store import current_pointer, publish_models
+from src.common.online_cf import OnlineCFState, consume_events, invalidate_rated, read_rating_events
+from src.common.partitioned_models import PartitionedModels, train_partitions
+from src.common.result_cache import artifact_version, recommendation_cache
+from src.common.social_graph import load_social_graph
+from src.common.stage_runner import Stage, run_stages
+from src.common.user_item_matrix_components import load_user_item_matrix_components
+from util.paths import BATCH_OUTPUT_DIR, DATA_PROCESSED, TEST_DATA_PROCESSED
+
+
+##############################################
+# Build Stages
+##############################################
+def build_matrix_stage(processed_dir):
+    matrix_components = load_user_item_matrix_components(os.path.join(processed_dir, "ratings_processed.csv"))
+    # Batch workers attach to the published copy (see run_batch_mode)
+    publish_models(matrix_components, name=shared_model_name("cf"))
+
+
+def train_svd_stage(processed_dir, n_factors=20):
+    """
+    Train the SVD, or retrain it warm-started from the factors of the previous build when the ratings
+    matrix changed (the previous Vt is kept next to the model cache as svd_factors_[N_FACTORS].npz).
+    """
+    matrix_components = load_user_item_matrix_components(os.path.join(processed_dir, "ratings_processed.csv"))
+    factors_path = os.path.join(get_cache_dir(), f"svd_factors_{n_factors}.npz")
+    if os.path.exists(factors_path):
+        _, U, Vt = l3.retrain_svd(matrix_components, l3.load_svd_factors(factors_path), n_factors=n_factors)
+    else:
+        _, U, Vt = l3.train_svd(matrix_components[0], n_factors=n_factors)
+    l3.save_svd_factors(factors_path, Vt, matrix_components[2])
+    publish_models(matrix_components, (None, U, Vt), name=shared_model_name("svd", n_factors))
 
 
-def run_preprocessing():
-    # Check if processed files exist; if not, run preprocessing
-    business_csv = os.path.join(processed_dir, "business_processed.csv")
+def aggregate_reviews_stage(processed_dir):
+    l1.aggregate_business_reviews(pd.read_csv(os.path.join(processed_dir, "reviews_processed.csv")))
+
+
+def sentiment_stage(processed_dir):
+    l1.calculate_business_sentiments(pd.read_csv(os.path.join(processed_dir, "reviews_processed.csv")))
+
+
+def users_digest(user_ids):
+    return hashlib.sha1("\n".join(user_ids).encode("utf8")).hexdigest()
+
+
+def fit_clusters_stage(processed_dir, n_factors=20, n_clusters=100, max_new_fraction=0.2):
+    """
+    Fit the user clusters, or fold the users added since the previous build into its centroids while the
+    earlier users kept their rows and the users added since the last full fit are at most `max_new_fraction`
+    of it. The previous clustering is kept as user_clusters_base_[N_CLUSTERS]_svd[N_FACTORS].pkl, because the
+    runner deletes the stale cache before the stage reruns.
+    """
     ratings_csv = os.path.join(processed_dir, "ratings_processed.csv")
-    reviews_csv = os.path.join(processed_dir, "reviews_processed.csv")
+    sparse_matrix, user_ids, _ = load_user_item_matrix_components(ratings_csv)
+    svd_model_components = l3.train_svd(sparse_matrix, n_factors=n_factors)
+    cache_name = l5.cluster_cache_name(n_clusters, svd_model_components=svd_model_components)
+    base_name = cache_name.replace("user_clusters_cache", "user_clusters_base")
+    base = l5.load_cluster_components(base_name)
+    if (base is not None and len(user_ids) - base["n_fitted"] <= max_new_fraction * base["n_fitted"]
+            and base["user_ids_digest"] == users_digest(user_ids[:len(base["assignments"])])):
+        cluster_components = l5.assign_new_users(sparse_matrix[len(base["assignments"]):], base)
+        print(f"Folded {len(user_ids) - len(base['assignments'])} new users into the previous clusters")
+        l5.save_cluster_components(cluster_components, cache_name)
+    else:
+        cluster_components = l5.fit_user_clusters(sparse_matrix, svd_model_components, n_clusters=n_clusters)
+    l5.save_cluster_components({**cluster_components, "user_ids_digest": users_digest(user_ids)}, base_name)
+
+
+def load_item_profiles(processed_dir):
+    business_df = pd.read_csv(os.path.join(processed_dir, "business_processed.csv"))
+    reviews_df = pd.read_csv(os.path.join(processed_dir, "reviews_processed.csv"))
+    return l1.build_item_profiles(business_df, reviews_df)
+
+
+def item_profiles_stage(processed_dir):
+    load_item_profiles(processed_dir)
+
+
+def projected_profiles_stage(processed_dir, profile_dim=64, profile_projection="pca"):
+    business_df = pd.read_csv(os.path.join(processed_dir, "business_processed.csv"))
+    reviews_df = pd.read_csv(os.path.join(processed_dir, "reviews_processed.csv"))
+    l1.build_item_profiles(business_df, reviews_df, n_components=profile_dim, projection=profile_projection)
+
 
-    processed_files = [business_csv, ratings_csv, reviews_csv]
-    missing_files = [f for f in processed_files if not os.path.exists(f)]
+def content_neighbours_stage(processed_dir, n_neighbours=50):
+    matrix_components = load_user_item_matrix_components(os.path.join(processed_dir, "ratings_processed.csv"))
+    content_matrix = l4.build_content_matrix(load_item_profiles(processed_dir), matrix_components[2])
+    l4.build_content_neighbours(content_matrix, n_neighbours=n_neighbours)
 
-    if missing_files:
-        print("Processed files missing. Running preprocessing steps...")
-        from src.common.data_preprocessing import preprocess_ratings, preprocess_reviews, preprocess_business, \
-            preprocess_checkin, preprocess_user
 
-        preprocess_business()
-        preprocess_reviews()
-        preprocess_ratings()
-        preprocess_user()
-        preprocess_checkin()
+def blend_weights_stage(processed_dir, n_factors=20):
+    matrix_components = load_user_item_matrix_components(os.path.join(processed_dir, "ratings_processed.csv"))
+    l4.fit_blend_weights(matrix_components, load_item_profiles(processed_dir), n_factors=n_factors)
+
+
+# Model stages each method needs before its query runs.
+METHOD_STAGES = {
+    "content": ["item_profiles"],
+    "cf": ["matrix"],
+    "svd": ["svd"],
+    "hybrid": ["svd", "item_profiles", "content_neighbours", "blend_weights"],
+    "clustered": ["svd", "clusters"],
+    "graph": ["matrix"],
+}
+
+
+def model_stages(n_factors=20, n_clusters=100, n_content_neighbours=50, profile_dim=None, profile_projection="pca"):
+    """
+    Matrix -> SVD -> user clusters and reviews -> sentiment/aggregation -> item profiles, as runner stages.
+    The hybrid's content neighbours and blend weights are rebuilt from the matrix and the item profiles,
+    and with a `profile_dim` the projected profiles (and their projection) from the item profiles.
+    """
+    cache_dir = get_cache_dir()
+    ratings_csv = os.path.join(processed_dir, "ratings_processed.csv")
+    reviews_csv = os.path.join(processed_dir, "reviews_processed.csv")
+    business_csv = os.path.join(processed_dir, "business_processed.csv")
+    matrix_meta = os.path.join(cache_dir, "user_item_matrix", "meta.json")
+    item_profiles = os.path.join(cache_dir, "item_profiles_cache.pkl")
+    sentiments = os.path.join(cache_dir, "business_sentiments_cache.pkl")
+    aggregated = os.path.join(cache_dir, "aggregated_reviews_cache.pkl")
+    svd_model = os.path.join(cache_dir, f"svd_model_cache_{n_factors}.pkl")
+    embeddings = os.path.join(cache_dir, "embeddings_cache.pkl")
+    kwargs = {"processed_dir": processed_dir}
+    stages = [
+        Stage("matrix", build_matrix_stage, [ratings_csv], [matrix_meta, current_pointer(shared_model_name("cf"))],
+              kwargs),
+        Stage("svd", train_svd_stage, [matrix_meta],
+              [svd_model, current_pointer(shared_model_name("svd", n_factors))], {**kwargs, "n_factors": n_factors}),
+        Stage("clusters", fit_clusters_stage, [matrix_meta, svd_model],
+              [os.path.join(cache_dir, f"user_clusters_cache_{n_clusters}_svd{n_factors}.pkl")],
+              {**kwargs, "n_factors": n_factors, "n_clusters": n_clusters}),
+        Stage("aggregate_reviews", aggregate_reviews_stage, [reviews_csv], [aggregated], kwargs),
+        Stage("sentiment", sentiment_stage, [reviews_csv], [sentiments], kwargs),
+        Stage("item_profiles", item_profiles_stage, [business_csv, reviews_csv, aggregated, sentiments],
+              [item_profiles, embeddings], kwargs),
+        Stage("content_neighbours", content_neighbours_stage, [matrix_meta, item_profiles],
+              [os.path.join(cache_dir, f"content_neighbours_cache_{n_content_neighbours}.pkl")],
+              {**kwargs, "n_neighbours": n_content_neighbours}),
+        Stage("blend_weights", blend_weights_stage, [matrix_meta, item_profiles],
+              [os.path.join(cache_dir, f"hybrid_weights_cache_{n_factors}.pkl")], {**kwargs, "n_factors": n_factors},
+              after=["content_neighbours"]),
+    ]
+    if profile_dim is not None:
+        projected = [os.path.join(cache_dir, l1.item_profiles_cache_name(profile_dim, profile_projection)),
+                     os.path.join(cache_dir, l1.profile_projection_cache_name(profile_dim, profile_projection))]
+        stages.append(Stage("projected_profiles", projected_profiles_stage, [item_profiles, embeddings], projected,
+                            {**kwargs, "profile_dim": profile_dim, "profile_projection": profile_projection}))
+    return stages
+
+
+def run_preprocessing(method, jobs=1, n_factors=20, n_clusters=100, testing=False, partition=None, profile_dim=None,
+                      profile_projection="pca"):
+    """
+    Bring the processed tables and the models `method` needs up to date, running independent stages
+    in parallel and skipping the ones whose outputs are newer than their inputs. Partitioned cf/svd
+    only needs the global matrix: the partition models are trained by `train_partitions`.
+    """
+    stages = preprocessing_stages(testing=testing) + model_stages(
+        n_factors=n_factors, n_clusters=n_clusters, profile_dim=profile_dim, profile_projection=profile_projection)
+    tables = ["subsample"] if testing else [stage.name for stage in stages if stage.name.startswith("preprocess_")]
+    models = ["matrix"] if partition and method in ("cf", "svd") else METHOD_STAGES[method]
+    if method == "content" and profile_dim is not None:
+        models = models + ["projected_profiles"]
+    run_stages(stages, targets=tables + models, jobs=jobs)
+
+
+def load_popularity_fallback(segment=None, allowed=None):
+    """
+    Time-decayed check-in popularity lookup for unknown or very sparse users, restricted to `segment`
+    ("state:PA" or "city:Philadelphia, PA") and to the business IDs in `allowed` if given. The index is
+    only built when the fallback is first needed. None if there is no check-in data.
+    """
+    checkin_csv = os.path.join(processed_dir, "checkin_processed.csv")
+    if not os.path.exists(checkin_csv):
+        return None
+    segment = parse_segment(segment) if segment else None
+    popularity_index = []
+
+    def fallback(n, exclude=None):
+        if not popularity_index:
+            business_df = pd.read_csv(os.path.join(processed_dir, "business_processed.csv"))
+            popularity_index.append(PopularityIndex(load_checkin_times(checkin_csv), business_df))
+        return popularity_index[0].recommend(n, segment=segment, exclude=exclude, allowed=allowed)
+
+    return fallback
+
+
+def select_businesses(business_ids, business_filter=None, cache_name="business_index"):
+    """
+    Positions in `business_ids` of the businesses matching a --filter expression (see `BusinessIndex`),
+    or None without a filter.
+    """
+    if not business_filter:
+        return None
+    index = load_business_index(os.path.join(processed_dir, "business_processed.csv"), business_ids,
+                                cache_name=cache_name)
+    filter_rows = index.select(business_filter)
+    print(f"Filter '{business_filter}' keeps {len(filter_rows)} of {len(business_ids)} businesses")
+    return filter_rows
+
+
+def filtered_fallback(segment, business_ids, filter_rows):
+    """Popularity fallback that only returns businesses passing the filter."""
+    allowed = None if filter_rows is None else {business_ids[i] for i in filter_rows}
+    return load_popularity_fallback(segment, allowed=allowed)
+
+
+def model_version(method, n_factors=20, segment=None, business_filter=None, profile_dim=None,
+                  profile_projection="pca"):
+    """
+    Result cache key of the model a method serves from: the version of its artifacts, plus the filter and
+    fallback segment so their results are kept apart from the unrestricted ones.
+    """
+    cache_dir = get_cache_dir()
+    if method == "content":
+        paths = [os.path.join(cache_dir, l1.item_profiles_cache_name(profile_dim, profile_projection))]
     else:
-        print("All processed files found. Skipping preprocessing.")
+        paths = [os.path.join(cache_dir, "user_item_matrix", "meta.json")]
+        if method == "svd":
+            paths.append(os.path.join(cache_dir, f"svd_model_cache_{n_factors}.pkl"))
+    options = [f"{name}={value}" for name, value in (("filter", business_filter), ("segment", segment)) if value]
+    return f"{artifact_version(*paths)}[{';'.join(options)}]" if options else artifact_version(*paths)
 
 
-def run_content_based(business_id=None, top_n=5):
+def run_content_based(business_id=None, top_n=5, business_filter=None, profile_dim=None, profile_projection="pca"):
     # Load preprocessed business metadata and reviews
     business_csv = os.path.join(processed_dir, "business_processed.csv")
     reviews_csv = os.path.join(processed_dir, "reviews_processed.csv")
@@ -49,8 +267,10 @@ def run_content_based(business_id=None, top_n=5):
         print(f"No business_id provided. Using default: {business_id}")
 
     print("Building item profiles using Content-Based Filtering...")
-    profiles = l1.build_item_profiles(business_df, reviews_df)
-    recommendations = l1.recommend_similar_businesses(business_id, profiles, top_n=top_n)
+    profiles = l1.build_item_profiles(business_df, reviews_df, n_components=profile_dim, projection=profile_projection)
+    filter_rows = select_businesses(list(profiles.keys()), business_filter, cache_name="business_index_profiles")
+    with profiled("content_query"):
+        recommendations = l1.recommend_similar_businesses(business_id, profiles, top_n=top_n, filter_rows=filter_rows)
 
     # Get business names for better readability
     business_csv = os.path.join(processed_dir, "business_processed.csv")
@@ -72,12 +292,11 @@ def run_content_based(business_id=None, top_n=5):
         print(f"{i}. {name}")
 
 
-def run_collaborative(user_id=None, top_n=5):
+def run_collaborative(user_id=None, top_n=5, segment=None, social=False, business_filter=None):
     # Load preprocessed ratings
     ratings_csv = os.path.join(processed_dir, "ratings_processed.csv")
 
-    ratings_df = pd.read_csv(ratings_csv)
-    matrix_components = build_user_item_matrix_components(ratings_df)
+    matrix_components = load_user_item_matrix_components(ratings_csv)
 
     sparse_matrix, user_ids, business_ids = matrix_components
 
@@ -85,11 +304,22 @@ def run_collaborative(user_id=None, top_n=5):
         user_id = user_ids[0]
         print(f"No user_id provided. Using default: {user_id}")
 
+    users_csv = os.path.join(processed_dir, "user_processed.csv")
+    filter_rows = select_businesses(business_ids, business_filter)
+    fallback = filtered_fallback(segment, business_ids, filter_rows)
     print("Generating Collaborative Filtering recommendations...")
-    recommendations = l2.user_based_recommendations(user_id, matrix_components, top_n=top_n)
+    if social:
+        # Neighbours are searched among friends and friends of friends only.
+        friend_matrix = load_social_graph(users_csv, user_ids)
+        with profiled("cf_social_query"):
+            recommendations = l2.social_recommendations(user_id, matrix_components, friend_matrix, top_n=top_n,
+                                                        fallback=fallback, filter_rows=filter_rows)
+    else:
+        with profiled("cf_query"):
+            recommendations = l2.user_based_recommendations(user_id, matrix_components, top_n=top_n,
+                                                            fallback=fallback, filter_rows=filter_rows)
 
     # Get user's name and business names for better readability
-    users_csv = os.path.join(processed_dir, "user_processed.csv")
     business_csv = os.path.join(processed_dir, "business_processed.csv")
     user_df = pd.read_csv(users_csv)
     business_df = pd.read_csv(business_csv)
@@ -110,12 +340,11 @@ def run_collaborative(user_id=None, top_n=5):
         print(f"{i}. {name}")
 
 
-def run_matrix_factorization(user_id=None, top_n=5, n_factors=20):
+def run_matrix_factorization(user_id=None, top_n=5, n_factors=20, segment=None, business_filter=None):
     # Load preprocessed ratings
     ratings_csv = os.path.join(processed_dir, "ratings_processed.csv")
 
-    ratings_df = pd.read_csv(ratings_csv)
-    matrix_components = build_user_item_matrix_components(ratings_df)
+    matrix_components = load_user_item_matrix_components(ratings_csv)
 
     sparse_matrix, user_ids, business_ids = matrix_components
 
@@ -125,9 +354,13 @@ def run_matrix_factorization(user_id=None, top_n=5, n_factors=20):
 
     print("Generating Matrix Factorization (SVD) recommendations...")
     svd_model_components = l3.train_svd(sparse_matrix, n_factors=n_factors)
+    filter_rows = select_businesses(business_ids, business_filter)
+    fallback = filtered_fallback(segment, business_ids, filter_rows)
 
-    recommendations = l3.matrix_factorization_recommendations(user_id, matrix_components, svd_model_components,
-                                                              top_n=top_n)
+    with profiled("svd_query"):
+        recommendations = l3.matrix_factorization_recommendations(user_id, matrix_components, svd_model_components,
+                                                                  top_n=top_n, fallback=fallback,
+                                                                  filter_rows=filter_rows)
 
     # Get user's name and business names for better readability
     users_csv = os.path.join(processed_dir, "user_processed.csv")
@@ -151,32 +384,430 @@ def run_matrix_factorization(user_id=None, top_n=5, n_factors=20):
         print(f"{i}. {name}")
 
 
+def run_hybrid(user_id=None, top_n=5, n_factors=20):
+    # Load preprocessed ratings, business metadata and reviews
+    ratings_csv = os.path.join(processed_dir, "ratings_processed.csv")
+    business_csv = os.path.join(processed_dir, "business_processed.csv")
+    reviews_csv = os.path.join(processed_dir, "reviews_processed.csv")
+
+    business_df = pd.read_csv(business_csv)
+    reviews_df = pd.read_csv(reviews_csv)
+    matrix_components = load_user_item_matrix_components(ratings_csv)
+
+    sparse_matrix, user_ids, business_ids = matrix_components
+
+    if user_id is None:
+        user_id = user_ids[0]
+        print(f"No user_id provided. Using default: {user_id}")
+
+    print("Generating Hybrid recommendations...")
+    profiles = l1.build_item_profiles(business_df, reviews_df)
+    svd_model_components = l3.train_svd(sparse_matrix, n_factors=n_factors)
+    hybrid_components = l4.build_hybrid_components(matrix_components, profiles)
+    weights = l4.fit_blend_weights(matrix_components, profiles, n_factors=n_factors)
+
+    with profiled("hybrid_query"):
+        recommendations, timings = l4.hybrid_recommendations(user_id, matrix_components, svd_model_components,
+                                                             hybrid_components, weights, top_n=top_n,
+                                                             return_timings=True)
+
+    # Get user's name and business names for better readability
+    users_csv = os.path.join(processed_dir, "user_processed.csv")
+    user_df = pd.read_csv(users_csv)
+
+    # Get user's name
+    user_name = user_df[user_df['user_id'] == user_id]['name'].iloc[0] if not user_df[
+        user_df['user_id'] == user_id].empty else "Unknown"
+
+    # Get business names for recommendations
+    business_names = []
+    for business_id in recommendations:
+        business_name = business_df[business_df['business_id'] == business_id]['name'].iloc[0] if not business_df[
+            business_df['business_id'] == business_id].empty else "Unknown"
+        business_names.append(f"{business_name}")
+
+    print(f"Hybrid Recommendations for user '{user_name}':")
+    for i, name in enumerate(business_names, 1):
+        print(f"{i}. {name}")
+    print(f"Hybrid stage latencies ({timings.pop('n_candidates', 0)} candidates): "
+          + ", ".join(f"{stage} {ms:.2f} ms" for stage, ms in timings.items()))
+
+
+def run_clustered(user_id=None, top_n=5, n_factors=20, n_clusters=100, n_probe=2):
+    # Load preprocessed ratings
+    ratings_csv = os.path.join(processed_dir, "ratings_processed.csv")
+
+    matrix_components = load_user_item_matrix_components(ratings_csv)
+
+    sparse_matrix, user_ids, business_ids = matrix_components
+
+    if user_id is None:
+        user_id = user_ids[0]
+        print(f"No user_id provided. Using default: {user_id}")
+
+    print("Generating Clustered Collaborative Filtering recommendations...")
+    svd_model_components = l3.train_svd(sparse_matrix, n_factors=n_factors)
+    cluster_components = l5.fit_user_clusters(sparse_matrix, svd_model_components, n_clusters=n_clusters)
+    n_clustered = len(cluster_components["assignments"])
+
+    with profiled("clustered_query"):
+        recommendations = l5.clustered_recommendations(user_id, matrix_components, cluster_components, top_n=top_n,
+                                                       n_probe=n_probe)
+    if len(cluster_components["assignments"]) > n_clustered:
+        # Keep the users folded in by the query, so the next run does not assign them again
+        l5.save_cluster_components(cluster_components, l5.cluster_cache_name(
+            n_clusters, svd_model_components=svd_model_components))
+
+    # Get user's name and business names for better readability
+    users_csv = os.path.join(processed_dir, "user_processed.csv")
+    business_csv = os.path.join(processed_dir, "business_processed.csv")
+    user_df = pd.read_csv(users_csv)
+    business_df = pd.read_csv(business_csv)
+
+    # Get user's name
+    user_name = user_df[user_df['user_id'] == user_id]['name'].iloc[0] if not user_df[
+        user_df['user_id'] == user_id].empty else "Unknown"
+
+    # Get business names for recommendations
+    business_names = []
+    for business_id in recommendations:
+        business_name = business_df[business_df['business_id'] == business_id]['name'].iloc[0] if not business_df[
+            business_df['business_id'] == business_id].empty else "Unknown"
+        business_names.append(f"{business_name}")
+
+    print(f"Clustered Collaborative Filtering Recommendations for user '{user_name}':")
+    for i, name in enumerate(business_names, 1):
+        print(f"{i}. {name}")
+
+
+def run_graph_based(user_id=None, top_n=5, approximate=False):
+    # Load preprocessed ratings and users (for the friend edges)
+    ratings_csv = os.path.join(processed_dir, "ratings_processed.csv")
+    users_csv = os.path.join(processed_dir, "user_processed.csv")
+
+    user_df = pd.read_csv(users_csv)
+    matrix_components = load_user_item_matrix_components(ratings_csv)
+
+    sparse_matrix, user_ids, business_ids = matrix_components
+
+    if user_id is None:
+        user_id = user_ids[0]
+        print(f"No user_id provided. Using default: {user_id}")
+
+    print("Generating Graph-Based (random walk with restart) recommendations...")
+    friend_matrix = load_social_graph(users_csv, user_ids)
+    graph = l6.build_bipartite_graph(sparse_matrix, friend_matrix=friend_matrix)
+
+    with profiled("graph_query"):
+        if approximate:
+            recommendations = l6.graph_recommendations_push(user_id, matrix_components, graph, top_n=top_n)
+        else:
+            recommendations = l6.graph_recommendations(user_id, matrix_components, graph, top_n=top_n)
+
+    # Get business names for better readability
+    business_csv = os.path.join(processed_dir, "business_processed.csv")
+    business_df = pd.read_csv(business_csv)
+
+    # Get user's name
+    user_name = user_df[user_df['user_id'] == user_id]['name'].iloc[0] if not user_df[
+        user_df['user_id'] == user_id].empty else "Unknown"
+
+    # Get business names for recommendations
+    business_names = []
+    for business_id in recommendations:
+        business_name = business_df[business_df['business_id'] == business_id]['name'].iloc[0] if not business_df[
+            business_df['business_id'] == business_id].empty else "Unknown"
+        business_names.append(f"{business_name}")
+
+    print(f"Graph-Based Recommendations for user '{user_name}':")
+    for i, name in enumerate(business_names, 1):
+        print(f"{i}. {name}")
+
+
+def run_partitioned(method, user_id=None, top_n=5, n_factors=20, level="state", cross_region="user",
+                    segment=None, jobs=1):
+    # Per-region models, trained in a process pool on the first run and loaded per partition on first use
+    ratings_csv = os.path.join(processed_dir, "ratings_processed.csv")
+    business_csv = os.path.join(processed_dir, "business_processed.csv")
+    train_partitions(ratings_csv, business_csv, level=level, n_factors=n_factors, jobs=jobs)
+    models = PartitionedModels(level=level, cross_region=None if cross_region == "none" else cross_region)
+
+    if user_id is None:
+        user_id = str(models.user_index[0])
+        print(f"No user_id provided. Using default: {user_id}")
+
+    # A --segment at the partition level (e.g. state:PA with --partition state) selects the partition.
+    region = None
+    if segment and parse_segment(segment)[0] == level:
+        label = parse_segment(segment)[1].lower()
+        region = next((name for name in models.manifest["regions"] if name.lower() == label), label)
+    print(f"Routing user {user_id} to partitions {models.route(user_id, region)}...")
+    with profiled(f"{method}_partitioned_query"):
+        recommendations = models.recommend(user_id, method=method, top_n=top_n, region=region,
+                                           fallback=load_popularity_fallback(segment))
+
+    # Get business names for better readability
+    business_df = pd.read_csv(business_csv)
+    business_names = business_df.drop_duplicates("business_id").set_index("business_id")["name"]
+    print(f"Partitioned ({level}) {method} Recommendations for user {user_id}:")
+    for i, business_id in enumerate(recommendations, 1):
+        print(f"{i}. {business_names.get(business_id, 'Unknown')}")
+
+
+def shared_model_name(method, n_factors=20, profile_dim=None, profile_projection="pca"):
+    """Name the batched path of a method is published under in the model store (src.common.model_store)."""
+    if method == "content":
+        return f"content_{profile_projection}{profile_dim}" if profile_dim else "content"
+    return f"svd_{n_factors}" if method == "svd" else "matrix"
+
+
+def make_batch_scorer(method, model, fallback=None, filter_rows=None):
+    """`scorer(ids, top_n)` over the batched path of content, cf or svd, for a model dict laid out like
+    `load_version` (loaded here or mapped from the model store)."""
+    if method == "content":
+        return content_batch_fn(model["profile_components"], filter_rows=filter_rows)
+    if method == "cf":
+        if "online_cf_state" in model:
+            return online_cf_batch_fn(model["online_cf_state"], fallback=fallback, filter_rows=filter_rows)
+        return cf_batch_fn(model["matrix_components"], fallback=fallback, filter_rows=filter_rows)
+    return svd_batch_fn(model["matrix_components"], model["svd_model_components"], fallback=fallback,
+                        filter_rows=filter_rows)
+
+
+def load_batch_model(method, n_factors=20, segment=None, business_filter=None, profile_dim=None,
+                     profile_projection="pca"):
+    """
+    The model of the batched path of content, cf or svd, with the filter and fallback applied.
+
+    Returns:
+        tuple: (model dict laid out like `load_version`, make_scorer(model) -> scorer(ids, top_n))
+    """
+    if method == "content":
+        business_df = pd.read_csv(os.path.join(processed_dir, "business_processed.csv"))
+        reviews_df = pd.read_csv(os.path.join(processed_dir, "reviews_processed.csv"))
+        profiles = l1.build_item_profiles(business_df, reviews_df, n_components=profile_dim,
+                                          projection=profile_projection)
+        filter_rows = select_businesses(list(profiles.keys()), business_filter, cache_name="business_index_profiles")
+        model = {"item_profiles": profiles, "profile_components": l1.build_profile_matrix(profiles)}
+        return model, functools.partial(make_batch_scorer, method, filter_rows=filter_rows)
+
+    matrix_components = load_user_item_matrix_components(os.path.join(processed_dir, "ratings_processed.csv"))
+    business_ids = matrix_components[2]
+    filter_rows = select_businesses(business_ids, business_filter)
+    fallback = filtered_fallback(segment, business_ids, filter_rows)
+    model = {"matrix_components": matrix_components}
+    if method == "svd":
+        model["svd_model_components"] = l3.train_svd(matrix_components[0], n_factors=n_factors)
+    return model, functools.partial(make_batch_scorer, method, fallback=fallback, filter_rows=filter_rows)
+
+
+def run_batch_mode(method, id_source, output_path=None, output_format=None, top_n=5, jobs=1, chunk_size=10_000,
+                   **scorer_options):
+    # Score a file (or stdin) of IDs with the batched path of the method and stream the results to a file.
+    # With several jobs every worker maps the published model instead of holding its own copy
+    model, make_scorer = load_batch_model(method, **scorer_options)
+    model_name = None
+    if jobs > 1:
+        model_name = shared_model_name(method, scorer_options.get("n_factors", 20), scorer_options.get("profile_dim"),
+                                       scorer_options.get("profile_projection", "pca"))
+        if method == "content":
+            # The profiles have no build stage of their own to publish them
+            publish_models(item_profiles=model["item_profiles"], name=model_name)
+    output_path = output_path or os.path.join(BATCH_OUTPUT_DIR, f"{method}_recommendations.{output_format or 'csv'}")
+    writer = open_result_writer(output_path, output_format)
+    try:
+        summary = run_batch(make_scorer(model), read_id_chunks(id_source, chunk_size=chunk_size), writer,
+                            top_n=top_n, jobs=jobs, model_name=model_name, make_scorer=make_scorer)
+    finally:
+        writer.close()
+    print(f"Batch {method} recommendations written to {'stdout' if output_path == '-' else output_path}")
+    print_batch_summary(summary)
+
+
+def run_serve_mode(method, top_n=5, max_batch_size=64, max_wait_ms=2.0, events_path=None, online=False,
+                   **scorer_options):
+    # Answer request lines from stdin as JSON lines on stdout until stdin closes, micro-batching concurrent requests
+    # and answering repeated requests from the result cache. The scorer is reloaded when its model artifacts are
+    # rebuilt, and rating events appended to `events_path` drop the cached answers of their users. With `online`
+    # (cf), the neighbour lists are built once and the rating events are applied to them in place instead.
+    if online:
+        model, make_scorer = load_batch_model(method, **scorer_options)
+        state = model["online_cf_state"] = OnlineCFState(model["matrix_components"])
+        scorer, version = make_scorer(model), model_version(method, **scorer_options)
+        consume = functools.partial(consume_events, state, cache=recommendation_cache)
+    else:
+        def load():
+            model, make_scorer = load_batch_model(method, **scorer_options)
+            return make_scorer(model)
+
+        scorer = ReloadingScorer(load, functools.partial(model_version, method, **scorer_options))
+        version = scorer.current_version
+        consume = functools.partial(invalidate_rated, cache=recommendation_cache)
+    batcher = MicroBatcher(scorer, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, name=method)
+    writer = open_result_writer("-", "jsonl")
+    if events_path:
+        threading.Thread(target=consume, args=(read_rating_events(events_path, follow=True),), daemon=True).start()
+        print(f"Following rating events in {events_path}")
+
+    def respond(entity_id, recommendations):
+        writer.write([entity_id], [recommendations])
+        writer.flush()
+
+    async def serve():
+        try:
+            return await serve_requests(batcher, sys.stdin, respond, top_n=top_n, cache=recommendation_cache,
+                                        model_version=version)
+        finally:
+            await batcher.close()
+
+    print(f"Serving {method} recommendations: one '<id>' or '<id>,<top_n>' per line on stdin")
+    counts = asyncio.run(serve())
+    stats, cache_stats = batcher.stats(), recommendation_cache.stats()
+    reloads = "" if online else f"{scorer.reloads} model reloads, "
+    print(f"Served {counts['requests']} requests: {cache_stats['hits']} from the result cache "
+          f"(hit rate {cache_stats['hit_rate']:.1%}), {counts['coalesced']} shared an in-flight result, "
+          f"{stats['requests']} scored in {stats['batches']} batches (mean batch size {stats['mean_batch_size']:.1f}), "
+          f"{reloads}{cache_stats['invalidations']} cached answers invalidated")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Hybrid Yelp Recommendation System - Main Integration")
-    parser.add_argument('--method', type=str, required=True, choices=['content', 'cf', 'svd'],
-                        help="Select the recommendation method: 'content' for Content-Based, 'cf' for Collaborative Filtering, 'svd' for Matrix Factorization")
+    parser.add_argument('--method', type=str, required=True, choices=['content', 'cf', 'svd', 'hybrid', 'clustered', 'graph'],
+                        help="Select the recommendation method: 'content' for Content-Based, 'cf' for Collaborative Filtering, 'svd' for Matrix Factorization, 'hybrid' for the Level 4 Hybrid, 'clustered' for the Level 5 Clustered CF, 'graph' for the Level 6 Graph-Based random walk")
     parser.add_argument('--id', type=str, required=False,
-                        help="ID of the business (for content-based) or user (for collab/svd). Defaults to the first record if not provided.")
+                        help="ID of the business (for content-based) or user (for the other methods). Defaults to the first record if not provided.")
     parser.add_argument('--top_n', type=int, default=5,
                         help="Number of recommendations to return (default is 5).")
     parser.add_argument('--n_factors', type=int, default=20,
                         help="Number of latent factors for SVD in matrix factorization (default is 20).")
+    parser.add_argument('--n_clusters', type=int, default=100,
+                        help="Number of user clusters for the clustered method (default is 100).")
+    parser.add_argument('--n_probe', type=int, default=2,
+                        help="Number of nearest clusters searched for neighbours by the clustered method (default is 2).")
+    parser.add_argument('--approximate', type=bool, default=False,
+                        help="Set to True to use the push-based approximation for the graph method.")
+    parser.add_argument('--segment', type=str, default=None,
+                        help="Region for the check-in popularity fallback of cf/svd, e.g. 'state:PA' or 'city:Philadelphia, PA'.")
+    parser.add_argument('--filter', type=str, default=None,
+                        help="Only recommend businesses matching this expression (content, cf, svd), e.g. 'city:Philadelphia;category:Pizza|Burgers'.")
+    parser.add_argument('--partition', type=str, default=None, choices=['state', 'city'],
+                        help="Serve cf/svd from per-region models split by business state or city.")
+    parser.add_argument('--cross_region', type=str, default="user",
+                        help="Where partitioned cf/svd look when the home region has too few results: 'user' (the other regions the user rated in), 'none', or a partition name such as 'other'.")
+    parser.add_argument('--batch_input', type=str, default=None,
+                        help="Score every ID in this file (one per line, '-' for stdin) instead of a single --id (content, cf, svd).")
+    parser.add_argument('--batch_output', type=str, default=None,
+                        help="Output file of the batch mode (default data/batch/<method>_recommendations.<format>).")
+    parser.add_argument('--batch_format', type=str, default=None, choices=['csv', 'jsonl', 'parquet'],
+                        help="Output format of the batch mode (default from the output file extension, else csv).")
+    parser.add_argument('--serve', type=bool, default=False,
+                        help="Set to True to answer '<id>' or '<id>,<top_n>' lines from stdin as JSON lines on stdout until stdin closes (content, cf, svd); concurrent requests are micro-batched.")
+    parser.add_argument('--max_batch_size', type=int, default=64,
+                        help="Largest micro-batch of the serve mode (default is 64).")
+    parser.add_argument('--events', type=str, default=None,
+                        help="Serve mode (cf, svd): follow this ratings CSV for appended rating events and drop the cached answers of their users.")
+    parser.add_argument('--online', type=bool, default=False,
+                        help="Set to True to serve cf from neighbour lists kept between requests; --events then updates them in place instead of waiting for a rebuild.")
+    parser.add_argument('--max_wait_ms', type=float, default=2.0,
+                        help="Longest wait of the serve mode for a micro-batch to fill, in ms (default is 2.0).")
+    parser.add_argument('--profile_dim', type=int, default=None,
+                        help="Project the content profiles to this many dimensions plus a weighted sentiment feature (default: full embedding).")
+    parser.add_argument('--profile_projection', type=str, default="pca", choices=['pca', 'random'],
+                        help="Projection used with --profile_dim: incremental PCA or a seeded random projection (default is pca).")
+    parser.add_argument('--social', type=bool, default=False,
+                        help="Set to True to search cf neighbours among friends and friends of friends only.")
     parser.add_argument('--testing', type=bool, default=False,
                         help="Set to True to use test (5% subsample) data.")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of preprocessing/model build stages (or batch scoring workers) to run in parallel (default is 1).")
+    parser.add_argument('--trace', type=str, default=None,
+                        help="Write stage timings to this file (*.json: Chrome trace format, otherwise JSON lines).")
+    parser.add_argument('--profile', type=bool, default=False,
+                        help="Set to True to dump cProfile stats of the recommendation query to data/profiles.")
     args = parser.parse_args()
+    if args.batch_input:
+        if args.method not in ("content", "cf", "svd"):
+            parser.error(f"--batch_input supports the content, cf and svd methods, not '{args.method}'")
+        if args.social:
+            parser.error("--social has no batched path; score the IDs one --id at a time instead")
+        if args.partition:
+            parser.error("--partition cannot be combined with --batch_input")
+        if args.batch_output == "-" and args.batch_format == "parquet":
+            parser.error("--batch_format parquet needs a --batch_output file, not stdout")
+    elif args.batch_output or args.batch_format:
+        parser.error("--batch_output and --batch_format need --batch_input")
+    if args.filter is not None:
+        try:
+            parse_filter(args.filter)
+        except ValueError as e:
+            parser.error(f"--filter: {e}")
+    if args.segment is not None:
+        try:
+            parse_segment(args.segment)
+        except ValueError as e:
+            parser.error(f"--segment: {e}")
+    if args.filter is not None and args.partition:
+        parser.error("--filter cannot be combined with --partition; the partition models have no business index")
+    if args.serve:
+        if args.method not in ("content", "cf", "svd"):
+            parser.error(f"--serve supports the content, cf and svd methods, not '{args.method}'")
+        if args.batch_input or args.social or args.partition:
+            parser.error("--serve cannot be combined with --batch_input, --social or --partition")
+    if args.events and not (args.serve and args.method in ("cf", "svd")):
+        parser.error("--events needs --serve with the cf or svd method")
+    if args.online and not (args.serve and args.method == "cf"):
+        parser.error("--online needs --serve with the cf method")
 
     # Store the testing flag in an environment variable for later use
     os.environ['TESTING'] = str(args.testing)
+    os.environ['PROFILE'] = str(args.profile)
+    if args.trace:
+        configure_tracing(args.trace)
 
     # Determine the processed directory based on testing flag.
     processed_dir = TEST_DATA_PROCESSED if args.testing else DATA_PROCESSED
 
-    # Run preprocessing before executing any recommendations
-    run_preprocessing()
-
-    if args.method == "content":
-        run_content_based(business_id=args.id, top_n=args.top_n)
-    elif args.method == "cf":
-        run_collaborative(user_id=args.id, top_n=args.top_n)
-    elif args.method == "svd":
-        run_matrix_factorization(user_id=args.id, top_n=args.top_n, n_factors=args.n_factors)
+    # When the results go to stdout, the logs go to stderr so they do not end up among them.
+    log_stream = sys.stderr if args.serve or args.batch_output == "-" else sys.stdout
+    with contextlib.redirect_stdout(log_stream):
+        # Run preprocessing and the model builds before executing any recommendations
+        run_preprocessing(args.method, jobs=args.jobs, n_factors=args.n_factors, n_clusters=args.n_clusters,
+                          testing=args.testing, partition=args.partition, profile_dim=args.profile_dim,
+                          profile_projection=args.profile_projection)
+        if args.segment is not None:
+            # The labels can only be checked once the business table is processed
+            try:
+                check_segment(args.segment, pd.read_csv(os.path.join(processed_dir, "business_processed.csv"),
+                                                        usecols=["city", "state"]))
+            except ValueError as e:
+                parser.error(f"--segment: {e}")
+
+        scorer_options = {"n_factors": args.n_factors, "segment": args.segment, "business_filter": args.filter,
+                          "profile_dim": args.profile_dim, "profile_projection": args.profile_projection}
+        if args.batch_input:
+            run_batch_mode(args.method, args.batch_input, output_path=args.batch_output,
+                           output_format=args.batch_format, top_n=args.top_n, jobs=args.jobs, **scorer_options)
+        elif args.serve:
+            run_serve_mode(args.method, top_n=args.top_n, max_batch_size=args.max_batch_size,
+                           max_wait_ms=args.max_wait_ms, events_path=args.events, online=args.online,
+                           **scorer_options)
+        elif args.partition and args.method in ("cf", "svd"):
+            run_partitioned(args.method, user_id=args.id, top_n=args.top_n, n_factors=args.n_factors,
+                            level=args.partition, cross_region=args.cross_region, segment=args.segment,
+                            jobs=args.jobs)
+        elif args.method == "content":
+            run_content_based(business_id=args.id, top_n=args.top_n, business_filter=args.filter,
+                              profile_dim=args.profile_dim, profile_projection=args.profile_projection)
+        elif args.method == "cf":
+            run_collaborative(user_id=args.id, top_n=args.top_n, segment=args.segment, social=args.social,
+                              business_filter=args.filter)
+        elif args.method == "svd":
+            run_matrix_factorization(user_id=args.id, top_n=args.top_n, n_factors=args.n_factors,
+                                     segment=args.segment, business_filter=args.filter)
+        elif args.method == "hybrid":
+            run_hybrid(user_id=args.id, top_n=args.top_n, n_factors=args.n_factors)
+        elif args.method == "clustered":
+            run_clustered(user_id=args.id, top_n=args.top_n, n_factors=args.n_factors, n_clusters=args.n_clusters,
+                          n_probe=args.n_probe)
+        elif args.method == "graph":
+            run_graph_based(user_id=args.id, top_n=args.top_n, approximate=args.approximate)
@@ -8,8 +8,12 @@ DATA_RAW_JSON = os.path.join(BASE_DIR, "data", "raw", "json")
 DATA_RAW_CSV = os.path.join(BASE_DIR, "data", "raw", "csv")
 DATA_PROCESSED = os.path.join(BASE_DIR, "data", "processed")
 TEST_DATA_PROCESSED = os.path.join(DATA_PROCESSED, "test")
+DATA_SYNTHETIC = os.path.join(BASE_DIR, "data", "synthetic")
 CACHE_DIR = os.path.join(BASE_DIR, "data", "cache")
 TEST_CACHE_DIR = os.path.join(CACHE_DIR, "test")
+BENCHMARK_DIR = os.path.join(BASE_DIR, "data", "benchmarks")
+PROFILE_DIR = os.path.join(BASE_DIR, "data", "profiles")
+BATCH_OUTPUT_DIR = os.path.join(BASE_DIR, "data", "batch")
 
 if __name__ == "__main__":
     print(f"Base directory: {BASE_DIR}")
@@ -17,5 +21,9 @@ if __name__ == "__main__":
     print(f"Raw CSV data path: {DATA_RAW_CSV}")
     print(f"Processed data path: {DATA_PROCESSED}")
     print(f"Processed test data path: {TEST_DATA_PROCESSED}")
+    print(f"Synthetic data path: {DATA_SYNTHETIC}")
     print(f"Cache directory: {CACHE_DIR}")
     print(f"Test Cache directory: {TEST_CACHE_DIR}")
+    print(f"Benchmark results directory: {BENCHMARK_DIR}")
+    print(f"Profile output directory: {PROFILE_DIR}")
+    print(f"Batch output directory: {BATCH_OUTPUT_DIR}")